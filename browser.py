@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""
+مجمع متصفحات Chrome قابلة لإعادة الاستخدام بدلاً من تشغيل متصفح جديد لكل حلقة أو لكل سيرفر.
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.by import By
+
+from pipeline import clamp_timeout, cancelled
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# يمكن ضبطها عبر متغيرات البيئة
+DRIVER_POOL_SIZE = int(os.environ.get("DRIVER_POOL_SIZE", "3"))
+DRIVER_MAX_PAGES = int(os.environ.get("DRIVER_MAX_PAGES", "40"))
+DRIVER_MAX_MEMORY_MB = int(os.environ.get("DRIVER_MAX_MEMORY_MB", "1500"))
+
+# التقاط روابط الفيديو من حركة الشبكة عبر سجل الأداء (CDP) بدلاً من الانتظار وفحص page_source
+NETWORK_CAPTURE = os.environ.get("NETWORK_CAPTURE", "1") == "1"
+MEDIA_CAPTURE_TIMEOUT = float(os.environ.get("MEDIA_CAPTURE_TIMEOUT", "20"))
+
+MEDIA_MIME_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl')
+
+# مهلة الانتظار الافتراضية، ومهلة لكل موقع (جزء من اسم النطاق ← ثوانٍ)
+# يمكن تعديلها عبر WAIT_TIMEOUTS="uqload=8,3seq=20"
+WAIT_TIMEOUT = float(os.environ.get("WAIT_TIMEOUT", "15"))
+SITE_WAIT_TIMEOUTS = {
+    '3seq': 15,
+    'eishq': 15,
+    'hagobi': 15,
+    'rmd.quest': 10,
+    'larozaa': 15,
+    'uqload': 10,
+    'lodynet': 15,
+}
+for _item in os.environ.get("WAIT_TIMEOUTS", "").split(','):
+    if '=' in _item:
+        _site, _seconds = _item.split('=', 1)
+        SITE_WAIT_TIMEOUTS[_site.strip()] = float(_seconds)
+
+_chromedriver_path = None
+_chromedriver_lock = threading.Lock()
+
+
+def resolve_chromedriver_path():
+    """تحديد مسار chromedriver مرة واحدة لكل عملية (النظام أولاً ثم webdriver-manager)"""
+    global _chromedriver_path
+    with _chromedriver_lock:
+        if _chromedriver_path:
+            return _chromedriver_path
+        path = '/usr/bin/chromedriver'
+        if not os.path.exists(path):
+            path = shutil.which('chromedriver')
+        if not path:
+            try:
+                from webdriver_manager.chrome import ChromeDriverManager
+                path = ChromeDriverManager().install()
+            except Exception as e:
+                print(f"❌ لم يتم العثور على chromedriver: {e}")
+                return None
+        _chromedriver_path = path
+        return path
+
+
+def build_chrome_options():
+    """خيارات Chrome في وضع headless مع إخفاء علامات الأتمتة"""
+    chrome_options = Options()
+    chrome_options.add_argument('--headless')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--window-size=1920,1080')
+    chrome_options.add_argument(f'--user-agent={USER_AGENT}')
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    chrome_options.add_argument('--disable-extensions')
+    chrome_options.add_argument('--disable-notifications')
+    chrome_options.add_argument('--ignore-certificate-errors')
+    if NETWORK_CAPTURE:
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    return chrome_options
+
+
+def _origin_of(url):
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def _frame_origins(frame_tree):
+    """أصول كل الإطارات في الصفحة الحالية (مشغّلات الفيديو المضمّنة تخزّن بياناتها في أصلها)"""
+    origins = set()
+    pending = [frame_tree]
+    while pending:
+        node = pending.pop()
+        url = node.get('frame', {}).get('url', '')
+        if url.startswith('http'):
+            origins.add(_origin_of(url))
+        pending.extend(node.get('childFrames', []))
+    return origins
+
+
+def create_driver():
+    """تشغيل متصفح جديد، مع عدّاد للصفحات المفتوحة لاستخدامه في إعادة التدوير"""
+    chromedriver_path = resolve_chromedriver_path()
+    if not chromedriver_path:
+        return None
+    try:
+        service = Service(executable_path=chromedriver_path)
+        driver = webdriver.Chrome(service=service, options=build_chrome_options())
+        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        if NETWORK_CAPTURE:
+            driver.execute_cdp_cmd('Network.enable', {})
+    except Exception as e:
+        print(f"❌ فشل إعداد Selenium: {e}")
+        return None
+
+    driver.pages_loaded = 0
+    # المواقع التي زارها المتصفح منذ آخر مسح، لمسح تخزينها قبل إعارته لحلقة أخرى
+    driver.visited_origins = set()
+    original_get = driver.get
+
+    def counting_get(url):
+        if url != 'about:blank':
+            driver.pages_loaded += 1
+            driver.visited_origins.add(_origin_of(url))
+        return original_get(url)
+
+    driver.get = counting_get
+    return driver
+
+
+# ===== محرك الانتظار: شروط تعود فور تحققها بدلاً من time.sleep ثابت =====
+_wait_stats = {}
+_wait_stats_lock = threading.Lock()
+
+
+def site_timeout(url, default=None):
+    """مهلة الانتظار الخاصة بالموقع حسب اسم النطاق"""
+    host = urlparse(url or '').netloc.lower()
+    for site, seconds in SITE_WAIT_TIMEOUTS.items():
+        if site in host:
+            return seconds
+    return default if default is not None else WAIT_TIMEOUT
+
+
+def record_wait(name, url, elapsed, met):
+    """تسجيل مدة انتظار واحدة لمعرفة أين يذهب وقت الاستخراج"""
+    host = urlparse(url or '').netloc or '-'
+    with _wait_stats_lock:
+        stat = _wait_stats.setdefault((name, host), {'count': 0, 'met': 0, 'total': 0.0, 'max': 0.0})
+        stat['count'] += 1
+        stat['met'] += 1 if met else 0
+        stat['total'] += elapsed
+        stat['max'] = max(stat['max'], elapsed)
+    print(f"⏱️ [{name}] {'✓' if met else '✗'} {elapsed:.1f}s ({host})")
+
+
+def print_wait_summary():
+    """طباعة ملخص أوقات الانتظار لكل شرط ولكل موقع في نهاية التشغيل"""
+    with _wait_stats_lock:
+        items = sorted(_wait_stats.items(), key=lambda item: -item[1]['total'])
+    if not items:
+        return
+    print("\n⏱️ ملخص أوقات الانتظار:")
+    for (name, host), stat in items:
+        print(f"   {name:<14} {host:<28} مرات: {stat['count']:<3} نجاح: {stat['met']:<3} "
+              f"المجموع: {stat['total']:.1f}s الأقصى: {stat['max']:.1f}s")
+
+
+def _current_url(driver):
+    try:
+        return driver.current_url
+    except Exception:
+        return ''
+
+
+def wait_for(driver, condition, name, timeout=None, poll_interval=0.25):
+    """
+    الانتظار حتى تعيد condition(driver) قيمة غير فارغة أو انتهاء المهلة.
+    المهلة الافتراضية هي مهلة الموقع الحالي. يعيد القيمة أو None، ويُسجَّل زمن الانتظار.
+    """
+    url = _current_url(driver)
+    if timeout is None:
+        timeout = site_timeout(url)
+    timeout = clamp_timeout(timeout)
+    start = time.time()
+    while True:
+        try:
+            value = condition(driver)
+        except Exception:
+            # عناصر قديمة (stale) أو صفحة قيد التحميل: نعيد المحاولة
+            value = None
+        if value or time.time() - start >= timeout or cancelled():
+            break
+        time.sleep(poll_interval)
+    record_wait(name, url, time.time() - start, bool(value))
+    return value or None
+
+
+def page_loaded():
+    """اكتمال تحميل المستند"""
+    return lambda driver: driver.execute_script("return document.readyState") == 'complete'
+
+
+def redirect_settled(start_url, stable_for=1.0):
+    """تغيّر الرابط عن start_url وثباته لمدة stable_for ثانية، يعيد الرابط النهائي"""
+    state = {'url': None, 'since': 0.0}
+
+    def condition(driver):
+        url = driver.current_url
+        if url != state['url']:
+            state['url'], state['since'] = url, time.time()
+            return None
+        if url != start_url and time.time() - state['since'] >= stable_for:
+            return url
+        return None
+    return condition
+
+
+def url_changed(old_url):
+    """تغيّر رابط الصفحة (مثلاً بعد إرسال نموذج)"""
+    return lambda driver: driver.current_url if driver.current_url != old_url else None
+
+
+def element_present(css=None, xpath=None):
+    """وجود عنصر حسب CSS أو XPath، يعيد العنصر"""
+    def condition(driver):
+        if xpath:
+            elements = driver.find_elements(By.XPATH, xpath)
+        else:
+            elements = driver.find_elements(By.CSS_SELECTOR, css)
+        return elements[0] if elements else None
+    return condition
+
+
+def iframe_with_src(css='iframe', predicate=None):
+    """وجود iframe له src (ويحقق predicate إن وُجد)، يعيد قيمة src"""
+    def condition(driver):
+        for iframe in driver.find_elements(By.CSS_SELECTOR, css):
+            src = iframe.get_attribute('src')
+            if src and (predicate is None or predicate(src)):
+                return src
+        return None
+    return condition
+
+
+def video_has_src():
+    """وجود عنصر video أو source برابط http، يعيد الرابط"""
+    script = """
+    var video = document.querySelector('video');
+    if (video && (video.currentSrc || video.src)) return video.currentSrc || video.src;
+    var source = document.querySelector('video source[src], source[src]');
+    return source ? source.src : null;
+    """
+
+    def condition(driver):
+        src = driver.execute_script(script)
+        return src if src and src.startswith('http') else None
+    return condition
+
+
+def page_source_matches(pattern):
+    """ظهور نص يطابق التعبير المنتظم في page_source، يعيد أول مجموعة مطابقة"""
+    regex = re.compile(pattern)
+
+    def condition(driver):
+        match = regex.search(driver.page_source)
+        if not match:
+            return None
+        return match.group(1) if regex.groups else match.group(0)
+    return condition
+
+
+def any_of(*conditions):
+    """أول شرط يتحقق من بين عدة شروط"""
+    def condition(driver):
+        for cond in conditions:
+            value = cond(driver)
+            if value:
+                return value
+        return None
+    return condition
+
+
+def drain_network_log(driver):
+    """قراءة سجل الأداء وتفريغه حتى لا تُحسب طلبات صفحة سابقة"""
+    if not NETWORK_CAPTURE:
+        return []
+    try:
+        return driver.get_log('performance')
+    except Exception:
+        return []
+
+
+def _is_media_response(response):
+    mime = (response.get('mimeType') or '').lower()
+    if mime == 'video/mp2t':
+        # مقاطع HLS: الرابط المطلوب هو ملف m3u8 وليس المقطع
+        return False
+    return mime.startswith('video/') or mime in MEDIA_MIME_TYPES
+
+
+def _is_media_url(url):
+    path = url.split('?', 1)[0].split('#', 1)[0].lower()
+    return url.startswith('http') and path.endswith(('.m3u8', '.mp4'))
+
+
+# هيدرز خاصة بالطلب نفسه أو بالاتصال لا معنى لتمريرها إلى التنزيل (المُنزِّل يضع Range وضغطه بنفسه)
+_NON_FORWARDABLE_HEADERS = {'host', 'connection', 'content-length', 'range', 'if-range', 'accept-encoding',
+                            'if-none-match', 'if-modified-since'}
+
+
+def forwardable_headers(headers):
+    """
+    هيدرز طلب المشغّل التي يحتاجها التنزيل ليُقبل مثل المتصفح (Cookie، Origin، User-Agent، Referer، ...).
+    الأسماء تُوحَّد (HTTP/2 يرسلها بأحرف صغيرة) حتى لا يتكرر الهيدر نفسه عند دمجه مع هيدرز التنزيل.
+    """
+    return {'-'.join(part.capitalize() for part in name.split('-')): value
+            for name, value in (headers or {}).items()
+            if not name.startswith(':') and name.lower() not in _NON_FORWARDABLE_HEADERS}
+
+
+def wait_for_media_request(driver, timeout=MEDIA_CAPTURE_TIMEOUT, poll_interval=0.25, stop_when=None):
+    """
+    مراقبة طلبات الشبكة في المتصفح حتى يطلب المشغّل ملف m3u8/mp4 أو استجابة من نوع video.
+    يعيد قاموساً {'url', 'headers', 'referer', 'mime_type'} فور ظهور الطلب، أو None بعد المهلة.
+    headers: هيدرز الطلب القابلة للتمرير (forwardable_headers)، تُعطى للتنزيل حتى تقبله السيرفرات التي تشترط الكوكيز.
+    stop_when: شرط اختياري (مثل iframe_with_src) يُنهي المراقبة مبكراً عند تحققه.
+    يجب استدعاء drain_network_log قبل driver.get حتى لا تختلط طلبات الصفحة السابقة.
+    """
+    if not NETWORK_CAPTURE:
+        return None
+
+    requests_by_id = {}
+    extra_headers = {}
+
+    def media_info(request_id, url, mime_type=None):
+        request = requests_by_id.get(request_id, {})
+        headers = dict(request.get('headers', {}))
+        headers.update(extra_headers.get(request_id, {}))
+        referer = headers.get('Referer') or headers.get('referer') or driver.current_url
+        return {'url': url, 'headers': forwardable_headers(headers), 'referer': referer, 'mime_type': mime_type}
+
+    deadline = time.time() + timeout
+    while True:
+        for entry in drain_network_log(driver):
+            try:
+                message = json.loads(entry['message'])['message']
+            except Exception:
+                continue
+            method = message.get('method')
+            params = message.get('params', {})
+            request_id = params.get('requestId')
+
+            if method == 'Network.requestWillBeSent':
+                request = params.get('request', {})
+                requests_by_id[request_id] = request
+                url = request.get('url', '')
+                if _is_media_url(url):
+                    return media_info(request_id, url)
+            elif method == 'Network.requestWillBeSentExtraInfo':
+                extra_headers.setdefault(request_id, {}).update(params.get('headers', {}))
+            elif method == 'Network.responseReceived':
+                response = params.get('response', {})
+                url = response.get('url', '')
+                if url.startswith('http') and _is_media_response(response):
+                    return media_info(request_id, url, response.get('mimeType'))
+
+        if time.time() >= deadline or cancelled():
+            return None
+        if stop_when:
+            try:
+                if stop_when(driver):
+                    return None
+            except Exception:
+                pass
+        time.sleep(poll_interval)
+
+
+def capture_media_request(driver, url, timeout=None, stop_when=None):
+    """فتح الصفحة وإرجاع أول طلب فيديو يرسله المشغّل (أو None)، بمهلة الموقع افتراضياً"""
+    drain_network_log(driver)
+    driver.get(url)
+    if not NETWORK_CAPTURE:
+        return None
+    if timeout is None:
+        timeout = site_timeout(url, MEDIA_CAPTURE_TIMEOUT)
+    timeout = clamp_timeout(timeout)
+    start = time.time()
+    media = wait_for_media_request(driver, timeout=timeout, stop_when=stop_when)
+    record_wait('media_request', url, time.time() - start, bool(media))
+    if media:
+        print(f"📡 تم التقاط طلب الفيديو من الشبكة: {media['url'][:100]}...")
+    return media
+
+
+def _process_tree_rss_mb(root_pid):
+    """مجموع الذاكرة المقيمة (RSS) لعملية chromedriver وكل عمليات Chrome التابعة لها (لينكس فقط)"""
+    children = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    stat = f.read()
+                ppid = int(stat.rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except Exception:
+                continue
+    except Exception:
+        return 0
+
+    total_kb = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+                        break
+        except Exception:
+            continue
+    return total_kb / 1024
+
+
+def driver_memory_mb(driver):
+    try:
+        return _process_tree_rss_mb(driver.service.process.pid)
+    except Exception:
+        return 0
+
+
+class DriverPool:
+    """
+    مجمع متصفحات آمن للاستخدام من عدة خيوط.
+    - يشغّل حتى size متصفحات عند الحاجة ثم يعيد استخدامها
+    - يمسح الكوكيز والتخزين بين الإعارات (clear_state)
+    - يعيد تدوير المتصفح بعد max_pages صفحة أو عند تجاوز max_memory_mb
+    """
+
+    def __init__(self, size=DRIVER_POOL_SIZE, max_pages=DRIVER_MAX_PAGES,
+                 max_memory_mb=DRIVER_MAX_MEMORY_MB, clear_state=True):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.clear_state = clear_state
+        # متصفحات خاملة (آخر متصفح أُعيد يُعار أولاً)، والشرط يوقظ المنتظرين عند الإعادة أو الإغلاق
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        الحصول على متصفح: متصفح خامل إن وُجد، أو متصفح جديد ضمن الحد، أو الانتظار.
+        إغلاق متصفح (_discard) يوقظ منتظراً ليشغّل بديلاً، والانتظار لا يتجاوز موعد انتهاء التشغيل.
+        """
+        timeout = clamp_timeout(timeout)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    print("⚠️ لا يوجد متصفح متاح في المجمع.")
+                    return None
+                self._cond.wait(wait)
+
+        driver = create_driver()
+        if not driver:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+        return driver
+
+    def _discard(self, driver):
+        with self._cond:
+            self._created -= 1
+            self._cond.notify()
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def _reset(self, driver):
+        """
+        مسح الكوكيز والتخزين وإيقاف أي مشغّل فيديو قبل إعادة المتصفح للمجمع.
+        أي فشل هنا يُرفع ليُغلق المتصفح بدلاً من إعارته ببيانات موقع سابق.
+        """
+        if self.clear_state:
+            driver.visited_origins |= _frame_origins(driver.execute_cdp_cmd('Page.getFrameTree', {})['frameTree'])
+        driver.get('about:blank')
+        if self.clear_state:
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+            for origin in driver.visited_origins:
+                driver.execute_cdp_cmd('Storage.clearDataForOrigin', {
+                    'origin': origin,
+                    'storageTypes': 'local_storage,session_storage,indexeddb,websql,service_workers,cache_storage',
+                })
+            driver.visited_origins.clear()
+        drain_network_log(driver)
+
+    def release(self, driver, broken=False):
+        """إعادة المتصفح إلى المجمع أو إغلاقه إذا كان معطلاً أو تجاوز حدود إعادة التدوير"""
+        if driver is None:
+            return
+        if broken or driver.pages_loaded >= self.max_pages:
+            self._discard(driver)
+            return
+        memory_mb = driver_memory_mb(driver)
+        if self.max_memory_mb and memory_mb > self.max_memory_mb:
+            print(f"♻️ إعادة تدوير المتصفح (الذاكرة {memory_mb:.0f}MB)")
+            self._discard(driver)
+            return
+        try:
+            self._reset(driver)
+        except Exception as e:
+            print(f"⚠️ تعذّر مسح حالة المتصفح، سيُغلق: {e}")
+            self._discard(driver)
+            return
+        with self._cond:
+            self._idle.append(driver)
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """
+        استعارة متصفح داخل كتلة with، يعيد None إذا تعذّر تشغيل المتصفح.
+        عند حدوث استثناء داخل الكتلة يُغلق المتصفح بدلاً من إعادته.
+        """
+        driver = self.acquire(timeout=timeout)
+        try:
+            yield driver
+        except Exception:
+            self.release(driver, broken=True)
+            driver = None
+            raise
+        finally:
+            if driver is not None:
+                self.release(driver)
+
+    def close_all(self):
+        """إغلاق جميع المتصفحات الخاملة في نهاية التشغيل"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for driver in idle:
+            self._discard(driver)
+
+
+# مجمع مشترك لكل السكريبت
+driver_pool = DriverPool()
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+"""
+تنزيل ملفات الفيديو المباشرة (MP4) عبر عدة اتصالات متوازية بطلبات Range،
+مع الرجوع إلى اتصال واحد إذا كان السيرفر لا يدعم Range، وتنزيل بث HLS بمقاطع متوازية.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+from pipeline import cancelled, check_deadline, carry_context, wait_process, DeadlineExceeded, CANCEL_POLL_SECONDS
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# ارتفاع النسخة النهائية بعد الضغط (240p): لا فائدة من تنزيل مصدر أعلى بكثير منه
+TARGET_HEIGHT = int(os.environ.get("TARGET_HEIGHT", "240"))
+
+# يمكن ضبطها عبر متغيرات البيئة
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+# لا نقسم الملفات الأصغر من هذا الحجم (لكل اتصال)
+DOWNLOAD_MIN_SEGMENT_MB = int(os.environ.get("DOWNLOAD_MIN_SEGMENT_MB", "8"))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "5"))
+
+
+class Progress:
+    """عدّاد تقدم آمن للخيوط يطبع سطراً واحداً كل PROGRESS_INTERVAL ثانية على الأكثر"""
+
+    def __init__(self, total_size, label="جاري التحميل", interval=PROGRESS_INTERVAL):
+        self.total_size = total_size
+        self.label = label
+        self.interval = interval
+        self.downloaded = 0
+        self.started = time.time()
+        self._last_print = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        # يُستدعى مع كل قطعة، فهو أنسب مكان لإيقاف التنزيل عند موعد انتهاء التشغيل
+        check_deadline()
+        with self._lock:
+            self.downloaded += size
+            now = time.time()
+            if now - self._last_print < self.interval:
+                return
+            self._last_print = now
+            self._print(now)
+
+    def _print(self, now):
+        speed = self.downloaded / max(now - self.started, 0.001) / (1024 * 1024)
+        done_mb = self.downloaded / (1024 * 1024)
+        if self.total_size:
+            percent = self.downloaded / self.total_size * 100
+            print(f"⏳ {self.label}: {percent:.1f}% ({done_mb:.0f}/{self.total_size / (1024 * 1024):.0f}MB، {speed:.1f}MB/s)")
+        else:
+            print(f"⏳ {self.label}: {done_mb:.0f}MB ({speed:.1f}MB/s)")
+
+    def finish(self):
+        with self._lock:
+            self._print(time.time())
+
+
+def probe_range_support(session, url, headers, timeout=30):
+    """
+    طلب أول بايت فقط لمعرفة حجم الملف ودعم Range.
+    يعيد (total_size, accepts_ranges)؛ total_size = 0 إذا كان غير معروف.
+    """
+    with session.get(url, headers={**headers, 'Range': 'bytes=0-0'}, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        if r.status_code == 206:
+            match = re.search(r'/(\d+)$', r.headers.get('Content-Range', ''))
+            if match:
+                return int(match.group(1)), True
+        return int(r.headers.get('Content-Length', 0) or 0), False
+
+
+def _fetch_range(url, headers, output_path, start, end, progress, timeout):
+    """تنزيل المقطع [start, end] وكتابته في موضعه داخل الملف، مع الاستكمال من آخر بايت عند الخطأ"""
+    position = start
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            range_headers = {**headers, 'Range': f'bytes={position}-{end}'}
+            with requests.get(url, headers=range_headers, stream=True, timeout=timeout) as r:
+                if r.status_code != 206:
+                    raise Exception(f"السيرفر أعاد {r.status_code} بدلاً من 206")
+                with open(output_path, 'r+b') as f:
+                    f.seek(position)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            position += len(chunk)
+                            progress.add(len(chunk))
+            if position > end:
+                return True
+            raise Exception(f"انقطع المقطع عند {position}/{end}")
+        except DeadlineExceeded:
+            return False
+        except Exception as e:
+            print(f"⚠️ فشل المقطع {start}-{end} (محاولة {attempt}/{DOWNLOAD_RETRIES}): {e}")
+    return False
+
+
+def _download_segmented(url, headers, output_path, total_size, connections, timeout):
+    """تقسيم الملف إلى connections مقطعاً تُنزَّل بالتوازي في ملف محجوز مسبقاً"""
+    with open(output_path, 'wb') as f:
+        f.truncate(total_size)
+
+    segment_size = -(-total_size // connections)
+    ranges = [(start, min(start + segment_size, total_size) - 1)
+              for start in range(0, total_size, segment_size)]
+    print(f"🔀 تنزيل عبر {len(ranges)} اتصالات متوازية ({total_size / (1024 * 1024):.0f}MB)")
+
+    progress = Progress(total_size)
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="segment") as executor:
+        results = list(executor.map(
+            carry_context(lambda r: _fetch_range(url, headers, output_path, r[0], r[1], progress, timeout)), ranges))
+    progress.finish()
+    return all(results) and os.path.getsize(output_path) == total_size
+
+
+def _download_single(session, url, headers, output_path, total_size, timeout):
+    """تنزيل الملف عبر اتصال واحد (عندما لا يدعم السيرفر Range)"""
+    progress = Progress(total_size)
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        with open(output_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    progress.add(len(chunk))
+    progress.finish()
+    return not total_size or os.path.getsize(output_path) == total_size
+
+
+def download_file(url, output_path, headers=None, connections=DOWNLOAD_CONNECTIONS, timeout=60):
+    """
+    تنزيل ملف مباشر إلى output_path.
+    إذا دعم السيرفر Range وكان الملف كبيراً بما يكفي يُقسَّم على عدة اتصالات، وإلا اتصال واحد.
+    يعيد True عند اكتمال الملف.
+    """
+    headers = headers or {}
+    session = requests.Session()
+    try:
+        total_size, accepts_ranges = probe_range_support(session, url, headers, timeout)
+        min_size = DOWNLOAD_MIN_SEGMENT_MB * 1024 * 1024
+        connections = min(connections, total_size // min_size) if total_size else 1
+        if accepts_ranges and connections > 1:
+            if _download_segmented(url, headers, output_path, total_size, connections, timeout):
+                return True
+            print("⚠️ فشل التنزيل المقسّم، الرجوع إلى اتصال واحد...")
+        return _download_single(session, url, headers, output_path, total_size, timeout)
+    except Exception as e:
+        print(f"❌ فشل التنزيل: {e}")
+        return False
+    finally:
+        session.close()
+
+
+# ===== تنزيل HLS (m3u8) بمقاطع متوازية =====
+HLS_WORKERS = int(os.environ.get("HLS_WORKERS", "8"))
+HLS_MARKER_FILE = "playlist.id"
+
+
+def is_hls_url(url):
+    return '.m3u8' in (url or '').split('?', 1)[0].lower()
+
+
+def _parse_attributes(line):
+    """قراءة خصائص سطر مثل #EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=1280x720"""
+    return {key: value.strip('"') for key, value in
+            re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.split(':', 1)[1] if ':' in line else '')}
+
+
+def parse_master_playlist(text, base_url):
+    """قائمة الجودات في master playlist: [{'url', 'height', 'bandwidth', 'audio'}]"""
+    variants = []
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    audio_groups_with_uri = {
+        _parse_attributes(line).get('GROUP-ID') for line in lines
+        if line.startswith('#EXT-X-MEDIA:') and 'TYPE=AUDIO' in line and 'URI=' in line
+    }
+    for i, line in enumerate(lines):
+        if line.startswith('#EXT-X-STREAM-INF:') and i + 1 < len(lines):
+            attrs = _parse_attributes(line)
+            resolution = attrs.get('RESOLUTION', '')
+            height = int(resolution.split('x')[1]) if 'x' in resolution else 0
+            variants.append({
+                'url': urljoin(base_url, lines[i + 1]),
+                'height': height,
+                'bandwidth': int(attrs.get('BANDWIDTH', 0) or 0),
+                # الصوت في ملف منفصل: لا يمكن دمجه بهذا المحرك البسيط
+                'separate_audio': attrs.get('AUDIO') in audio_groups_with_uri,
+            })
+    return variants
+
+
+def select_variant(variants, target_height=TARGET_HEIGHT):
+    """
+    أصغر جودة لا تقل عن target_height (أقل حجم يكفي للنسخة النهائية)،
+    أو أعلى جودة متاحة إذا كانت كلها أقل منه.
+    الجودات ذات الصوت المنفصل تُستبعد أولاً لأن المحرك لا يدمجها؛ يعيد None إذا لم تبقَ جودة مدمجة.
+    """
+    variants = [v for v in variants if not v['separate_audio']]
+    if not variants:
+        return None
+    enough = [v for v in variants if v['height'] >= target_height]
+    if enough:
+        return min(enough, key=lambda v: (v['height'], v['bandwidth']))
+    known = [v for v in variants if v['height']]
+    if known:
+        return max(known, key=lambda v: (v['height'], v['bandwidth']))
+    # بدون دقة معروفة (قد تكون بعض الجودات صوتاً فقط): الأعلى معدلاً أكثر أماناً
+    return max(variants, key=lambda v: v['bandwidth'])
+
+
+def ytdlp_format_options(target_height=TARGET_HEIGHT):
+    """
+    خيارات yt-dlp لاختيار أصغر مصدر لا يقل عن target_height بدلاً من أفضل جودة حتى 720p.
+    '+res' يعكس ترتيب الدقة فيُفضَّل الأصغر، و ?= يقبل الصيغ غير المعروفة الدقة (روابط mp4 المباشرة).
+    إذا كانت كل الصيغ أقل من target_height فالاحتياط w/wv* ("الأسوأ" حسب الترتيب المعكوس = الأعلى دقة)،
+    مثل select_variant.
+    """
+    return {
+        'format': f'b[height>=?{target_height}]/bv*[height>=?{target_height}]+ba/w/wv*+ba',
+        'format_sort': ['+res', '+size', '+br'],
+    }
+
+
+def parse_media_playlist(text, base_url):
+    """
+    روابط المقاطع بالترتيب ومقطع التهيئة (EXT-X-MAP) إن وُجد.
+    يعيد (segments, init_url) أو (None, None) إذا كانت القائمة مشفرة أو بصيغة لا يدعمها المحرك.
+    """
+    segments = []
+    init_url = None
+    for line in (line.strip() for line in text.splitlines()):
+        if not line:
+            continue
+        if line.startswith('#EXT-X-KEY:') and 'METHOD=NONE' not in line:
+            return None, None
+        if line.startswith('#EXT-X-BYTERANGE'):
+            return None, None
+        if line.startswith('#EXT-X-MAP:'):
+            uri = _parse_attributes(line).get('URI')
+            if uri:
+                init_url = urljoin(base_url, uri)
+        elif not line.startswith('#'):
+            segments.append(urljoin(base_url, line))
+    return segments, init_url
+
+
+def _make_session(headers, pool_size):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(headers)
+    return session
+
+
+def _fetch_segment(session, url, path, progress, timeout):
+    """تنزيل مقطع واحد إلى ملف مؤقت ثم إعادة تسميته، فوجود الملف يعني اكتمال المقطع"""
+    if os.path.exists(path):
+        return True
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout) as r:
+                r.raise_for_status()
+                with open(path + '.part', 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                            progress.add(len(chunk))
+            os.replace(path + '.part', path)
+            return True
+        except DeadlineExceeded:
+            return False
+        except Exception as e:
+            if attempt == DOWNLOAD_RETRIES:
+                print(f"❌ فشل المقطع {os.path.basename(path)}: {e}")
+    return False
+
+
+def _playlist_marker(urls):
+    """بصمة قائمة المقاطع بدون query (التوكنات الموقّعة تتغير بين الطلبات لنفس النسخة)"""
+    joined = '\n'.join(u.split('?', 1)[0] for u in urls)
+    return hashlib.sha1(joined.encode('utf-8')).hexdigest()
+
+
+def _prepare_segments_dir(segments_dir, urls):
+    """
+    إنشاء مجلد المقاطع مع ملف بصمة القائمة؛ إذا كانت المقاطع الموجودة من قائمة أخرى
+    (سيرفر أو جودة مختلفة) يُمسح المجلد حتى لا تُخلط مقاطع نسختين في ملف واحد.
+    """
+    marker_path = os.path.join(segments_dir, HLS_MARKER_FILE)
+    marker = _playlist_marker(urls)
+    if os.path.isdir(segments_dir):
+        try:
+            with open(marker_path, 'r', encoding='utf-8') as f:
+                previous = f.read().strip()
+        except Exception:
+            previous = None
+        if previous != marker:
+            print("🧹 مقاطع HLS المحفوظة من قائمة مختلفة، سيتم حذفها")
+            shutil.rmtree(segments_dir, ignore_errors=True)
+    os.makedirs(segments_dir, exist_ok=True)
+    with open(marker_path, 'w', encoding='utf-8') as f:
+        f.write(marker)
+
+
+def discard_hls_segments(output_path):
+    """
+    حذف مقاطع HLS المحفوظة للاستئناف عندما ينتقل المستدعي إلى yt-dlp (الذي لا يستخدمها).
+    إذا انتهى الوقت أو أُلغيت المرحلة تبقى المقاطع ليستأنف منها التشغيل التالي.
+    """
+    if cancelled():
+        return
+    shutil.rmtree(output_path + '.segments', ignore_errors=True)
+
+
+def remux_output_args(output_path):
+    """إعادة تغليف المقاطع في MP4 بدون إعادة ترميز"""
+    return ['-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-movflags', '+faststart', '-y', output_path]
+
+
+def download_hls(url, output_path, headers=None, target_height=TARGET_HEIGHT, workers=HLS_WORKERS, timeout=30,
+                 output_args=None):
+    """
+    تنزيل بث HLS مباشرة: اختيار أصغر جودة تكفي target_height من master playlist، تنزيل المقاطع بالتوازي عبر
+    مجمع اتصالات واحد مع نفس الهيدرز (Referer/User-Agent)، وتمريرها بالترتيب إلى ffmpeg فور اكتمال كل مقطع.
+    output_args: معاملات مخرجات ffmpeg (افتراضياً إعادة تغليف في output_path؛ ويمكن تمرير أوامر الضغط مباشرة).
+    المقاطع المكتملة تبقى في مجلد <output>.segments حتى ينجح ffmpeg، فيُستأنف التنزيل المنقطع من حيث توقف.
+    يعيد False إذا كانت القائمة مشفرة أو غير مدعومة ليستخدم المستدعي yt-dlp بدلاً منها.
+    """
+    session = _make_session(headers or {}, workers)
+    try:
+        r = session.get(url, timeout=timeout)
+        r.raise_for_status()
+        playlist_url, text = r.url, r.text
+
+        if '#EXT-X-STREAM-INF' in text:
+            variant = select_variant(parse_master_playlist(text, playlist_url), target_height)
+            if not variant:
+                print("⚠️ كل جودات HLS بصوت منفصل أو بدون جودات، سيتم استخدام yt-dlp.")
+                return False
+            print(f"🎚️ جودة HLS المختارة: {variant['height'] or '?'}p ({variant['bandwidth'] // 1000}kbps)")
+            r = session.get(variant['url'], timeout=timeout)
+            r.raise_for_status()
+            playlist_url, text = r.url, r.text
+
+        segments, init_url = parse_media_playlist(text, playlist_url)
+        if not segments:
+            print("⚠️ قائمة HLS مشفرة أو غير مدعومة، سيتم استخدام yt-dlp.")
+            return False
+
+        segments_dir = output_path + '.segments'
+        urls = ([init_url] if init_url else []) + segments
+        _prepare_segments_dir(segments_dir, urls)
+        paths = [os.path.join(segments_dir, f"{i:05d}.seg") for i in range(len(urls))]
+        done = sum(1 for path in paths if os.path.exists(path))
+        if done:
+            print(f"↩️ استئناف تنزيل HLS: {done}/{len(paths)} مقطع مكتمل مسبقاً")
+        print(f"📥 تنزيل {len(paths)} مقطع HLS عبر {workers} اتصالات")
+
+        cmd = ['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0'] + (output_args or remux_output_args(output_path))
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        except Exception as e:
+            print(f"❌ فشل تشغيل ffmpeg: {e}")
+            return False
+
+        progress = Progress(0, label="مقاطع HLS")
+        ready = [threading.Event() for _ in paths]
+        fetched = [False] * len(paths)
+
+        def fetch(index):
+            try:
+                fetched[index] = _fetch_segment(session, urls[index], paths[index], progress, timeout)
+            finally:
+                ready[index].set()
+
+        # العمال يسبقون الكاتب، والكاتب يمرر المقاطع بالترتيب إلى ffmpeg ليبدأ العمل أثناء التنزيل
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hls")
+        try:
+            for index in range(len(paths)):
+                executor.submit(carry_context(fetch), index)
+            for index, path in enumerate(paths):
+                while not ready[index].wait(CANCEL_POLL_SECONDS):
+                    check_deadline()
+                if not fetched[index]:
+                    raise Exception(f"لم يكتمل المقطع {index}")
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, proc.stdin, DOWNLOAD_CHUNK_SIZE)
+            proc.stdin.close()
+        except Exception as e:
+            print(f"❌ توقف تنزيل HLS: {e} (المقاطع المكتملة محفوظة للاستئناف)")
+            proc.kill()
+            executor.shutdown(wait=True, cancel_futures=True)
+            proc.wait()
+            return False
+        executor.shutdown(wait=True)
+        progress.finish()
+
+        # في وضع البث يضغط ffmpeg بعد آخر مقطع، فالانتظار يجب أن يتوقف مع إلغاء المرحلة
+        if wait_process(proc) != 0:
+            print("❌ فشل ffmpeg في معالجة مقاطع HLS")
+            return False
+        shutil.rmtree(segments_dir, ignore_errors=True)
+        return True
+    except Exception as e:
+        print(f"❌ فشل تنزيل HLS: {e}")
+        return False
+    finally:
+        session.close()
+
+
+def _playlist_duration(text):
+    return sum(float(match) for match in re.findall(r'#EXTINF:([\d.]+)', text))
+
+
+def estimate_media_size(url, headers=None, target_height=TARGET_HEIGHT, timeout=15):
+    """
+    تقدير حجم التنزيل بالبايت لمقارنة السيرفرات: Content-Length للملفات المباشرة،
+    أو (معدل الجودة المختارة × مدة القائمة) لبث HLS. يعيد None إذا تعذّر التقدير.
+    """
+    headers = {'User-Agent': USER_AGENT, **(headers or {})}
+    session = requests.Session()
+    try:
+        if not is_hls_url(url):
+            total_size, _ = probe_range_support(session, url, headers, timeout)
+            return total_size or None
+
+        r = session.get(url, headers=headers, timeout=timeout)
+        r.raise_for_status()
+        playlist_url, text = r.url, r.text
+        bandwidth = 0
+        if '#EXT-X-STREAM-INF' in text:
+            variant = select_variant(parse_master_playlist(text, playlist_url), target_height)
+            if not variant:
+                return None
+            bandwidth = variant['bandwidth']
+            r = session.get(variant['url'], headers=headers, timeout=timeout)
+            r.raise_for_status()
+            text = r.text
+        duration = _playlist_duration(text)
+        if not bandwidth or not duration:
+            return None
+        return int(bandwidth / 8 * duration)
+    except Exception:
+        return None
+    finally:
+        session.close()
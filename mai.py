@@ -11,9 +11,7 @@ import json
 import subprocess
 import shutil
 import asyncio
-import random
 import re
-from datetime import datetime
 
 # ===== التهيئة والتحقق =====
 TELEGRAM_API_ID = os.environ.get("API_ID", "")
@@ -54,7 +52,8 @@ def install_requirements():
         "yt-dlp>=2024.4.9",
         "curl_cffi>=0.5.10",
         "selenium>=4.15.0",
-        "beautifulsoup4>=4.12.0"
+        "beautifulsoup4>=4.12.0",
+        "requests>=2.28.0"
     ]
     for req in reqs:
         try:
@@ -63,49 +62,26 @@ def install_requirements():
         except:
             print(f"  ⚠️ Failed to install {req}")
 
-install_requirements()
+# خادم forkserver لعمليات yt-dlp يستورد هذا الملف باسم __mp_main__، والحزم مثبتة مسبقاً
+if __name__ == "__main__":
+    install_requirements()
 
 from pyrogram import Client
-from pyrogram.errors import FloodWait
-import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 
-app = None
+from browser import (driver_pool, capture_media_request, wait_for, element_present, video_has_src,
+                     print_wait_summary, NETWORK_CAPTURE)
+from resolver import race_collect, rank_mirrors_by_size, url_cache, use_cached_url, host_health, MIRROR_GRACE_SECONDS
+from downloader import download_hls, discard_hls_segments, is_hls_url, HLS_WORKERS, ytdlp_format_options
+from transcode import compress_to_240p, create_thumbnail, probe_media_async
+from pipeline import Pipeline, Stage, TimeBudget, run_io, ytdlp_download_blocking, shutdown_executors, cancelled
+from state import Manifest
+from uploader import UploadIndex, OrderedUploader, UPLOAD_CONCURRENCY
+from ratelimit import telegram_limiter, host_scheduler
 
-# ===== إعداد Selenium =====
-def setup_selenium():
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    
-    chromedriver_path = '/usr/bin/chromedriver'
-    if not os.path.exists(chromedriver_path):
-        chromedriver_path = shutil.which('chromedriver')
-        if not chromedriver_path:
-            print("❌ لم يتم العثور على chromedriver. تأكد من تثبيته.")
-            return None
-    
-    try:
-        service = Service(executable_path=chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        print(f"❌ فشل إعداد Selenium: {e}")
-        return None
+app = None
+upload_index = None
+video_uploader = None
 
 # ===== دوال مساعدة =====
 
@@ -118,7 +94,9 @@ async def setup_telegram():
             api_id=TELEGRAM_API_ID,
             api_hash=TELEGRAM_API_HASH,
             session_string=STRING_SESSION.strip(),
-            in_memory=True
+            in_memory=True,
+            # كل FloodWait يصل إلى telegram_limiter بدلاً من أن يبتلعه pyrogram بانتظار صامت
+            sleep_threshold=0
         )
         await app.start()
         me = await app.get_me()
@@ -129,11 +107,17 @@ async def setup_telegram():
         return False
 
 def try_extract_video_from_embed(driver, embed_url):
-    """محاولة استخراج رابط فيديو مباشر من صفحة embed"""
+    """
+    محاولة استخراج رابط فيديو مباشر من صفحة embed.
+    يعيد (video_url, referer, headers) من أول طلب فيديو في الشبكة (مع هيدرز طلبه)، أو من عناصر الصفحة، أو None.
+    """
     try:
         print(f"🔄 فتح embed: {embed_url}")
-        driver.get(embed_url)
-        time.sleep(5)
+        media = capture_media_request(driver, embed_url)
+        if media:
+            return media['url'], media['referer'], media['headers']
+        if not NETWORK_CAPTURE:
+            wait_for(driver, video_has_src(), "video_src")
         
         # البحث عن عنصر <video>
         try:
@@ -141,7 +125,7 @@ def try_extract_video_from_embed(driver, embed_url):
             src = video.get_attribute("src")
             if src and src.startswith("http"):
                 print(f"✅ تم العثور على فيديو في <video>: {src[:100]}...")
-                return src
+                return src, embed_url, {}
         except:
             pass
         
@@ -152,7 +136,7 @@ def try_extract_video_from_embed(driver, embed_url):
                 src = src_elem.get_attribute("src")
                 if src and src.startswith("http"):
                     print(f"✅ تم العثور على فيديو في <source>: {src[:100]}...")
-                    return src
+                    return src, embed_url, {}
         except:
             pass
         
@@ -161,12 +145,12 @@ def try_extract_video_from_embed(driver, embed_url):
         mp4_matches = re.findall(r'(https?://[^"\']+\.mp4[^"\']*)', page_source)
         if mp4_matches:
             print(f"✅ تم العثور على رابط mp4: {mp4_matches[0][:100]}...")
-            return mp4_matches[0]
+            return mp4_matches[0], embed_url, {}
         
         m3u8_matches = re.findall(r'(https?://[^"\']+\.m3u8[^"\']*)', page_source)
         if m3u8_matches:
             print(f"✅ تم العثور على رابط m3u8: {m3u8_matches[0][:100]}...")
-            return m3u8_matches[0]
+            return m3u8_matches[0], embed_url, {}
         
         print("⚠️ لم يتم العثور على رابط مباشر.")
         return None
@@ -174,25 +158,39 @@ def try_extract_video_from_embed(driver, embed_url):
         print(f"❌ خطأ في استخراج الفيديو من embed: {e}")
         return None
 
-def download_with_ytdlp(url, output_path, referer=None):
-    """محاولة تنزيل فيديو باستخدام yt-dlp مع impersonate"""
+def download_with_ytdlp(url, output_path, referer=None, headers=None):
+    """محاولة تنزيل فيديو باستخدام yt-dlp مع impersonate (وبث HLS عبر المحرك الداخلي أولاً)"""
     try:
+        if is_hls_url(url):
+            hls_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                           **(headers or {})}
+            if referer:
+                hls_headers['Referer'] = referer
+            if download_hls(url, output_path, hls_headers):
+                return True
+            discard_hls_segments(output_path)
+
         ydl_opts = {
-            'format': 'best[height<=720]/best',
+            **ytdlp_format_options(),
             'outtmpl': output_path,
             'quiet': False,
             'retries': 5,
             'fragment_retries': 5,
+            'concurrent_fragment_downloads': HLS_WORKERS,
             'socket_timeout': 30,
             'extractor_args': {'generic': 'impersonate'},
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
             }
         }
         if referer:
             ydl_opts['http_headers']['Referer'] = referer
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        # تشغيل yt-dlp في مجمع العمليات حتى لا يزاحم حلقة الأحداث على الـ GIL
+        success, error = ytdlp_download_blocking(url, ydl_opts)
+        if not success:
+            print(f"❌ yt-dlp error: {error}")
+            return False
         return os.path.exists(output_path)
     except Exception as e:
         print(f"❌ yt-dlp error: {e}")
@@ -203,7 +201,7 @@ def get_embed_urls_from_larozaa(driver, video_page_url):
     try:
         print(f"🖥️ فتح صفحة الفيديو: {video_page_url}")
         driver.get(video_page_url)
-        time.sleep(5)
+        wait_for(driver, element_present("ul.WatchList li[data-embed-url]"), "server_list")
         
         servers = driver.find_elements(By.CSS_SELECTOR, "ul.WatchList li")
         if not servers:
@@ -221,81 +219,67 @@ def get_embed_urls_from_larozaa(driver, video_page_url):
         print(f"❌ خطأ في استخراج السيرفرات: {e}")
         return []
 
-def download_video_from_servers(embed_urls, output_path, driver):
-    """تجربة السيرفرات حتى نجاح التنزيل"""
-    for idx, embed_url in enumerate(embed_urls):
-        print(f"\n🔄 تجربة السيرفر {idx+1}: {embed_url}")
-        
-        # محاولة استخراج رابط مباشر
-        direct_url = try_extract_video_from_embed(driver, embed_url)
-        if direct_url:
+def probe_embed(embed_url, cancel):
+    """فحص سيرفر واحد ضمن السباق: استخراج رابط مباشر بمتصفح من المجمع"""
+    if cancel.is_set():
+        return None
+    with driver_pool.lease() as driver:
+        if not driver or cancel.is_set():
+            return None
+        return try_extract_video_from_embed(driver, embed_url)
+
+def download_video_from_servers(embed_urls, output_path):
+    """
+    فحص جميع السيرفرات بالتوازي والتنزيل من أول سيرفر يعطي رابطاً مباشراً.
+    يعيد (url, referer, headers) الذي نجح التنزيل منه، أو None.
+    """
+    # ترتيب السيرفرات حسب صحتها في التشغيلات السابقة وتخطي المتعطلة حالياً
+    remaining = host_health.order(embed_urls)
+    while remaining:
+        results = race_collect(remaining, probe_embed, grace=MIRROR_GRACE_SECONDS)
+        if not results:
+            break
+        # كل السيرفرات تُضغط إلى نفس الدقة، لذا نبدأ بالأصغر حجماً
+        for embed_url, (direct_url, referer, headers) in rank_mirrors_by_size(
+                results, lambda media: (media[0], {**media[2], 'Referer': media[1]})):
+            if cancelled():
+                print("⏹️ أُلغيت المرحلة، إيقاف تجربة السيرفرات")
+                return None
+            remaining.remove(embed_url)
+            print(f"🏁 السيرفر المختار: {embed_url}")
             print(f"✅ تم استخراج رابط مباشر، محاولة التنزيل...")
-            if download_with_ytdlp(direct_url, output_path, referer=embed_url):
-                return True
-            else:
-                print(f"⚠️ فشل التنزيل من الرابط المباشر.")
-        else:
-            print(f"⚠️ لم يتم العثور على رابط مباشر، محاولة تنزيل embed_url مباشرة...")
-            if download_with_ytdlp(embed_url, output_path, referer=embed_url):
-                return True
-            else:
-                print(f"⚠️ فشل تنزيل embed_url مباشرة.")
-        
-        # تأخير قبل المحاولة التالية
-        time.sleep(3)
-    return False
-
-def compress_to_240p(input_path, output_path):
-    """ضغط الفيديو إلى 240p"""
-    if not os.path.exists(input_path):
-        return False
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vf', 'scale=-2:240',
-        '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast',
-        '-c:a', 'aac', '-b:a', '64k',
-        '-y', output_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=1800)
-        return os.path.exists(output_path)
-    except:
-        return False
-
-def create_thumbnail(video_path, thumb_path):
-    cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', '00:00:05', '-vframes', '1', '-s', '320x180',
-        '-f', 'image2', '-y', thumb_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=30)
-        return os.path.exists(thumb_path)
-    except:
-        return False
-
-async def upload_video(file_path, caption, thumb_path=None):
+            started = time.time()
+            ok = download_with_ytdlp(direct_url, output_path, referer=referer, headers=headers)
+            host_health.record_download_file(embed_url, ok, output_path, started)
+            if ok:
+                return direct_url, referer, headers
+            print(f"⚠️ فشل التنزيل من الرابط المباشر، نجرب السيرفر التالي.")
+
+    # السيرفرات التي لم تعطِ رابطاً مباشراً: محاولة تنزيل embed_url مباشرة
+    for embed_url in remaining:
+        if cancelled():
+            print("⏹️ أُلغيت المرحلة، إيقاف تجربة السيرفرات")
+            return None
+        print(f"⚠️ محاولة تنزيل embed_url مباشرة: {embed_url}")
+        started = time.time()
+        ok = download_with_ytdlp(embed_url, output_path, referer=embed_url)
+        host_health.record_download_file(embed_url, ok, output_path, started)
+        if ok:
+            return embed_url, embed_url, {}
+        print(f"⚠️ فشل تنزيل embed_url مباشرة.")
+    return None
+
+async def upload_video(file_path, caption, thumb_path=None, media=None):
     if not app or not os.path.exists(file_path):
         return False
     try:
-        width, height = 426, 240
-        duration = 0
-        try:
-            probe = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                                    '-show_entries', 'stream=width,height,duration',
-                                    '-of', 'csv=p=0', file_path],
-                                   capture_output=True, text=True)
-            if probe.returncode == 0:
-                parts = probe.stdout.strip().split(',')
-                if len(parts) >= 2:
-                    width, height = int(parts[0]), int(parts[1])
-                if len(parts) >= 3 and parts[2]:
-                    duration = int(float(parts[2]))
-        except:
-            pass
+        # معلومات الملف تأتي من مرحلة الضغط؛ ffprobe فقط إذا لم تصل
+        media = media or await probe_media_async(file_path)
+        width, height = (media['width'], media['height']) if media and media['height'] else (426, 240)
+        duration = int(media['duration']) if media else 0
 
-        await app.send_video(
-            chat_id=TELEGRAM_CHANNEL,
+        # الرفع عبر OrderedUploader: عدة ملفات بالتوازي والنشر في القناة بالترتيب
+        message = await video_uploader.send_video(
             video=file_path,
             caption=caption,
             supports_streaming=True,
@@ -304,70 +288,97 @@ async def upload_video(file_path, caption, thumb_path=None):
             duration=duration,
             thumb=thumb_path if thumb_path and os.path.exists(thumb_path) else None
         )
-        return True
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return await upload_video(file_path, caption, thumb_path)
+        # رقم الرسالة يُحفظ في سجل الحلقات
+        return message.id
     except Exception as e:
         print(f"❌ Upload error: {e}")
         return False
 
-async def process_video(episode_num, video_url, series_name_arabic, season_num, download_dir):
-    """معالجة حلقة واحدة"""
-    print(f"\n🎬 Processing episode {episode_num}")
-    print(f"🔗 Video page URL: {video_url}")
-    
-    temp_file = os.path.join(download_dir, f"temp_{episode_num:02d}.mp4")
-    final_file = os.path.join(download_dir, f"final_{episode_num:02d}.mp4")
-    thumb_file = os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg")
-
-    # إعداد Selenium
-    driver = setup_selenium()
-    if not driver:
-        return False, "فشل إعداد Selenium"
-    
-    # استخراج قائمة السيرفرات
-    embed_urls = get_embed_urls_from_larozaa(driver, video_url)
+def build_episode_job(episode_num, video_url, series_name_arabic, season_num, download_dir):
+    """تجهيز قاموس المهمة لحلقة واحدة"""
+    return {
+        'num': episode_num,
+        'page_url': video_url,
+        'caption': f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}",
+        'temp_file': os.path.join(download_dir, f"temp_{episode_num:02d}.mp4"),
+        'final_file': os.path.join(download_dir, f"final_{episode_num:02d}.mp4"),
+        'thumb_file': os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg"),
+    }
+
+def extract_stage(job):
+    """المرحلة 1: استخراج قائمة السيرفرات من صفحة الحلقة"""
+    print(f"\n🎬 Processing episode {job['num']}")
+    print(f"🔗 Video page URL: {job['page_url']}")
+
+    # رابط محلول سابقاً وما زال صالحاً: لا حاجة لفتح صفحة السيرفرات
+    if use_cached_url(job, job['page_url']):
+        return True, "تم الاستخراج (من الذاكرة)"
+
+    # فاصل التأدب فقط إذا زِير نفس الموقع قبل قليل
+    host_scheduler.wait(job['page_url'])
+
+    with driver_pool.lease() as driver:
+        if not driver:
+            return False, "فشل إعداد Selenium"
+        embed_urls = get_embed_urls_from_larozaa(driver, job['page_url'])
     if not embed_urls:
-        driver.quit()
         return False, "لم يتم العثور على سيرفرات"
-    
-    # محاولة التنزيل من السيرفرات
-    download_success = download_video_from_servers(embed_urls, temp_file, driver)
-    driver.quit()
-    
-    if not download_success:
+    job['embed_urls'] = embed_urls
+    return True, "تم الاستخراج"
+
+def download_stage(job):
+    """المرحلة 2: محاولة التنزيل من الرابط المحفوظ أو من السيرفرات"""
+    if job.pop('from_cache', False):
+        if download_with_ytdlp(job['video_url'], job['temp_file'], referer=job['referer'], headers=job['headers']):
+            return True, "تم التنزيل"
+        url_cache.evict(job['cache_key'])
+        # الرابط المحفوظ لم يعد صالحاً: استخراج السيرفرات من صفحة الحلقة بدلاً من إفشالها
+        print("🔄 الرابط المحفوظ لم يعد صالحاً، إعادة استخراج السيرفرات...")
+        ok, msg = extract_stage(job)
+        if not ok:
+            return ok, msg
+
+    media = download_video_from_servers(job['embed_urls'], job['temp_file'])
+    if not media:
         return False, "فشل التنزيل من جميع السيرفرات"
-    
-    # ضغط الفيديو
-    if not compress_to_240p(temp_file, final_file):
-        shutil.copy2(temp_file, final_file)
-    
-    # إنشاء صورة مصغرة
-    create_thumbnail(final_file, thumb_file)
-    
-    # رفع إلى تليغرام
-    caption = f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}"
-    success = await upload_video(final_file, caption, thumb_file if os.path.exists(thumb_file) else None)
-    
-    # تنظيف
-    for f in [temp_file, final_file, thumb_file]:
-        try:
-            if os.path.exists(f):
-                os.remove(f)
-        except:
-            pass
-    
+    url_cache.put(job['page_url'], *media)
+    return True, "تم التنزيل"
+
+async def transcode_stage(job):
+    """المرحلة 3: ضغط الفيديو وإنشاء صورة مصغرة"""
+    job['media'] = await compress_to_240p(job['temp_file'], job['final_file'])
+    if not job['media']:
+        await run_io(shutil.copy2, job['temp_file'], job['final_file'])
+    await create_thumbnail(job['final_file'], job['thumb_file'], job['media'])
+    # المصدر لم يعد لازماً، ولا داعي لحفظه في ملفات الاستكمال
+    if os.path.exists(job['temp_file']):
+        os.remove(job['temp_file'])
+    return True, "تم الضغط"
+
+async def upload_stage(job):
+    """المرحلة 4: رفع إلى تليغرام"""
+    thumb_file = job['thumb_file']
+    job['message_id'] = await upload_video(job['final_file'], job['caption'],
+                                           thumb_file if os.path.exists(thumb_file) else None, job.get('media'))
+    success = bool(job['message_id'])
+    if success:
+        upload_index.add(job['caption'], job['message_id'])
     return success, "تم بنجاح" if success else "فشل الرفع"
 
-def check_time_limit(start_time, max_seconds):
-    """التحقق من الوقت المنقضي، وإذا تجاوز الحد يخرج السكريبت"""
-    elapsed = time.time() - start_time
-    if elapsed >= max_seconds:
-        print(f"\n⏰ تم تجاوز الحد الزمني المسموح به ({MAX_RUNTIME_HOURS} ساعات).")
-        print(f"⏰ الوقت المنقضي: {elapsed/60:.1f} دقيقة.")
-        return True
-    return False
+def cleanup_job(job):
+    """تنظيف ملفات الحلقة وطباعة النتيجة بعد خروجها من خط المعالجة"""
+    # ملفات الحلقة الفاشلة تبقى في مجلد العمل ليكمل منها التشغيل القادم
+    if job['success']:
+        for f in [job['temp_file'], job['final_file'], job['thumb_file']]:
+            try:
+                if os.path.exists(f):
+                    os.remove(f)
+            except:
+                pass
+    if job['success']:
+        print(f"✅ الحلقة {job['num']} اكتملت بنجاح")
+    else:
+        print(f"❌ الحلقة {job['num']} فشلت: {job['message']}")
 
 async def main():
     print("="*50)
@@ -442,48 +453,40 @@ async def main():
     print(f"📺 المسلسل: {series_name_arabic}")
     print(f"🎬 عدد الحلقات المطلوب معالجتها: {len(episodes)}")
 
-    download_dir = f"downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    os.makedirs(download_dir, exist_ok=True)
-
-    successful = 0
-    failed = []
-
-    for idx, ep in enumerate(episodes):
-        # التحقق من الوقت قبل بدء الحلقة
-        if check_time_limit(start_time, MAX_RUNTIME_SECONDS):
-            print("⚠️ تم إيقاف السكريبت بسبب تجاوز الحد الزمني.")
-            break
-
-        ep_num = ep.get("num")
-        ep_url = ep.get("url")
-        if not ep_num or not ep_url:
-            print(f"⚠️ تخطي حلقة غير مكتملة البيانات: {ep}")
-            continue
-
-        # طباعة الوقت المتبقي
-        elapsed = time.time() - start_time
-        remaining = MAX_RUNTIME_SECONDS - elapsed
-        print(f"\n⏳ الوقت المنقضي: {elapsed/60:.1f} دقيقة | الوقت المتبقي: {remaining/60:.1f} دقيقة")
-
-        print(f"\n--- معالجة الحلقة {ep_num} ---")
-        success, msg = await process_video(ep_num, ep_url, series_name_arabic, season_num, download_dir)
-        if success:
-            successful += 1
-            print(f"✅ الحلقة {ep_num} اكتملت بنجاح")
-        else:
-            failed.append(ep_num)
-            print(f"❌ الحلقة {ep_num} فشلت: {msg}")
-
-        # التحقق من الوقت بعد الحلقة
-        if check_time_limit(start_time, MAX_RUNTIME_SECONDS):
-            print("⚠️ تم إيقاف السكريبت بسبب تجاوز الحد الزمني.")
-            break
-
-        # انتظار عشوائي بين الحلقات
-        if idx < len(episodes) - 1:
-            wait_time = random.randint(30, 60)
-            print(f"⏳ انتظار {wait_time} ثانية قبل الحلقة التالية...")
-            await asyncio.sleep(wait_time)
+    # فهرس الحلقات المنشورة: حلقة موجودة في القناة لا تُعالج من جديد
+    global upload_index, video_uploader
+    upload_index = UploadIndex(TELEGRAM_CHANNEL)
+    video_uploader = OrderedUploader(app, TELEGRAM_CHANNEL)
+    await upload_index.build(app, series_name_arabic)
+
+    # سجل الحلقات ومجلد عمل ثابت: إعادة التشغيل تكمل من آخر مرحلة مكتملة
+    manifest = Manifest("mai")
+    download_dir = manifest.work_dir(f"{series_name_arabic} {season_num}")
+
+    def episode_jobs():
+        """بناء مهام الحلقات؛ قبولها في خط المعالجة يحدده TimeBudget حسب الوقت المتبقي"""
+        for ep in episodes:
+            ep_num = ep.get("num")
+            ep_url = ep.get("url")
+            if not ep_num or not ep_url:
+                print(f"⚠️ تخطي حلقة غير مكتملة البيانات: {ep}")
+                continue
+
+            print(f"\n--- معالجة الحلقة {ep_num} ---")
+            yield build_episode_job(ep_num, ep_url, series_name_arabic, season_num, download_dir)
+
+    # خط معالجة: الحلقة N+1 تُنزَّل بينما N تُضغط و N-1 تُرفع
+    pipeline = Pipeline([
+        Stage("extract", extract_stage, checkpoint=False),
+        Stage("download", download_stage),
+        Stage("transcode", transcode_stage),
+        Stage("upload", upload_stage, workers=UPLOAD_CONCURRENCY),
+    ], queue_size=1, on_done=cleanup_job, manifest=manifest,
+       budget=TimeBudget("mai", MAX_RUNTIME_SECONDS, start_time=start_time))
+    results = await pipeline.run(upload_index.pending(episode_jobs()))
+
+    successful = sum(1 for job in results if job['success'])
+    failed = sorted(job['num'] for job in results if not job['success'])
 
     print(f"\n✅ الحلقات الناجحة: {successful}/{len(episodes)}")
     if failed:
@@ -495,6 +498,12 @@ async def main():
     except:
         pass
 
+    print_wait_summary()
+    telegram_limiter.print_summary()
+    host_scheduler.print_summary()
+    host_health.print_summary()
+    driver_pool.close_all()
+    shutdown_executors()
     await app.stop()
     print("🔌 تم قطع الاتصال بتليغرام")
     print(f"⏰ إجمالي وقت التشغيل: {(time.time() - start_time)/60:.1f} دقيقة")
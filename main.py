@@ -5,13 +5,11 @@ Telegram Video Downloader & Uploader - معالج متكامل باستخدام
 
 import os
 import sys
-import time
 import json
 import subprocess
 import shutil
 import asyncio
-import random
-from datetime import datetime
+import re
 
 # ===== التهيئة والتحقق =====
 TELEGRAM_API_ID = os.environ.get("API_ID", "")
@@ -48,7 +46,8 @@ def install_requirements():
         "yt-dlp>=2024.4.9",
         "curl_cffi>=0.5.10",
         "selenium>=4.15.0",
-        "beautifulsoup4>=4.12.0"
+        "beautifulsoup4>=4.12.0",
+        "requests>=2.28.0"
     ]
     for req in reqs:
         try:
@@ -57,58 +56,29 @@ def install_requirements():
         except:
             print(f"  ⚠️ Failed to install {req}")
 
-install_requirements()
+# خادم forkserver لعمليات yt-dlp يستورد هذا الملف باسم __mp_main__، والحزم مثبتة مسبقاً
+if __name__ == "__main__":
+    install_requirements()
 
 # استيراد المكتبات بعد التثبيت
 from pyrogram import Client
-from pyrogram.errors import FloodWait
-import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from bs4 import BeautifulSoup
+from curl_cffi import requests as curl_requests
+
+from browser import (driver_pool, capture_media_request, wait_for, redirect_settled, iframe_with_src,
+                     video_has_src, print_wait_summary, NETWORK_CAPTURE)
+from resolver import url_cache, use_cached_url
+from downloader import download_hls, discard_hls_segments, is_hls_url, HLS_WORKERS, ytdlp_format_options
+from transcode import compress_to_240p, create_thumbnail, probe_media_async, should_stream_transcode, stream_transcode
+from pipeline import Pipeline, Stage, TimeBudget, run_io, ytdlp_download_blocking, shutdown_executors
+from state import Manifest
+from uploader import UploadIndex, OrderedUploader, UPLOAD_CONCURRENCY
+from ratelimit import telegram_limiter, host_scheduler
 
 app = None
-
-# ===== إعداد Selenium =====
-def setup_selenium():
-    """إعداد متصفح Chrome في وضع headless مع خيارات لمنع اكتشاف adblock"""
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    
-    # استخدام chromedriver المثبت في النظام (عادة /usr/bin/chromedriver)
-    chromedriver_path = '/usr/bin/chromedriver'
-    if not os.path.exists(chromedriver_path):
-        # إذا لم يكن موجوداً، نجرب البحث عنه
-        import shutil
-        chromedriver_path = shutil.which('chromedriver')
-        if not chromedriver_path:
-            print("❌ لم يتم العثور على chromedriver. تأكد من تثبيته.")
-            return None
-    
-    try:
-        service = Service(executable_path=chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        # تنفيذ كود لإخفاء وجود selenium
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        print(f"❌ فشل إعداد Selenium: {e}")
-        return None
+upload_index = None
+video_uploader = None
 
 # ===== دوال مساعدة =====
 
@@ -121,7 +91,9 @@ async def setup_telegram():
             api_id=TELEGRAM_API_ID,
             api_hash=TELEGRAM_API_HASH,
             session_string=STRING_SESSION.strip(),
-            in_memory=True
+            in_memory=True,
+            # كل FloodWait يصل إلى telegram_limiter بدلاً من أن يبتلعه pyrogram بانتظار صامت
+            sleep_threshold=0
         )
         await app.start()
         me = await app.get_me()
@@ -131,29 +103,19 @@ async def setup_telegram():
         print(f"❌ Telegram connection failed: {e}")
         return False
 
-def get_episode_page_with_selenium(base_url):
+def get_episode_page_with_selenium(driver, base_url):
     """
-    استخدام Selenium للحصول على:
+    استخدام Selenium (متصفح من المجمع) للحصول على:
     1. الرابط النهائي بعد إعادة التوجيه (مع الرمز)
     2. محتوى HTML الكامل لصفحة المشاهدة بعد تحميل JavaScript
     """
-    driver = setup_selenium()
-    if not driver:
-        return None, None, None
-    
     try:
         # الخطوة 1: الذهاب إلى الرابط الأساسي وانتظار إعادة التوجيه
         print("🖥️ تشغيل Selenium للحصول على الرابط النهائي...")
         driver.get(base_url)
         
-        # انتظار تغيير الرابط أو مرور 10 ثواني
-        start_time = time.time()
-        current_url = driver.current_url
-        while current_url == base_url and time.time() - start_time < 10:
-            time.sleep(1)
-            current_url = driver.current_url
-        
-        final_url = driver.current_url
+        # انتظار استقرار إعادة التوجيه (حتى 10 ثواني)
+        final_url = wait_for(driver, redirect_settled(base_url), "redirect", timeout=10) or driver.current_url
         print(f"🌐 الرابط النهائي: {final_url}")
         
         # الخطوة 2: إضافة ?do=watch والذهاب إلى صفحة المشاهدة
@@ -163,24 +125,18 @@ def get_episode_page_with_selenium(base_url):
         print(f"📺 جاري تحميل صفحة المشاهدة: {watch_url}")
         driver.get(watch_url)
         
-        # انتظار تحميل iframe (لمدة أقصاها 15 ثانية)
-        try:
-            WebDriverWait(driver, 15).until(
-                EC.presence_of_element_located((By.TAG_NAME, "iframe"))
-            )
-            time.sleep(2)  # انتظار إضافي للتأكد
-        except:
-            print("⚠️ لم يتم العثور على iframe خلال 15 ثانية، قد تكون الصفحة مختلفة.")
+        # انتظار ظهور iframe له src (بمهلة الموقع)
+        if not wait_for(driver, iframe_with_src(), "iframe"):
+            print("⚠️ لم يتم العثور على iframe خلال المهلة، قد تكون الصفحة مختلفة.")
             # نكمل على أي حال
         
         # الحصول على HTML الكامل بعد تحميل JavaScript
         page_html = driver.page_source
-        return driver, watch_url, page_html
+        return watch_url, page_html
         
     except Exception as e:
         print(f"❌ خطأ في Selenium: {e}")
-        driver.quit()
-        return None, None, None
+        return None, None
 
 def extract_iframe_url_from_html(html):
     """استخراج رابط iframe من HTML"""
@@ -195,23 +151,87 @@ def extract_iframe_url_from_html(html):
         return iframe_url
     return None
 
+# ===== المسار السريع عبر HTTP (بدون متصفح) =====
+def find_media_url_in_html(html):
+    """البحث عن رابط .m3u8 أو .mp4 في HTML (بما في ذلك الروابط المهربة داخل JSON)"""
+    html = html.replace('\\/', '/')
+    for pattern in (r'(https?://[^"\'\s]+\.m3u8[^"\'\s]*)', r'(https?://[^"\'\s]+\.mp4[^"\'\s]*)'):
+        match = re.search(pattern, html)
+        if match:
+            return match.group(1)
+    return None
+
+def find_js_redirect(html):
+    """استخراج رابط إعادة التوجيه من meta refresh أو location.href في الصفحة"""
+    patterns = [
+        r'http-equiv=["\']refresh["\'][^>]*url=([^"\'>]+)',
+        r'(?:window\.)?location(?:\.href)?\s*=\s*["\']([^"\']+)["\']',
+        r'location\.replace\(\s*["\']([^"\']+)["\']',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, html, re.IGNORECASE)
+        if match:
+            return match.group(1).strip()
+    return None
+
+def resolve_episode_over_http(base_url):
+    """
+    المسار السريع: متابعة إعادة التوجيه، تحميل ?do=watch، استخراج iframe، ثم البحث عن رابط
+    الفيديو داخل صفحة iframe، كل ذلك عبر curl_cffi مع انتحال بصمة Chrome.
+    يعيد (watch_url, iframe_url, video_url)، وأي قيمة None تعني أن الخطوة تحتاج Selenium.
+    """
+    try:
+        with curl_requests.Session(impersonate="chrome") as session:
+            # الخطوة 1: إعادة التوجيه (HTTP 3xx أو عبر JavaScript بسيط)
+            resp = session.get(base_url, allow_redirects=True, timeout=15)
+            if resp.status_code != 200:
+                print(f"⚠️ HTTP {resp.status_code} عند فتح الرابط الأساسي")
+                return None, None, None
+            final_url = str(resp.url)
+            if final_url.rstrip('/') == base_url.rstrip('/'):
+                redirect = find_js_redirect(resp.text)
+                if not redirect:
+                    return None, None, None
+                if redirect.startswith('/'):
+                    redirect = 'https://o.3seq.cam' + redirect
+                final_url = redirect
+            print(f"🌐 الرابط النهائي (HTTP): {final_url}")
+
+            # الخطوة 2: صفحة المشاهدة
+            if not final_url.endswith('/'):
+                final_url += '/'
+            watch_url = final_url + '?do=watch'
+            resp = session.get(watch_url, headers={'Referer': final_url}, timeout=15)
+            if resp.status_code != 200:
+                return None, None, None
+            iframe_url = extract_iframe_url_from_html(resp.text)
+            if not iframe_url:
+                return watch_url, None, None
+
+            # الخطوة 3: صفحة iframe نفسها، قد يكون رابط m3u8 موجوداً في HTML مباشرة
+            resp = session.get(iframe_url, headers={'Referer': watch_url}, timeout=15)
+            video_url = find_media_url_in_html(resp.text) if resp.status_code == 200 else None
+            return watch_url, iframe_url, video_url
+    except Exception as e:
+        print(f"⚠️ فشل المسار السريع عبر HTTP: {e}")
+        return None, None, None
+
 def extract_video_from_iframe_with_selenium(driver, iframe_url):
     """
     استخدام نفس جلسة المتصفح لفتح iframe واستخراج رابط الفيديو الحقيقي (.m3u8)
+    يعيد (video_url, referer, headers): أولاً من طلبات الشبكة التي يرسلها المشغّل (مع هيدرز طلبه)، ثم من عناصر الصفحة
     """
     try:
         print(f"🔄 فتح iframe: {iframe_url}")
-        driver.get(iframe_url)
-        
-        # انتظار تحميل عنصر الفيديو (لمدة أقصاها 20 ثانية)
-        try:
-            WebDriverWait(driver, 20).until(
-                EC.presence_of_element_located((By.TAG_NAME, "video"))
-            )
-            time.sleep(3)
-        except:
-            print("⚠️ لم يتم العثور على عنصر video خلال 20 ثانية.")
-            # قد يكون هناك مصدر بديل مثل source
+        media = capture_media_request(driver, iframe_url)
+        if media:
+            return media['url'], media['referer'], media['headers']
+
+        if not NETWORK_CAPTURE:
+            # انتظار حصول عنصر الفيديو على رابط
+            if not wait_for(driver, video_has_src(), "video_src", timeout=20):
+                print("⚠️ لم يحصل عنصر video على رابط خلال المهلة.")
+                # قد يكون هناك مصدر بديل مثل source
         
         # البحث عن مصدر الفيديو
         video_src = None
@@ -220,9 +240,9 @@ def extract_video_from_iframe_with_selenium(driver, iframe_url):
         video_elements = driver.find_elements(By.TAG_NAME, "video")
         if video_elements:
             video_src = video_elements[0].get_attribute("src")
-            if video_src:
+            if video_src and video_src.startswith("http"):
                 print(f"✅ تم العثور على مصدر الفيديو: {video_src[:100]}...")
-                return video_src
+                return video_src, iframe_url, {}
         
         # الطريقة الثانية: من عناصر source داخل video
         source_elements = driver.find_elements(By.TAG_NAME, "source")
@@ -231,98 +251,70 @@ def extract_video_from_iframe_with_selenium(driver, iframe_url):
             if src:
                 video_src = src
                 print(f"✅ تم العثور على مصدر بديل: {video_src[:100]}...")
-                return video_src
+                return video_src, iframe_url, {}
         
         # الطريقة الثالثة: البحث في الصفحة عن أي رابط .m3u8
-        page_source = driver.page_source
-        import re
-        m3u8_matches = re.findall(r'(https?://[^"\']+\.m3u8[^"\']*)', page_source)
-        if m3u8_matches:
-            video_src = m3u8_matches[0]
+        video_src = find_media_url_in_html(driver.page_source)
+        if video_src:
             print(f"✅ تم العثور على رابط m3u8: {video_src[:100]}...")
-            return video_src
+            return video_src, iframe_url, {}
         
         print("⚠️ لم يتم العثور على مصدر الفيديو.")
-        return None
+        return None, None, {}
         
     except Exception as e:
         print(f"❌ خطأ في استخراج الفيديو من iframe: {e}")
-        return None
+        return None, None, {}
 
-def download_video(video_url, output_path, referer):
-    """تنزيل الفيديو باستخدام yt-dlp مع impersonation وإضافة referer"""
+async def download_video(video_url, output_path, referer, headers=None):
+    """تنزيل الفيديو (HLS عبر المحرك الداخلي) أو باستخدام yt-dlp (في عملية منفصلة) مع impersonation وإضافة referer"""
     try:
+        # بث HLS: المحرك الداخلي بمقاطع متوازية أولاً، ثم yt-dlp إذا كانت القائمة غير مدعومة
+        if is_hls_url(video_url):
+            hls_headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
+                'Referer': referer,
+            }
+            if await run_io(download_hls, video_url, output_path, hls_headers):
+                return True
+            discard_hls_segments(output_path)
+
         ydl_opts = {
-            'format': 'best[height<=720]/best',
+            **ytdlp_format_options(),
             'outtmpl': output_path,
             'quiet': False,
             'retries': 5,
             'fragment_retries': 5,
+            'concurrent_fragment_downloads': HLS_WORKERS,
             'socket_timeout': 30,
             'extractor_args': {'generic': 'impersonate'},
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
                 'Referer': referer,
             }
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        success, error = await run_io(ytdlp_download_blocking, video_url, ydl_opts)
+        if not success:
+            print(f"❌ Download error: {error}")
+            return False
         return os.path.exists(output_path)
     except Exception as e:
         print(f"❌ Download error: {e}")
         return False
 
-def compress_to_240p(input_path, output_path):
-    """ضغط الفيديو إلى 240p"""
-    if not os.path.exists(input_path):
-        return False
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vf', 'scale=-2:240',
-        '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast',
-        '-c:a', 'aac', '-b:a', '64k',
-        '-y', output_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=1800)
-        return os.path.exists(output_path)
-    except:
-        return False
-
-def create_thumbnail(video_path, thumb_path):
-    cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', '00:00:05', '-vframes', '1', '-s', '320x180',
-        '-f', 'image2', '-y', thumb_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=30)
-        return os.path.exists(thumb_path)
-    except:
-        return False
-
-async def upload_video(file_path, caption, thumb_path=None):
+async def upload_video(file_path, caption, thumb_path=None, media=None):
     if not app or not os.path.exists(file_path):
         return False
     try:
-        width, height = 426, 240
-        duration = 0
-        try:
-            probe = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                                    '-show_entries', 'stream=width,height,duration',
-                                    '-of', 'csv=p=0', file_path],
-                                   capture_output=True, text=True)
-            if probe.returncode == 0:
-                parts = probe.stdout.strip().split(',')
-                if len(parts) >= 2:
-                    width, height = int(parts[0]), int(parts[1])
-                if len(parts) >= 3 and parts[2]:
-                    duration = int(float(parts[2]))
-        except:
-            pass
+        # معلومات الملف تأتي من مرحلة الضغط؛ ffprobe فقط إذا لم تصل
+        media = media or await probe_media_async(file_path)
+        width, height = (media['width'], media['height']) if media and media['height'] else (426, 240)
+        duration = int(media['duration']) if media else 0
 
-        await app.send_video(
-            chat_id=TELEGRAM_CHANNEL,
+        # الرفع عبر OrderedUploader: عدة ملفات بالتوازي والنشر في القناة بالترتيب
+        message = await video_uploader.send_video(
             video=file_path,
             caption=caption,
             supports_streaming=True,
@@ -331,81 +323,140 @@ async def upload_video(file_path, caption, thumb_path=None):
             duration=duration,
             thumb=thumb_path if thumb_path and os.path.exists(thumb_path) else None
         )
-        return True
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return await upload_video(file_path, caption, thumb_path)
+        # رقم الرسالة يُحفظ في سجل الحلقات
+        return message.id
     except Exception as e:
         print(f"❌ Upload error: {e}")
         return False
 
-async def process_episode(episode_num, series_name, series_name_arabic, season_num, download_dir):
+def build_episode_job(episode_num, series_name, series_name_arabic, season_num, download_dir):
+    """تجهيز قاموس المهمة لحلقة واحدة"""
+    return {
+        'num': episode_num,
+        'base_url': f"https://o.3seq.cam/video/modablaj-{series_name}-episode-s{season_num:02d}e{episode_num:02d}",
+        'caption': f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}",
+        'temp_file': os.path.join(download_dir, f"temp_{episode_num:02d}.mp4"),
+        'final_file': os.path.join(download_dir, f"final_{episode_num:02d}.mp4"),
+        'thumb_file': os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg"),
+    }
+
+def extract_stage(job):
     """
-    معالجة حلقة واحدة باستخدام Selenium بالكامل
+    المرحلة 1: الحصول على رابط الفيديو من iframe، عبر HTTP أولاً ثم Selenium عند الحاجة فقط
     """
-    base_url = f"https://o.3seq.cam/video/modablaj-{series_name}-episode-s{season_num:02d}e{episode_num:02d}"
-    
-    print(f"\n🎬 Episode {episode_num:02d}")
-    print(f"🔗 Base URL: {base_url}")
-    
-    temp_file = os.path.join(download_dir, f"temp_{episode_num:02d}.mp4")
-    final_file = os.path.join(download_dir, f"final_{episode_num:02d}.mp4")
-    thumb_file = os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg")
-
-    # 1. استخدام Selenium للحصول على الرابط النهائي وHTML مع الاحتفاظ بالـ driver
-    driver, watch_url, page_html = get_episode_page_with_selenium(base_url)
-    if not driver:
-        return False, "فشل تشغيل Selenium"
-    
-    if not watch_url or not page_html:
-        driver.quit()
-        return False, "فشل تحميل الصفحة عبر Selenium"
-    
-    print(f"📺 Watch URL: {watch_url}")
-    
-    # 2. استخراج iframe
-    iframe_url = extract_iframe_url_from_html(page_html)
-    if not iframe_url:
-        driver.quit()
-        return False, "لم يتم العثور على iframe في الصفحة"
-    
-    print(f"📦 تم العثور على iframe: {iframe_url}")
-    
-    # 3. استخدام نفس driver لفتح iframe واستخراج رابط الفيديو
-    video_url = extract_video_from_iframe_with_selenium(driver, iframe_url)
-    driver.quit()  # نغلق المتصفح بعد الانتهاء
+    print(f"\n🎬 Episode {job['num']:02d}")
+    print(f"🔗 Base URL: {job['base_url']}")
+
+    # 0. رابط محلول سابقاً وما زال صالحاً: لا حاجة للاستخراج
+    if use_cached_url(job, job['base_url']):
+        return True, "تم الاستخراج (من الذاكرة)"
+
+    # فاصل التأدب فقط إذا زِير نفس الموقع قبل قليل
+    host_scheduler.wait(job['base_url'])
+
+    # 1. المسار السريع عبر HTTP
+    watch_url, iframe_url, video_url = resolve_episode_over_http(job['base_url'])
+    referer, headers = None, {}
+    if video_url:
+        print("⚡ تم حل الحلقة عبر HTTP بدون متصفح")
+    else:
+        # 2. استعارة متصفح من المجمع فقط للخطوات التي تحتاج JavaScript
+        with driver_pool.lease() as driver:
+            if not driver:
+                return False, "فشل تشغيل Selenium"
+
+            if not iframe_url:
+                watch_url, page_html = get_episode_page_with_selenium(driver, job['base_url'])
+                if not watch_url or not page_html:
+                    return False, "فشل تحميل الصفحة عبر Selenium"
+                iframe_url = extract_iframe_url_from_html(page_html)
+                if not iframe_url:
+                    return False, "لم يتم العثور على iframe في الصفحة"
+
+            print(f"📺 Watch URL: {watch_url}")
+            print(f"📦 تم العثور على iframe: {iframe_url}")
+
+            # 3. فتح iframe في المتصفح واستخراج رابط الفيديو
+            video_url, referer, headers = extract_video_from_iframe_with_selenium(driver, iframe_url)
     
     if not video_url:
         return False, "فشل استخراج رابط الفيديو من iframe"
     
     print(f"🎥 Video URL: {video_url}")
-    
-    # 4. تنزيل الفيديو باستخدام yt-dlp مع referer المناسب
-    if not download_video(video_url, temp_file, referer=iframe_url):
+    job['video_url'] = video_url
+    job['referer'] = referer or iframe_url
+    job['headers'] = headers
+    url_cache.put(job['base_url'], video_url, job['referer'], headers)
+    return True, "تم الاستخراج"
+
+async def download_resolved(job):
+    """تنزيل الفيديو باستخدام yt-dlp مع referer المناسب من الرابط المستخرج (أو المحفوظ)"""
+    if await should_stream_transcode(job['video_url'], job['referer'], job['headers']):
+        # تنزيل وضغط في مرور واحد بدون ملف مؤقت
+        if await stream_transcode(job['video_url'], job['final_file'], job['thumb_file'], referer=job['referer'],
+                                  headers=job['headers']):
+            job['transcoded'] = True
+            return True, "تم التنزيل والضغط"
+        print("⚠️ فشل وضع البث، الرجوع إلى التنزيل ثم الضغط")
+    if not await download_video(job['video_url'], job['temp_file'], referer=job['referer'], headers=job['headers']):
+        # الرابط لم يعد صالحاً: لا نعيد استخدامه في المحاولة القادمة
+        url_cache.evict(job.get('cache_key'))
         return False, "فشل التنزيل"
-    
-    # 5. ضغط الفيديو
-    if not compress_to_240p(temp_file, final_file):
-        shutil.copy2(temp_file, final_file)
-    
-    # 6. إنشاء صورة مصغرة
-    create_thumbnail(final_file, thumb_file)
-    
-    # 7. رفع إلى تليغرام
-    caption = f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}"
-    success = await upload_video(final_file, caption, thumb_file if os.path.exists(thumb_file) else None)
-    
-    # 8. تنظيف
-    for f in [temp_file, final_file, thumb_file]:
-        try:
-            if os.path.exists(f):
-                os.remove(f)
-        except:
-            pass
-    
+    return True, "تم التنزيل"
+
+async def download_stage(job):
+    """المرحلة 2: تنزيل الفيديو، وإذا فشل رابط محفوظ في الذاكرة يُعاد الاستخراج مرة واحدة"""
+    while True:
+        ok, msg = await download_resolved(job)
+        if ok or not job.pop('from_cache', False):
+            return ok, msg
+        print("🔄 الرابط المحفوظ لم يعد صالحاً، إعادة استخراج الرابط...")
+        ok, msg = await run_io(extract_stage, job)
+        if not ok:
+            return ok, msg
+
+async def transcode_stage(job):
+    """المرحلة 3: ضغط الفيديو وإنشاء صورة مصغرة"""
+    if job.get('transcoded'):
+        job['media'] = await probe_media_async(job['final_file'])
+        return True, "تم الضغط أثناء التنزيل"
+    job['media'] = await compress_to_240p(job['temp_file'], job['final_file'])
+    if not job['media']:
+        await run_io(shutil.copy2, job['temp_file'], job['final_file'])
+    await create_thumbnail(job['final_file'], job['thumb_file'], job['media'])
+    # المصدر لم يعد لازماً، ولا داعي لحفظه في ملفات الاستكمال
+    if os.path.exists(job['temp_file']):
+        os.remove(job['temp_file'])
+    return True, "تم الضغط"
+
+async def upload_stage(job):
+    """المرحلة 4: رفع إلى تليغرام"""
+    thumb_file = job['thumb_file']
+    job['message_id'] = await upload_video(job['final_file'], job['caption'],
+                                           thumb_file if os.path.exists(thumb_file) else None, job.get('media'))
+    success = bool(job['message_id'])
+    if success:
+        upload_index.add(job['caption'], job['message_id'])
     return success, "تم بنجاح" if success else "فشل الرفع"
 
+def cleanup_job(job):
+    """تنظيف ملفات الحلقة وطباعة النتيجة بعد خروجها من خط المعالجة"""
+    # ملفات الحلقة الفاشلة تبقى في مجلد العمل ليكمل منها التشغيل القادم
+    if job['success']:
+        for f in [job['temp_file'], job['final_file'], job['thumb_file']]:
+            try:
+                if os.path.exists(f):
+                    os.remove(f)
+            except:
+                pass
+    if job['success']:
+        print(f"✅ الحلقة {job['num']} اكتملت")
+    else:
+        print(f"❌ الحلقة {job['num']}: {job['message']}")
+
 async def main():
+    # ميزانية الوقت تبدأ مع التشغيل لتشمل وقت التجهيز
+    budget = TimeBudget("main")
     print("="*50)
     print("🎬 معالج الفيديو المتكامل باستخدام Selenium (استخراج من iframe)")
     print("="*50)
@@ -442,33 +493,33 @@ async def main():
     start_ep = int(config.get("start_episode", 1))
     end_ep = int(config.get("end_episode", 1))
 
-    # تقليل العدد للحماية
-    if end_ep - start_ep + 1 > 25:
-        print("⚠️ عدد الحلقات كبير جداً، سيتم معالجة 25 حلقه فقط.")
-        end_ep = start_ep + 24
-
     print(f"📺 المسلسل: {series_name_arabic}")
     print(f"🎬 الحلقات: {start_ep} إلى {end_ep}")
 
-    download_dir = f"downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    os.makedirs(download_dir, exist_ok=True)
+    # فهرس الحلقات المنشورة: حلقة موجودة في القناة لا تُعالج من جديد
+    global upload_index, video_uploader
+    upload_index = UploadIndex(TELEGRAM_CHANNEL)
+    video_uploader = OrderedUploader(app, TELEGRAM_CHANNEL)
+    await upload_index.build(app, series_name_arabic)
+
+    # سجل الحلقات ومجلد عمل ثابت: إعادة التشغيل تكمل من آخر مرحلة مكتملة
+    manifest = Manifest("main")
+    download_dir = manifest.work_dir(f"{series_name_arabic} {season_num}")
 
-    successful = 0
-    failed = []
+    jobs = [build_episode_job(ep, series_name, series_name_arabic, season_num, download_dir)
+            for ep in range(start_ep, end_ep + 1)]
 
-    for ep in range(start_ep, end_ep + 1):
-        success, msg = await process_episode(ep, series_name, series_name_arabic, season_num, download_dir)
-        if success:
-            successful += 1
-            print(f"✅ الحلقة {ep} اكتملت")
-        else:
-            failed.append(ep)
-            print(f"❌ الحلقة {ep}: {msg}")
+    # خط معالجة: الحلقة N+1 تُنزَّل بينما N تُضغط و N-1 تُرفع
+    pipeline = Pipeline([
+        Stage("extract", extract_stage, checkpoint=False),
+        Stage("download", download_stage),
+        Stage("transcode", transcode_stage),
+        Stage("upload", upload_stage, workers=UPLOAD_CONCURRENCY),
+    ], queue_size=1, on_done=cleanup_job, manifest=manifest, budget=budget)
+    results = await pipeline.run(upload_index.pending(jobs))
 
-        # انتظار عشوائي
-        wait_time = random.randint(30, 45)
-        print(f"⏳ انتظار {wait_time} ثانية...")
-        await asyncio.sleep(wait_time)
+    successful = sum(1 for job in results if job['success'])
+    failed = sorted(job['num'] for job in results if not job['success'])
 
     print(f"\n✅ الناجحة: {successful}/{len(range(start_ep, end_ep+1))}")
     if failed:
@@ -480,6 +531,11 @@ async def main():
     except:
         pass
 
+    print_wait_summary()
+    telegram_limiter.print_summary()
+    host_scheduler.print_summary()
+    driver_pool.close_all()
+    shutdown_executors()
     await app.stop()
     print("🔌 تم قطع الاتصال بتليغرام")
 
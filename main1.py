@@ -10,9 +10,7 @@ import json
 import subprocess
 import shutil
 import asyncio
-import random
 import re
-from datetime import datetime
 
 # ===== التهيئة والتحقق =====
 TELEGRAM_API_ID = os.environ.get("API_ID", "")
@@ -49,7 +47,8 @@ def install_requirements():
         "yt-dlp>=2024.4.9",
         "curl_cffi>=0.5.10",
         "selenium>=4.15.0",
-        "beautifulsoup4>=4.12.0"
+        "beautifulsoup4>=4.12.0",
+        "requests>=2.28.0"
     ]
     for req in reqs:
         try:
@@ -58,52 +57,27 @@ def install_requirements():
         except:
             print(f"  ⚠️ Failed to install {req}")
 
-install_requirements()
+# خادم forkserver لعمليات yt-dlp يستورد هذا الملف باسم __mp_main__، والحزم مثبتة مسبقاً
+if __name__ == "__main__":
+    install_requirements()
 
 from pyrogram import Client
-from pyrogram.errors import FloodWait
-import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from bs4 import BeautifulSoup
 
-app = None
+from browser import (driver_pool, capture_media_request, wait_for, any_of, element_present, iframe_with_src,
+                     url_changed, page_source_matches, print_wait_summary, NETWORK_CAPTURE)
+from resolver import race_collect, rank_mirrors_by_size, url_cache, use_cached_url, host_health, MIRROR_GRACE_SECONDS
+from downloader import download_hls, discard_hls_segments, is_hls_url, HLS_WORKERS, ytdlp_format_options
+from transcode import compress_to_240p, create_thumbnail, probe_media_async, should_stream_transcode, stream_transcode
+from pipeline import Pipeline, Stage, TimeBudget, run_io, ytdlp_download_blocking, ytdlp_extract_info_blocking, shutdown_executors
+from state import Manifest
+from uploader import UploadIndex, OrderedUploader, UPLOAD_CONCURRENCY
+from ratelimit import telegram_limiter, host_scheduler
 
-# ===== إعداد Selenium =====
-def setup_selenium():
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    
-    chromedriver_path = '/usr/bin/chromedriver'
-    if not os.path.exists(chromedriver_path):
-        chromedriver_path = shutil.which('chromedriver')
-        if not chromedriver_path:
-            print("❌ لم يتم العثور على chromedriver. تأكد من تثبيته.")
-            return None
-    
-    try:
-        service = Service(executable_path=chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        print(f"❌ فشل إعداد Selenium: {e}")
-        return None
+app = None
+upload_index = None
+video_uploader = None
 
 # ===== دوال مساعدة =====
 
@@ -116,7 +90,9 @@ async def setup_telegram():
             api_id=TELEGRAM_API_ID,
             api_hash=TELEGRAM_API_HASH,
             session_string=STRING_SESSION.strip(),
-            in_memory=True
+            in_memory=True,
+            # كل FloodWait يصل إلى telegram_limiter بدلاً من أن يبتلعه pyrogram بانتظار صامت
+            sleep_threshold=0
         )
         await app.start()
         me = await app.get_me()
@@ -141,16 +117,19 @@ def test_video_url(url):
             'no_warnings': True,
             'extract_flat': True,
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if info and ('url' in info or 'entries' in info):
-                return True
+        # في مجمع العمليات حتى لا يزاحم الاستخراج حلقة الأحداث على الـ GIL
+        info, _ = ytdlp_extract_info_blocking(url, ydl_opts)
+        if info and ('url' in info or 'entries' in info):
+            return True
     except Exception:
         pass
     return False
 
 def extract_video_from_uqload_page(driver, url):
-    """فتح صفحة Uqload واستخراج رابط الفيديو المباشر"""
+    """
+    فتح صفحة Uqload واستخراج رابط الفيديو المباشر.
+    يعيد (video_url, referer, headers) من أول طلب فيديو في الشبكة (مع هيدرز طلبه) أو من نص الصفحة، أو (None, None, {}).
+    """
     try:
         # تحويل النطاق من .to إلى .is إذا لزم الأمر
         if 'uqload.to' in url:
@@ -158,8 +137,12 @@ def extract_video_from_uqload_page(driver, url):
             print(f"🔄 تم تحويل الرابط إلى: {url}")
         
         print(f"🔄 فتح صفحة Uqload: {url}")
-        driver.get(url)
-        time.sleep(5)  # انتظار تحميل الصفحة
+        media = capture_media_request(driver, url)
+        if media:
+            return media['url'], media['referer'], media['headers']
+        if not NETWORK_CAPTURE:
+            # انتظار ظهور رابط mp4 في الصفحة
+            wait_for(driver, page_source_matches(r'https?://[^"\']+\.mp4'), "uqload_source")
         page_source = driver.page_source
         
         # البحث عن رابط .mp4 داخل متغير sources
@@ -168,37 +151,61 @@ def extract_video_from_uqload_page(driver, url):
         if match:
             video_url = match.group(1)
             print(f"✅ تم استخراج رابط فيديو Uqload: {video_url[:100]}...")
-            return video_url
+            return video_url, url, {}
         
         # إذا لم نجد، نبحث عن أي رابط .mp4
         match = re.search(r'(https?://[^"\']+\.mp4[^"\']*)', page_source)
         if match:
             video_url = match.group(1)
             print(f"✅ تم العثور على رابط mp4: {video_url[:100]}...")
-            return video_url
+            return video_url, url, {}
         
         print("❌ لم يتم العثور على رابط فيديو في صفحة Uqload.")
-        return None
+        return None, None, {}
     except Exception as e:
         print(f"❌ خطأ في استخراج الفيديو من Uqload: {e}")
+        return None, None, {}
+
+def probe_server(iframe_src, page_url, cancel):
+    """
+    فحص سيرفر واحد ضمن السباق، يعيد (video_url, referer, headers) أو None.
+    Uqload يُفتح بمتصفح مستقل من المجمع، وبقية السيرفرات تُختبر عبر yt-dlp.
+    """
+    if cancel.is_set():
         return None
+    print(f"🔄 تجربة السيرفر: {iframe_src}")
+    if 'uqload' in iframe_src:
+        with driver_pool.lease() as driver:
+            if not driver or cancel.is_set():
+                return None
+            # استخراج الفيديو مباشرة من صفحة uqload
+            uqload_video, referer, headers = extract_video_from_uqload_page(driver, iframe_src)
+            if uqload_video:
+                print(f"✅ تم الحصول على رابط فيديو مباشر من Uqload.")
+                return uqload_video, referer, headers
+            print("❌ فشل استخراج الفيديو من Uqload.")
+            return None
+
+    # للسيرفرات الأخرى، نستخدم yt-dlp لاختبار الرابط
+    if test_video_url(iframe_src):
+        print(f"✅ السيرفر {iframe_src} يعمل.")
+        return iframe_src, page_url, {}
+    print(f"❌ السيرفر {iframe_src} لا يعمل.")
+    return None
 
 # ===== دالة استخراج الفيديو من new.eishq.net (معدلة للتعامل مع Uqload) =====
-def get_video_from_eishq(base_url):
-    driver = setup_selenium()
-    if not driver:
-        return None, None
-    
+def get_servers_from_eishq(driver, base_url):
+    """فتح صفحة الحلقة وجمع روابط السيرفرات، يعيد (server_iframes, page_url)"""
     try:
         print(f"🖥️ فتح صفحة الحلقة: {base_url}")
         driver.get(base_url)
-        time.sleep(5)
 
         # البحث عن النموذج
         try:
-            form = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, "//form[contains(@action, 'b.hagobi.com') or contains(@action, '/sk/p-')]"))
-            )
+            form = wait_for(driver, element_present(xpath="//form[contains(@action, 'b.hagobi.com') or contains(@action, '/sk/p-')]"),
+                            "watch_form")
+            if not form:
+                raise Exception("لم يظهر نموذج المشاهدة خلال المهلة")
             print("📝 تم العثور على نموذج المشاهدة.")
 
             action_url = form.get_attribute('action')
@@ -212,32 +219,26 @@ def get_video_from_eishq(base_url):
             old_url = driver.current_url
             submit_button.click()
             
-            try:
-                WebDriverWait(driver, 15).until(
-                    lambda d: d.current_url != old_url or 
-                    EC.presence_of_element_located((By.TAG_NAME, "iframe"))(d) or
-                    EC.presence_of_element_located((By.TAG_NAME, "video"))(d)
-                )
+            if wait_for(driver, any_of(url_changed(old_url), element_present("iframe"), element_present("video")),
+                        "form_submit"):
                 print("✅ تم تحميل الصفحة الجديدة بنجاح.")
-                time.sleep(3)
-            except:
+                # انتظار ظهور قائمة السيرفرات أو iframe المشغّل بدلاً من انتظار ثابت
+                wait_for(driver, any_of(element_present("ul.serversList li"), iframe_with_src()), "server_list")
+            else:
                 print("⚠️ لم يتغير الرابط بعد النقر، قد يكون المحتوى في نفس الصفحة.")
 
         except Exception as e:
             print(f"⚠️ لم يتم العثور على النموذج أو حدث خطأ: {e}")
             # محاولة البحث عن iframe مباشر
             try:
-                iframe = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.TAG_NAME, "iframe"))
-                )
-                iframe_url = iframe.get_attribute("src")
+                iframe_url = wait_for(driver, iframe_with_src(), "iframe", timeout=10)
                 if iframe_url and iframe_url.startswith('//'):
                     iframe_url = 'https:' + iframe_url
                 elif iframe_url.startswith('/'):
                     iframe_url = 'https://b.hagobi.com' + iframe_url
                 print(f"📦 تم العثور على iframe مباشر: {iframe_url}")
                 driver.get(iframe_url)
-                time.sleep(3)
+                wait_for(driver, any_of(element_present("ul.serversList li"), iframe_with_src()), "server_list")
             except:
                 print("⚠️ لا يوجد iframe مباشر. جاري محاولة البحث عن روابط أخرى...")
 
@@ -286,119 +287,85 @@ def get_video_from_eishq(base_url):
                     server_iframes.append(src)
                     print(f"  - تم العثور على iframe إضافي: {src}")
 
-        # تجربة كل رابط حتى يعمل أحدهم
-        video_url = None
-        for iframe_src in server_iframes:
-            print(f"🔄 تجربة السيرفر: {iframe_src}")
-            if 'uqload' in iframe_src:
-                # استخراج الفيديو مباشرة من صفحة uqload
-                uqload_video = extract_video_from_uqload_page(driver, iframe_src)
-                if uqload_video:
-                    video_url = uqload_video
-                    print(f"✅ تم الحصول على رابط فيديو مباشر من Uqload.")
-                    break
-                else:
-                    print("❌ فشل استخراج الفيديو من Uqload، نجرب السيرفر التالي...")
-            else:
-                # للسيرفرات الأخرى، نستخدم yt-dlp لاختبار الرابط
-                if test_video_url(iframe_src):
-                    video_url = iframe_src
-                    print(f"✅ هذا السيرفر يعمل وسيتم استخدامه.")
-                    break
-                else:
-                    print(f"❌ هذا السيرفر لا يعمل، نجرب التالي...")
-
-        if video_url:
-            referer = driver.current_url
-            return video_url, referer
-        else:
-            print("❌ فشل البحث: لم يتم العثور على أي رابط فيديو يعمل.")
+        if not server_iframes:
+            print("❌ فشل البحث: لم يتم العثور على أي سيرفر.")
             # حفظ مصدر الصفحة للتشخيص
             with open("debug_page.html", "w", encoding="utf-8") as f:
                 f.write(driver.page_source)
             print("💾 تم حفظ مصدر الصفحة في debug_page.html للمساعدة في التشخيص.")
-            return None, None
+        return server_iframes, driver.current_url
 
     except Exception as e:
         print(f"❌ خطأ رئيسي في استخراج الفيديو: {e}")
-        return None, None
-    finally:
-        driver.quit()
+        return [], None
 
-def download_video(video_url, output_path, referer):
-    """تنزيل الفيديو باستخدام yt-dlp مع impersonation وإضافة referer"""
+def pick_server(server_iframes, page_url):
+    """
+    فحص جميع السيرفرات بالتوازي واختيار الأصغر حجماً، يعيد (video_url, referer, headers).
+    يُستدعى بعد إعادة متصفح صفحة الحلقة للمجمع، لأن فحص Uqload يستعير متصفحاً آخر منه.
+    """
+    # ترتيب السيرفرات حسب صحتها في التشغيلات السابقة وتخطي المتعطلة حالياً
+    server_iframes = host_health.order(server_iframes)
+    results = race_collect(server_iframes, lambda src, cancel: probe_server(src, page_url, cancel),
+                           grace=MIRROR_GRACE_SECONDS)
+    # كل السيرفرات تُضغط إلى نفس الدقة، لذا نختار الأصغر حجماً
+    ranked = rank_mirrors_by_size(results, lambda media: (media[0], {**media[2], 'Referer': media[1]}))
+    if not ranked:
+        print("❌ فشل البحث: لم يتم العثور على أي رابط فيديو يعمل.")
+        return None, None, {}
+    winner, (video_url, referer, headers) = ranked[0]
+    print(f"🏁 السيرفر المختار: {winner}")
+    return video_url, referer, headers
+
+async def download_video(video_url, output_path, referer, headers=None):
+    """تنزيل الفيديو (HLS عبر المحرك الداخلي) أو باستخدام yt-dlp (في عملية منفصلة) مع impersonation وإضافة referer"""
     try:
+        # بث HLS: المحرك الداخلي بمقاطع متوازية أولاً، ثم yt-dlp إذا كانت القائمة غير مدعومة
+        if is_hls_url(video_url):
+            hls_headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
+                'Referer': referer,
+            }
+            if await run_io(download_hls, video_url, output_path, hls_headers):
+                return True
+            discard_hls_segments(output_path)
+
         ydl_opts = {
-            'format': 'best[height<=720]/best',
+            **ytdlp_format_options(),
             'outtmpl': output_path,
             'quiet': False,
             'retries': 5,
             'fragment_retries': 5,
+            'concurrent_fragment_downloads': HLS_WORKERS,
             'socket_timeout': 30,
             'extractor_args': {'generic': 'impersonate'},
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
                 'Referer': referer,
             }
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        success, error = await run_io(ytdlp_download_blocking, video_url, ydl_opts)
+        if not success:
+            print(f"❌ Download error: {error}")
+            return False
         return os.path.exists(output_path)
     except Exception as e:
         print(f"❌ Download error: {e}")
         return False
 
-def compress_to_240p(input_path, output_path):
-    """ضغط الفيديو إلى 240p"""
-    if not os.path.exists(input_path):
-        return False
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vf', 'scale=-2:240',
-        '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast',
-        '-c:a', 'aac', '-b:a', '64k',
-        '-y', output_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=1800)
-        return os.path.exists(output_path)
-    except:
-        return False
-
-def create_thumbnail(video_path, thumb_path):
-    cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', '00:00:05', '-vframes', '1', '-s', '320x180',
-        '-f', 'image2', '-y', thumb_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=30)
-        return os.path.exists(thumb_path)
-    except:
-        return False
-
-async def upload_video(file_path, caption, thumb_path=None):
+async def upload_video(file_path, caption, thumb_path=None, media=None):
     if not app or not os.path.exists(file_path):
         return False
     try:
-        width, height = 426, 240
-        duration = 0
-        try:
-            probe = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                                    '-show_entries', 'stream=width,height,duration',
-                                    '-of', 'csv=p=0', file_path],
-                                   capture_output=True, text=True)
-            if probe.returncode == 0:
-                parts = probe.stdout.strip().split(',')
-                if len(parts) >= 2:
-                    width, height = int(parts[0]), int(parts[1])
-                if len(parts) >= 3 and parts[2]:
-                    duration = int(float(parts[2]))
-        except:
-            pass
+        # معلومات الملف تأتي من مرحلة الضغط؛ ffprobe فقط إذا لم تصل
+        media = media or await probe_media_async(file_path)
+        width, height = (media['width'], media['height']) if media and media['height'] else (426, 240)
+        duration = int(media['duration']) if media else 0
 
-        await app.send_video(
-            chat_id=TELEGRAM_CHANNEL,
+        # الرفع عبر OrderedUploader: عدة ملفات بالتوازي والنشر في القناة بالترتيب
+        message = await video_uploader.send_video(
             video=file_path,
             caption=caption,
             supports_streaming=True,
@@ -407,59 +374,122 @@ async def upload_video(file_path, caption, thumb_path=None):
             duration=duration,
             thumb=thumb_path if thumb_path and os.path.exists(thumb_path) else None
         )
-        return True
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return await upload_video(file_path, caption, thumb_path)
+        # رقم الرسالة يُحفظ في سجل الحلقات
+        return message.id
     except Exception as e:
         print(f"❌ Upload error: {e}")
         return False
 
-async def process_episode(episode_num, series_name, series_name_arabic, season_num, download_dir):
-    """
-    معالجة حلقة واحدة من new.eishq.net
-    """
-    # بناء رابط الحلقة حسب النمط الصحيح
-    base_url = f"https://new.eishq.net/video/{series_name}-sb{season_num}-ep-{episode_num:02d}/"
-    # base_url = f"https://new.eishq.net/video/{series_name}-sb{season_num}-ep-{episode_num:02d}/"
-    print(f"\n🎬 Episode {episode_num:02d}")
-    print(f"🔗 Base URL: {base_url}")
-    
-    temp_file = os.path.join(download_dir, f"temp_{episode_num:02d}.mp4")
-    final_file = os.path.join(download_dir, f"final_{episode_num:02d}.mp4")
-    thumb_file = os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg")
-
-    # استخراج رابط الفيديو باستخدام Selenium
-    video_url, referer = get_video_from_eishq(base_url)
+def build_episode_job(episode_num, series_name, series_name_arabic, season_num, download_dir):
+    """تجهيز قاموس المهمة لحلقة واحدة"""
+    return {
+        'num': episode_num,
+        'base_url': f"https://new.eishq.net/video/{series_name}-sb{season_num}-ep-{episode_num:02d}/",
+        'caption': f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}",
+        'temp_file': os.path.join(download_dir, f"temp_{episode_num:02d}.mp4"),
+        'final_file': os.path.join(download_dir, f"final_{episode_num:02d}.mp4"),
+        'thumb_file': os.path.join(download_dir, f"thumb_{episode_num:02d}.jpg"),
+    }
+
+def extract_stage(job):
+    """المرحلة 1: استخراج رابط الفيديو باستخدام Selenium"""
+    print(f"\n🎬 Episode {job['num']:02d}")
+    print(f"🔗 Base URL: {job['base_url']}")
+
+    if use_cached_url(job, job['base_url']):
+        return True, "تم الاستخراج (من الذاكرة)"
+
+    # فاصل التأدب فقط إذا زِير نفس الموقع قبل قليل
+    host_scheduler.wait(job['base_url'])
+
+    with driver_pool.lease() as driver:
+        if not driver:
+            return False, "فشل إعداد Selenium"
+        server_iframes, page_url = get_servers_from_eishq(driver, job['base_url'])
+    # المتصفح أُعيد قبل السباق: مع مجمع صغير كان فحص Uqload ينتظر متصفحاً يحجزه المستدعي نفسه
+    video_url, referer, headers = pick_server(server_iframes, page_url) if server_iframes else (None, None, {})
     if not video_url:
         return False, "فشل استخراج رابط الفيديو"
-    
-    # تنزيل الفيديو
-    if not download_video(video_url, temp_file, referer=referer):
+    job['video_url'] = video_url
+    job['referer'] = referer
+    job['headers'] = headers
+    url_cache.put(job['base_url'], video_url, referer, headers)
+    return True, "تم الاستخراج"
+
+async def download_resolved(job):
+    """تنزيل الفيديو من الرابط المستخرج (أو المحفوظ)"""
+    if await should_stream_transcode(job['video_url'], job['referer'], job['headers']):
+        # تنزيل وضغط في مرور واحد بدون ملف مؤقت
+        if await stream_transcode(job['video_url'], job['final_file'], job['thumb_file'], referer=job['referer'],
+                                  headers=job['headers']):
+            # الناتج ملف 240p والزمن يشمل الضغط: تسجيل النجاح فقط دون سرعة حتى لا تفسد سرعة السيرفر
+            host_health.record_download(job['video_url'], True)
+            job['transcoded'] = True
+            return True, "تم التنزيل والضغط"
+        print("⚠️ فشل وضع البث، الرجوع إلى التنزيل ثم الضغط")
+    # السرعة تُحسب من حجم الملف المنزَّل وزمن التنزيل وحده
+    started = time.time()
+    ok = await download_video(job['video_url'], job['temp_file'], referer=job['referer'], headers=job['headers'])
+    host_health.record_download_file(job['video_url'], ok, job['temp_file'], started)
+    if not ok:
+        # الرابط لم يعد صالحاً: لا نعيد استخدامه في المحاولة القادمة
+        url_cache.evict(job.get('cache_key'))
         return False, "فشل التنزيل"
-    
-    # ضغط الفيديو
-    if not compress_to_240p(temp_file, final_file):
-        shutil.copy2(temp_file, final_file)
-    
-    # إنشاء صورة مصغرة
-    create_thumbnail(final_file, thumb_file)
-    
-    # رفع إلى تليغرام
-    caption = f"{series_name_arabic} الموسم {season_num} الحلقة {episode_num}"
-    success = await upload_video(final_file, caption, thumb_file if os.path.exists(thumb_file) else None)
-    
-    # تنظيف
-    for f in [temp_file, final_file, thumb_file]:
-        try:
-            if os.path.exists(f):
-                os.remove(f)
-        except:
-            pass
-    
+    return True, "تم التنزيل"
+
+async def download_stage(job):
+    """المرحلة 2: تنزيل الفيديو، وإذا فشل رابط محفوظ في الذاكرة يُعاد الاستخراج مرة واحدة"""
+    while True:
+        ok, msg = await download_resolved(job)
+        if ok or not job.pop('from_cache', False):
+            return ok, msg
+        print("🔄 الرابط المحفوظ لم يعد صالحاً، إعادة استخراج الرابط...")
+        ok, msg = await run_io(extract_stage, job)
+        if not ok:
+            return ok, msg
+
+async def transcode_stage(job):
+    """المرحلة 3: ضغط الفيديو وإنشاء صورة مصغرة"""
+    if job.get('transcoded'):
+        job['media'] = await probe_media_async(job['final_file'])
+        return True, "تم الضغط أثناء التنزيل"
+    job['media'] = await compress_to_240p(job['temp_file'], job['final_file'])
+    if not job['media']:
+        await run_io(shutil.copy2, job['temp_file'], job['final_file'])
+    await create_thumbnail(job['final_file'], job['thumb_file'], job['media'])
+    # المصدر لم يعد لازماً، ولا داعي لحفظه في ملفات الاستكمال
+    if os.path.exists(job['temp_file']):
+        os.remove(job['temp_file'])
+    return True, "تم الضغط"
+
+async def upload_stage(job):
+    """المرحلة 4: رفع إلى تليغرام"""
+    thumb_file = job['thumb_file']
+    job['message_id'] = await upload_video(job['final_file'], job['caption'],
+                                           thumb_file if os.path.exists(thumb_file) else None, job.get('media'))
+    success = bool(job['message_id'])
+    if success:
+        upload_index.add(job['caption'], job['message_id'])
     return success, "تم بنجاح" if success else "فشل الرفع"
 
+def cleanup_job(job):
+    """تنظيف ملفات الحلقة وطباعة النتيجة بعد خروجها من خط المعالجة"""
+    # ملفات الحلقة الفاشلة تبقى في مجلد العمل ليكمل منها التشغيل القادم
+    if job['success']:
+        for f in [job['temp_file'], job['final_file'], job['thumb_file']]:
+            try:
+                if os.path.exists(f):
+                    os.remove(f)
+            except:
+                pass
+    if job['success']:
+        print(f"✅ الحلقة {job['num']} اكتملت")
+    else:
+        print(f"❌ الحلقة {job['num']}: {job['message']}")
+
 async def main():
+    # ميزانية الوقت تبدأ مع التشغيل لتشمل وقت التجهيز
+    budget = TimeBudget("main1")
     print("="*50)
     print("🎬 معالج الفيديو المتكامل باستخدام Selenium (new.eishq.net)")
     print("="*50)
@@ -500,33 +530,34 @@ async def main():
         print("❌ series_name مفقود في config")
         return
 
-    # تقليل العدد للحماية
-    if end_ep - start_ep + 1 > 25:
-        print("⚠️ عدد الحلقات كبير جداً، سيتم معالجة 25 حلقه فقط.")
-        end_ep = start_ep + 24
 
     print(f"📺 المسلسل: {series_name_arabic}")
     print(f"🎬 الحلقات: {start_ep} إلى {end_ep}")
 
-    download_dir = f"downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    os.makedirs(download_dir, exist_ok=True)
+    # فهرس الحلقات المنشورة: حلقة موجودة في القناة لا تُعالج من جديد
+    global upload_index, video_uploader
+    upload_index = UploadIndex(TELEGRAM_CHANNEL)
+    video_uploader = OrderedUploader(app, TELEGRAM_CHANNEL)
+    await upload_index.build(app, series_name_arabic)
+
+    # سجل الحلقات ومجلد عمل ثابت: إعادة التشغيل تكمل من آخر مرحلة مكتملة
+    manifest = Manifest("main1")
+    download_dir = manifest.work_dir(f"{series_name_arabic} {season_num}")
 
-    successful = 0
-    failed = []
+    jobs = [build_episode_job(ep, series_name, series_name_arabic, season_num, download_dir)
+            for ep in range(start_ep, end_ep + 1)]
 
-    for ep in range(start_ep, end_ep + 1):
-        success, msg = await process_episode(ep, series_name, series_name_arabic, season_num, download_dir)
-        if success:
-            successful += 1
-            print(f"✅ الحلقة {ep} اكتملت")
-        else:
-            failed.append(ep)
-            print(f"❌ الحلقة {ep}: {msg}")
+    # خط معالجة: الحلقة N+1 تُنزَّل بينما N تُضغط و N-1 تُرفع
+    pipeline = Pipeline([
+        Stage("extract", extract_stage, checkpoint=False),
+        Stage("download", download_stage),
+        Stage("transcode", transcode_stage),
+        Stage("upload", upload_stage, workers=UPLOAD_CONCURRENCY),
+    ], queue_size=1, on_done=cleanup_job, manifest=manifest, budget=budget)
+    results = await pipeline.run(upload_index.pending(jobs))
 
-        # انتظار عشوائي
-        wait_time = random.randint(30, 45)
-        print(f"⏳ انتظار {wait_time} ثانية...")
-        await asyncio.sleep(wait_time)
+    successful = sum(1 for job in results if job['success'])
+    failed = sorted(job['num'] for job in results if not job['success'])
 
     print(f"\n✅ الناجحة: {successful}/{len(range(start_ep, end_ep+1))}")
     if failed:
@@ -538,6 +569,12 @@ async def main():
     except:
         pass
 
+    print_wait_summary()
+    telegram_limiter.print_summary()
+    host_scheduler.print_summary()
+    host_health.print_summary()
+    driver_pool.close_all()
+    shutdown_executors()
     await app.stop()
     print("🔌 تم قطع الاتصال بتليغرام")
 
@@ -6,14 +6,11 @@ Telegram Video Uploader - يدعم روابط embed من vidspeed, uqload, vipse
 
 import os
 import sys
-import time
 import json
 import subprocess
 import shutil
 import asyncio
-import random
 import re
-from datetime import datetime
 
 # ===== التهيئة والتحقق =====
 TELEGRAM_API_ID = os.environ.get("API_ID", "")
@@ -49,6 +46,7 @@ def install_requirements():
         "tgcrypto>=1.2.0",
         "yt-dlp>=2024.4.9",
         "selenium>=4.15.0",
+        "requests>=2.28.0",
     ]
     for req in reqs:
         try:
@@ -57,51 +55,26 @@ def install_requirements():
         except:
             print(f"  ⚠️ Failed to install {req}")
 
-install_requirements()
+# خادم forkserver لعمليات yt-dlp يستورد هذا الملف باسم __mp_main__، والحزم مثبتة مسبقاً
+if __name__ == "__main__":
+    install_requirements()
 
 from pyrogram import Client
-from pyrogram.errors import FloodWait
-import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
-app = None
+from browser import (driver_pool, capture_media_request, wait_for, any_of, iframe_with_src, video_has_src,
+                     print_wait_summary, NETWORK_CAPTURE)
+from resolver import url_cache, use_cached_url
+from downloader import download_hls, discard_hls_segments, is_hls_url, HLS_WORKERS, ytdlp_format_options
+from transcode import compress_to_240p, create_thumbnail, probe_media_async, should_stream_transcode, stream_transcode
+from pipeline import Pipeline, Stage, TimeBudget, run_io, ytdlp_download_blocking, ytdlp_extract_info_blocking, shutdown_executors
+from state import Manifest
+from uploader import UploadIndex, OrderedUploader, UPLOAD_CONCURRENCY
+from ratelimit import telegram_limiter, host_scheduler
 
-# ===== إعداد Selenium =====
-def setup_selenium():
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    
-    chromedriver_path = '/usr/bin/chromedriver'
-    if not os.path.exists(chromedriver_path):
-        chromedriver_path = shutil.which('chromedriver')
-        if not chromedriver_path:
-            print("❌ لم يتم العثور على chromedriver. تأكد من تثبيته.")
-            return None
-    
-    try:
-        service = Service(executable_path=chromedriver_path)
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        print(f"❌ فشل إعداد Selenium: {e}")
-        return None
+app = None
+upload_index = None
+video_uploader = None
 
 # ===== دوال مساعدة =====
 
@@ -114,7 +87,9 @@ async def setup_telegram():
             api_id=TELEGRAM_API_ID,
             api_hash=TELEGRAM_API_HASH,
             session_string=STRING_SESSION.strip(),
-            in_memory=True
+            in_memory=True,
+            # كل FloodWait يصل إلى telegram_limiter بدلاً من أن يبتلعه pyrogram بانتظار صامت
+            sleep_threshold=0
         )
         await app.start()
         me = await app.get_me()
@@ -140,41 +115,44 @@ def extract_with_ytdlp(url):
             'no_warnings': True,
             'extract_flat': True,
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if info and 'url' in info:
-                return info['url']
-            if info and 'entries' and len(info['entries']) > 0:
-                return info['entries'][0].get('url')
+        # في مجمع العمليات حتى لا يزاحم الاستخراج حلقة الأحداث على الـ GIL
+        info, error = ytdlp_extract_info_blocking(url, ydl_opts)
+        if error:
+            print(f"  yt-dlp فشل: {error}")
+        if info and 'url' in info:
+            return info['url']
+        if info and 'entries' and len(info['entries']) > 0:
+            return info['entries'][0].get('url')
     except Exception as e:
         print(f"  yt-dlp فشل: {e}")
     return None
 
+def is_player_iframe(src):
+    return 'embed' in src or 'player' in src or 'video' in src or 'okhd' in src
+
 def extract_with_selenium(driver, url):
-    """استخراج الرابط باستخدام Selenium مع دعم لجميع المواقع"""
+    """
+    استخراج الرابط باستخدام Selenium مع دعم لجميع المواقع.
+    يعيد (video_url, referer, headers)؛ أولاً من طلبات الشبكة التي يرسلها المشغّل (مع هيدرز طلبه) ثم من عناصر الصفحة.
+    """
     try:
         print(f"  🔄 تجربة Selenium مع: {url}")
-        driver.get(url)
-        # انتظار تحميل الصفحة بالكامل (حتى 30 ثانية)
-        wait = WebDriverWait(driver, 30)
-        
-        # انتظار وجود أي iframe أو عنصر فيديو
-        try:
-            wait.until(EC.presence_of_element_located((By.TAG_NAME, "iframe")))
-        except:
-            pass
-        
-        time.sleep(5)  # تأمين إضافي
+        # مراقبة طلبات المشغّل، مع التوقف مبكراً إذا ظهر iframe مشغّل سننتقل إليه
+        media = capture_media_request(driver, url, stop_when=iframe_with_src(predicate=is_player_iframe))
+        if media:
+            return media['url'], media['referer'], media['headers']
+
+        if not NETWORK_CAPTURE:
+            # انتظار وجود iframe مشغّل أو عنصر فيديو له رابط
+            wait_for(driver, any_of(iframe_with_src(predicate=is_player_iframe), video_has_src()), "player")
         
         # ----- البحث عن iframes -----
         iframes = driver.find_elements(By.TAG_NAME, "iframe")
         for iframe in iframes:
             src = iframe.get_attribute("src")
-            if src and ('embed' in src or 'player' in src or 'video' in src or 'okhd' in src):
+            if src and is_player_iframe(src):
                 print(f"  📦 تم العثور على iframe: {src}")
                 # فتح iframe مباشرة ومعالجته
-                driver.get(src)
-                time.sleep(8)
                 return extract_with_selenium(driver, src)
         
         # ----- البحث عن عنصر الفيديو -----
@@ -182,7 +160,7 @@ def extract_with_selenium(driver, url):
             video = driver.find_element(By.TAG_NAME, "video")
             src = video.get_attribute("src")
             if src and src.startswith("http"):
-                return src
+                return src, url, {}
         except:
             pass
         
@@ -204,7 +182,7 @@ def extract_with_selenium(driver, url):
         """
         video_url = driver.execute_script(js_get_video)
         if video_url:
-            return video_url
+            return video_url, url, {}
         
         # ----- البحث في النص عن روابط mp4 أو m3u8 -----
         page_source = driver.page_source
@@ -219,12 +197,12 @@ def extract_with_selenium(driver, url):
         for pattern in patterns:
             match = re.search(pattern, page_source, re.IGNORECASE)
             if match:
-                return match.group(1)
+                return match.group(1), url, {}
         
-        return None
+        return None, None, {}
     except Exception as e:
         print(f"  ❌ خطأ في Selenium: {e}")
-        return None
+        return None, None, {}
 
 def get_video_url(part_info):
     """
@@ -232,10 +210,11 @@ def get_video_url(part_info):
     إذا وُجد 'direct_url' يتم استخدامه مباشرة.
     وإذا كان الرابط مباشراً يستخدم yt-dlp.
     وإلا يستخدم Selenium.
+    يعيد (video_url, referer, headers)، ويكون referer None إذا لم يُحدَّد من الشبكة.
     """
     if 'direct_url' in part_info and part_info['direct_url']:
         print(f"  🔗 استخدام الرابط المباشر المقدم: {part_info['direct_url'][:80]}...")
-        return part_info['direct_url']
+        return part_info['direct_url'], None, {}
     
     url = part_info['url']
     
@@ -244,92 +223,65 @@ def get_video_url(part_info):
         print(f"  📡 الرابط مباشر، استخراج بواسطة yt-dlp...")
         video_url = extract_with_ytdlp(url)
         if video_url:
-            return video_url
+            return video_url, None, {}
         # إذا فشل، نعتبر الرابط نفسه صالحاً
-        return url
+        return url, None, {}
     
     # خلاف ذلك، استخدم Selenium فقط (لأن yt-dlp لا يدعم صفحات embed)
     print(f"  🌐 الرابط ليس مباشراً، استخدام Selenium للاستخراج...")
-    driver = setup_selenium()
-    if not driver:
-        return None
-    video_url = extract_with_selenium(driver, url)
-    driver.quit()
-    return video_url
+    with driver_pool.lease() as driver:
+        if not driver:
+            return None, None, {}
+        return extract_with_selenium(driver, url)
 
-def download_video(video_url, output_path, referer_url):
-    """تنزيل الفيديو باستخدام yt-dlp مع إضافة referer"""
+async def download_video(video_url, output_path, referer_url, headers=None):
+    """تنزيل الفيديو (HLS عبر المحرك الداخلي) أو باستخدام yt-dlp (في عملية منفصلة) مع إضافة referer"""
     try:
+        # بث HLS: المحرك الداخلي بمقاطع متوازية أولاً، ثم yt-dlp إذا كانت القائمة غير مدعومة
+        if is_hls_url(video_url):
+            hls_headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
+                'Referer': referer_url,
+            }
+            if await run_io(download_hls, video_url, output_path, hls_headers):
+                return True
+            discard_hls_segments(output_path)
+
         ydl_opts = {
-            'format': 'best[height<=720]/best',
+            **ytdlp_format_options(),
             'outtmpl': output_path,
             'quiet': False,
             'retries': 5,
             'fragment_retries': 5,
+            'concurrent_fragment_downloads': HLS_WORKERS,
             'socket_timeout': 30,
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+                **(headers or {}),
                 'Referer': referer_url,
             }
         }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+        success, error = await run_io(ytdlp_download_blocking, video_url, ydl_opts)
+        if not success:
+            print(f"❌ Download error: {error}")
+            return False
         return os.path.exists(output_path)
     except Exception as e:
         print(f"❌ Download error: {e}")
         return False
 
-def compress_to_240p(input_path, output_path):
-    """ضغط الفيديو إلى 240p"""
-    if not os.path.exists(input_path):
-        return False
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vf', 'scale=-2:240',
-        '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast',
-        '-c:a', 'aac', '-b:a', '64k',
-        '-y', output_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=1800)
-        return os.path.exists(output_path)
-    except:
-        return False
-
-def create_thumbnail(video_path, thumb_path):
-    cmd = [
-        'ffmpeg', '-i', video_path,
-        '-ss', '00:00:05', '-vframes', '1', '-s', '320x180',
-        '-f', 'image2', '-y', thumb_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=30)
-        return os.path.exists(thumb_path)
-    except:
-        return False
-
-async def upload_video(file_path, caption, thumb_path=None):
+async def upload_video(file_path, caption, thumb_path=None, media=None):
     if not app or not os.path.exists(file_path):
         return False
     try:
-        width, height = 426, 240
-        duration = 0
-        try:
-            probe = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
-                                    '-show_entries', 'stream=width,height,duration',
-                                    '-of', 'csv=p=0', file_path],
-                                   capture_output=True, text=True)
-            if probe.returncode == 0:
-                parts = probe.stdout.strip().split(',')
-                if len(parts) >= 2:
-                    width, height = int(parts[0]), int(parts[1])
-                if len(parts) >= 3 and parts[2]:
-                    duration = int(float(parts[2]))
-        except:
-            pass
+        # معلومات الملف تأتي من مرحلة الضغط؛ ffprobe فقط إذا لم تصل
+        media = media or await probe_media_async(file_path)
+        width, height = (media['width'], media['height']) if media and media['height'] else (426, 240)
+        duration = int(media['duration']) if media else 0
 
-        await app.send_video(
-            chat_id=TELEGRAM_CHANNEL,
+        # الرفع عبر OrderedUploader: عدة ملفات بالتوازي والنشر في القناة بالترتيب
+        message = await video_uploader.send_video(
             video=file_path,
             caption=caption,
             supports_streaming=True,
@@ -338,52 +290,114 @@ async def upload_video(file_path, caption, thumb_path=None):
             duration=duration,
             thumb=thumb_path if thumb_path and os.path.exists(thumb_path) else None
         )
-        return True
-    except FloodWait as e:
-        await asyncio.sleep(e.value)
-        return await upload_video(file_path, caption, thumb_path)
+        # رقم الرسالة يُحفظ في سجل الحلقات
+        return message.id
     except Exception as e:
         print(f"❌ Upload error: {e}")
         return False
 
-async def process_part(part_info, download_dir):
+def build_part_job(part_info, download_dir):
+    """تجهيز قاموس المهمة لجزء واحد"""
     part_num = part_info['part']
-    movie_name = part_info['movie_name']
-    
-    print(f"\n🎬 الجزء {part_num} - {movie_name}")
+    return {
+        'num': part_num,
+        'part_info': part_info,
+        'caption': f"{part_info['movie_name']} - الجزء {part_num}",
+        'temp_file': os.path.join(download_dir, f"temp_part{part_num:02d}.mp4"),
+        'final_file': os.path.join(download_dir, f"final_part{part_num:02d}.mp4"),
+        'thumb_file': os.path.join(download_dir, f"thumb_part{part_num:02d}.jpg"),
+    }
+
+def extract_stage(job):
+    """المرحلة 1: الحصول على رابط الفيديو المباشر"""
+    part_info = job['part_info']
+    print(f"\n🎬 الجزء {job['num']} - {part_info['movie_name']}")
     print(f"🔗 الرابط: {part_info.get('url', part_info.get('direct_url', 'غير متوفر'))}")
-    
-    temp_file = os.path.join(download_dir, f"temp_part{part_num:02d}.mp4")
-    final_file = os.path.join(download_dir, f"final_part{part_num:02d}.mp4")
-    thumb_file = os.path.join(download_dir, f"thumb_part{part_num:02d}.jpg")
 
-    video_url = get_video_url(part_info)
+    page_url = part_info.get('url')
+    if page_url and not part_info.get('direct_url') and use_cached_url(job, page_url):
+        return True, "تم الاستخراج (من الذاكرة)"
+
+    # فاصل التأدب فقط إذا زِير نفس الموقع قبل قليل
+    host_scheduler.wait(page_url or part_info.get('direct_url', ''))
+    video_url, referer, headers = get_video_url(part_info)
     if not video_url:
         return False, "فشل استخراج رابط الفيديو"
-
-    referer = part_info.get('url', video_url)
-    if not download_video(video_url, temp_file, referer_url=referer):
+    job['video_url'] = video_url
+    job['referer'] = referer or part_info.get('url', video_url)
+    job['headers'] = headers
+    if page_url and video_url != page_url:
+        url_cache.put(page_url, video_url, job['referer'], headers)
+    return True, "تم الاستخراج"
+
+async def download_resolved(job):
+    """تنزيل الفيديو من الرابط المستخرج (أو المحفوظ)"""
+    if await should_stream_transcode(job['video_url'], job['referer'], job['headers']):
+        # تنزيل وضغط في مرور واحد بدون ملف مؤقت
+        if await stream_transcode(job['video_url'], job['final_file'], job['thumb_file'], referer=job['referer'],
+                                  headers=job['headers']):
+            job['transcoded'] = True
+            return True, "تم التنزيل والضغط"
+        print("⚠️ فشل وضع البث، الرجوع إلى التنزيل ثم الضغط")
+    if not await download_video(job['video_url'], job['temp_file'], referer_url=job['referer'], headers=job['headers']):
+        # الرابط لم يعد صالحاً: لا نعيد استخدامه في المحاولة القادمة
+        url_cache.evict(job.get('cache_key'))
         return False, "فشل التنزيل"
-    
-    # ضغط (يمكن تعطيله إذا أردت توفير الوقت)
-    if not compress_to_240p(temp_file, final_file):
-        shutil.copy2(temp_file, final_file)
-    
-    create_thumbnail(final_file, thumb_file)
-    
-    caption = f"{movie_name} - الجزء {part_num}"
-    success = await upload_video(final_file, caption, thumb_file if os.path.exists(thumb_file) else None)
-    
-    for f in [temp_file, final_file, thumb_file]:
-        try:
-            if os.path.exists(f):
-                os.remove(f)
-        except:
-            pass
-    
+    return True, "تم التنزيل"
+
+async def download_stage(job):
+    """المرحلة 2: تنزيل الفيديو، وإذا فشل رابط محفوظ في الذاكرة يُعاد الاستخراج مرة واحدة"""
+    while True:
+        ok, msg = await download_resolved(job)
+        if ok or not job.pop('from_cache', False):
+            return ok, msg
+        print("🔄 الرابط المحفوظ لم يعد صالحاً، إعادة استخراج الرابط...")
+        ok, msg = await run_io(extract_stage, job)
+        if not ok:
+            return ok, msg
+
+async def transcode_stage(job):
+    """المرحلة 3: ضغط (يمكن تعطيله إذا أردت توفير الوقت) وإنشاء صورة مصغرة"""
+    if job.get('transcoded'):
+        job['media'] = await probe_media_async(job['final_file'])
+        return True, "تم الضغط أثناء التنزيل"
+    job['media'] = await compress_to_240p(job['temp_file'], job['final_file'])
+    if not job['media']:
+        await run_io(shutil.copy2, job['temp_file'], job['final_file'])
+    await create_thumbnail(job['final_file'], job['thumb_file'], job['media'])
+    # المصدر لم يعد لازماً، ولا داعي لحفظه في ملفات الاستكمال
+    if os.path.exists(job['temp_file']):
+        os.remove(job['temp_file'])
+    return True, "تم الضغط"
+
+async def upload_stage(job):
+    """المرحلة 4: رفع إلى تليغرام"""
+    thumb_file = job['thumb_file']
+    job['message_id'] = await upload_video(job['final_file'], job['caption'],
+                                           thumb_file if os.path.exists(thumb_file) else None, job.get('media'))
+    success = bool(job['message_id'])
+    if success:
+        upload_index.add(job['caption'], job['message_id'])
     return success, "تم بنجاح" if success else "فشل الرفع"
 
+def cleanup_job(job):
+    """تنظيف ملفات الجزء وطباعة النتيجة بعد خروجه من خط المعالجة"""
+    # ملفات الحلقة الفاشلة تبقى في مجلد العمل ليكمل منها التشغيل القادم
+    if job['success']:
+        for f in [job['temp_file'], job['final_file'], job['thumb_file']]:
+            try:
+                if os.path.exists(f):
+                    os.remove(f)
+            except:
+                pass
+    if job['success']:
+        print(f"✅ الجزء {job['num']} اكتمل")
+    else:
+        print(f"❌ الجزء {job['num']}: {job['message']}")
+
 async def main():
+    # ميزانية الوقت تبدأ مع التشغيل لتشمل وقت التجهيز
+    budget = TimeBudget("main3")
     print("="*50)
     print("🎬 رافع الأفلام إلى تليغرام (Selenium بشكل أساسي)")
     print("="*50)
@@ -421,26 +435,33 @@ async def main():
     print(f"🎥 الفيلم: {movie_name}")
     print(f"📀 عدد الأجزاء: {len(parts)}")
 
-    download_dir = f"downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    os.makedirs(download_dir, exist_ok=True)
+    # فهرس الحلقات المنشورة: حلقة موجودة في القناة لا تُعالج من جديد
+    global upload_index, video_uploader
+    upload_index = UploadIndex(TELEGRAM_CHANNEL)
+    video_uploader = OrderedUploader(app, TELEGRAM_CHANNEL)
+    await upload_index.build(app, movie_name)
 
-    successful = 0
-    failed = []
+    # سجل الحلقات ومجلد عمل ثابت: إعادة التشغيل تكمل من آخر مرحلة مكتملة
+    manifest = Manifest("main3")
+    download_dir = manifest.work_dir(movie_name)
 
+    jobs = []
     for idx, part in enumerate(parts, start=1):
         part['movie_name'] = movie_name
-        success, msg = await process_part(part, download_dir)
-        if success:
-            successful += 1
-            print(f"✅ الجزء {part.get('part', idx)} اكتمل")
-        else:
-            failed.append(part.get('part', idx))
-            print(f"❌ الجزء {part.get('part', idx)}: {msg}")
-
-        if idx < len(parts):
-            wait_time = random.randint(30, 60)
-            print(f"⏳ انتظار {wait_time} ثانية...")
-            await asyncio.sleep(wait_time)
+        part.setdefault('part', idx)
+        jobs.append(build_part_job(part, download_dir))
+
+    # خط معالجة: الجزء N+1 يُنزَّل بينما N يُضغط و N-1 يُرفع
+    pipeline = Pipeline([
+        Stage("extract", extract_stage, checkpoint=False),
+        Stage("download", download_stage),
+        Stage("transcode", transcode_stage),
+        Stage("upload", upload_stage, workers=UPLOAD_CONCURRENCY),
+    ], queue_size=1, on_done=cleanup_job, manifest=manifest, budget=budget)
+    results = await pipeline.run(upload_index.pending(jobs))
+
+    successful = sum(1 for job in results if job['success'])
+    failed = sorted(job['num'] for job in results if not job['success'])
 
     print(f"\n✅ الناجحة: {successful}/{len(parts)}")
     if failed:
@@ -451,6 +472,11 @@ async def main():
     except:
         pass
 
+    print_wait_summary()
+    telegram_limiter.print_summary()
+    host_scheduler.print_summary()
+    driver_pool.close_all()
+    shutdown_executors()
     await app.stop()
     print("🔌 تم قطع الاتصال بتليغرام")
 
@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+خط معالجة بالمراحل (استخراج ← تنزيل ← ضغط ← رفع) مع طوابير محدودة بين المراحل،
+بحيث تُنزَّل الحلقة N+1 بينما تُضغط الحلقة N وتُرفع الحلقة N-1.
+"""
+
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+from state import CACHE_DIR, load_json, save_json_atomic
+
+# علامة انتهاء العمل في الطوابير
+_DONE = object()
+
+# موعد انتهاء التشغيل (time.time())، يضبطه TimeBudget وتحترمه كل المراحل والمهل
+_deadline = None
+
+# إشارات الإلغاء السارية (threading.Event): إشارة المرحلة الجارية، تُضبط عند انتهاء مهلتها أو خروجها،
+# وما يضيفه cancel_scope داخلها (مثل سباق السيرفرات عند ظهور فائز). تنتقل مع run_io وcarry_context
+# إلى الخيوط فتتوقف أعمالها وانتظارات المتصفح وعمليات ffmpeg التابعة لها
+_cancel_events = contextvars.ContextVar('cancel_events', default=())
+# كل كم ثانية تفحص الحلقات الحاجبة إشارة الإلغاء
+CANCEL_POLL_SECONDS = 1.0
+
+
+class DeadlineExceeded(Exception):
+    """انتهى وقت التشغيل المسموح به"""
+
+
+def set_deadline(deadline):
+    global _deadline
+    _deadline = deadline
+
+
+def time_left():
+    """الثواني المتبقية حتى موعد الانتهاء، أو None إذا لم يُضبط موعد"""
+    if _deadline is None:
+        return None
+    return max(0.0, _deadline - time.time())
+
+
+def clamp_timeout(timeout):
+    """تقصير المهلة بحيث لا تتجاوز موعد انتهاء التشغيل"""
+    left = time_left()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def cancelled():
+    """هل انتهى وقت التشغيل أو أُلغيت المرحلة التي يعمل هذا الخيط لحسابها؟"""
+    if any(event.is_set() for event in _cancel_events.get()):
+        return True
+    return _deadline is not None and time.time() >= _deadline
+
+
+def check_deadline():
+    """للحلقات الطويلة داخل الخيوط والعمليات: رفع DeadlineExceeded عند انتهاء الوقت أو إلغاء المرحلة"""
+    if cancelled():
+        raise DeadlineExceeded("انتهى وقت التشغيل أو أُلغيت المرحلة")
+
+
+@contextmanager
+def cancel_scope(event):
+    """إضافة إشارة إلغاء إلى السياق الحالي، فيتوقف ما بداخل الكتلة عند ضبطها أو ضبط إشارة المرحلة"""
+    token = _cancel_events.set(_cancel_events.get() + (event,))
+    try:
+        yield event
+    finally:
+        _cancel_events.reset(token)
+
+
+def carry_context(func):
+    """
+    تغليف دالة ستُرسل إلى مجمع خيوط داخلي (مقاطع التنزيل، أجزاء الضغط، سباق السيرفرات)
+    لتحمل إشارة إلغاء المرحلة الحالية معها.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args):
+        return context.copy().run(func, *args)
+    return run
+
+
+def wait_process(proc, timeout=None):
+    """
+    انتظار عملية Popen من داخل خيط، مع إنهائها عند المهلة أو موعد الانتهاء أو إلغاء المرحلة.
+    يعيد returncode، أو None إذا أُنهيت العملية.
+    """
+    timeout = clamp_timeout(timeout)
+    end = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            return proc.wait(timeout=CANCEL_POLL_SECONDS)
+        except subprocess.TimeoutExpired:
+            if cancelled() or (end is not None and time.time() >= end):
+                proc.kill()
+                proc.wait()
+                return None
+
+
+def run_process(cmd, timeout=None):
+    """
+    نسخة حاجبة من run_subprocess للاستدعاء من الخيوط: تُنهي العملية فعلاً عند المهلة أو موعد الانتهاء
+    أو إلغاء المرحلة بدلاً من تركها تستهلك المعالج. تعيد (returncode, stdout, stderr) مثل run_subprocess.
+    """
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except Exception as e:
+        print(f"❌ فشل تشغيل {cmd[0]}: {e}")
+        return None, b'', b''
+    timeout = clamp_timeout(timeout)
+    end = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            stdout, stderr = proc.communicate(timeout=CANCEL_POLL_SECONDS)
+            return proc.returncode, stdout, stderr
+        except subprocess.TimeoutExpired:
+            if cancelled() or (end is not None and time.time() >= end):
+                print(f"⏰ إيقاف {cmd[0]}: انتهت المهلة أو أُلغيت المرحلة")
+                proc.kill()
+                proc.communicate()
+                return None, b'', b''
+
+
+class Stage:
+    """
+    مرحلة واحدة في خط المعالجة.
+    func: دالة (عادية أو async) تستقبل قاموس المهمة وتعيد (success, msg)
+    workers: عدد العمال المتوازيين في هذه المرحلة
+    checkpoint: تسجيل اكتمال المرحلة في السجل للاستئناف؛ False للمراحل التي لا يبقى ناتجها صالحاً
+    بين التشغيلات (مثل الاستخراج: روابط CDN الموقّعة تنتهي صلاحيتها)
+    التأدب مع المواقع (الفاصل بين طلبات نفس الموقع) يتولاه host_scheduler داخل دوال المراحل.
+    """
+
+    def __init__(self, name, func, workers=1, checkpoint=True):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.checkpoint = checkpoint
+
+
+# ===== طبقة التنفيذ: خيوط للعمليات الحاجبة، عمليات منفصلة لـ yt-dlp، وعمليات async لـ ffmpeg =====
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "8"))
+YTDLP_PROCESSES = int(os.environ.get("YTDLP_PROCESSES", "2"))
+
+_io_pool = None
+_process_pool = None
+_manager = None
+
+
+def get_io_pool():
+    """مجمع الخيوط المشترك لعمليات الإدخال/الإخراج الحاجبة (Selenium، requests، ...)"""
+    global _io_pool
+    if _io_pool is None:
+        _io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    return _io_pool
+
+
+def get_process_pool():
+    """مجمع العمليات المشترك لتشغيل yt-dlp بعيداً عن الـ GIL الخاص بحلقة الأحداث"""
+    global _process_pool
+    if _process_pool is None:
+        # forkserver وليس fork: العملية الحالية فيها خيوط ومتصفحات، ونسخها بـ fork قد يورث أقفالاً مغلقة.
+        # خادم forkserver يستورد السكريبت الرئيسي مرة واحدة (دون تشغيل main)، والعمليات تتفرع منه.
+        # موعد الانتهاء لا يُورث كما في fork، فيُمرَّر عبر initializer
+        _process_pool = ProcessPoolExecutor(max_workers=YTDLP_PROCESSES,
+                                            mp_context=multiprocessing.get_context("forkserver"),
+                                            initializer=set_deadline, initargs=(_deadline,))
+    return _process_pool
+
+
+def get_manager():
+    """
+    مدير multiprocessing مشترك لإنشاء إشارات إلغاء تراها عمليات المجمع:
+    threading.Event الخاصة بالمرحلة لا تعبر حدود العملية، وEvent المدير تُمرَّر كمعامل عادي
+    """
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context("forkserver").Manager()
+    return _manager
+
+
+async def run_io(func, *args):
+    """تشغيل دالة حاجبة في مجمع الخيوط، مع نقل إشارة إلغاء المرحلة الحالية إلى الخيط"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_io_pool(), functools.partial(context.run, func, *args))
+
+
+async def run_cpu(func, *args):
+    """تشغيل دالة في مجمع العمليات (يجب أن تكون الدالة ومعاملاتها قابلة للـ pickle)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), func, *args)
+
+
+async def run_subprocess(cmd, timeout=None):
+    """
+    تشغيل أمر خارجي (ffmpeg/ffprobe) كعملية asyncio دون حجب حلقة الأحداث.
+    يعيد (returncode, stdout, stderr)، أو (None, b'', b'') عند انتهاء المهلة أو الفشل.
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    except Exception as e:
+        print(f"❌ فشل تشغيل {cmd[0]}: {e}")
+        return None, b'', b''
+    timeout = clamp_timeout(timeout)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        return proc.returncode, stdout, stderr
+    except asyncio.TimeoutError:
+        print(f"⏰ انتهت مهلة {cmd[0]} ({timeout} ثانية)")
+        proc.kill()
+        await proc.wait()
+        return None, b'', b''
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+
+
+def ytdlp_download(url, ydl_opts, cancel=None):
+    """
+    تنزيل عبر yt-dlp داخل عملية منفصلة.
+    cancel: Event من get_manager() يضبطها الأب عند إلغاء المرحلة، فيتوقف التنزيل عند أول تقدم بعدها.
+    تعيد (success, error) بدلاً من رفع الاستثناء لأن استثناءات yt-dlp لا تُنقل دائماً بين العمليات.
+    """
+    import yt_dlp
+
+    def deadline_hook(_):
+        # الموعد مُرِّر من الأب عند بدء العملية (initializer في get_process_pool)
+        check_deadline()
+        if cancel is not None and cancel.is_set():
+            raise DeadlineExceeded("أُلغيت المرحلة")
+
+    ydl_opts = {**ydl_opts, 'progress_hooks': list(ydl_opts.get('progress_hooks', [])) + [deadline_hook]}
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([url])
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+
+def ytdlp_download_blocking(url, ydl_opts):
+    """
+    نسخة حاجبة من ytdlp_download للاستدعاء من داخل خيط (مثل حلقات تجربة السيرفرات، أو عبر run_io).
+    تنتظر النتيجة على دفعات وتنقل إلغاء المرحلة الحالية إلى العملية عبر Event المدير.
+    """
+    cancel = get_manager().Event()
+    future = get_process_pool().submit(ytdlp_download, url, ydl_opts, cancel)
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_SECONDS)
+        except FutureTimeoutError:
+            if cancelled() and not cancel.is_set():
+                cancel.set()
+
+
+def ytdlp_extract_info(url, ydl_opts):
+    """
+    استخراج معلومات الرابط عبر yt-dlp بدون تنزيل، داخل عملية منفصلة.
+    تعيد (info, error)؛ info بعد sanitize_info حتى يمكن نقله بين العمليات.
+    """
+    import yt_dlp
+
+    try:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info), None
+    except Exception as e:
+        return None, str(e)
+
+
+def ytdlp_extract_info_blocking(url, ydl_opts):
+    """
+    نسخة حاجبة من ytdlp_extract_info للاستدعاء من داخل خيط (مثل فحص السيرفرات في السباق).
+    الاستخراج لا يمر بـ progress_hooks، فعند إلغاء المرحلة يتوقف الانتظار فقط ويُلغى الطلب إن لم يبدأ.
+    """
+    future = get_process_pool().submit(ytdlp_extract_info, url, ydl_opts)
+    while True:
+        try:
+            return future.result(timeout=CANCEL_POLL_SECONDS)
+        except FutureTimeoutError:
+            if cancelled():
+                future.cancel()
+                return None, "أُلغيت المرحلة"
+
+
+def shutdown_executors():
+    """إغلاق المجمعات في نهاية التشغيل"""
+    global _io_pool, _process_pool, _manager
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=False, cancel_futures=True)
+        _io_pool = None
+    if _process_pool is not None:
+        if _deadline is not None and time.time() >= _deadline:
+            # عمليات yt-dlp التي ما زالت تعمل بعد الموعد لا فائدة منها: إنهاؤها بدلاً من انتظارها
+            for proc in list(getattr(_process_pool, '_processes', {}).values()):
+                proc.terminate()
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None
+
+
+async def call_maybe_async(func, *args):
+    """استدعاء دالة async مباشرة، أو تشغيل الدالة العادية في مجمع الخيوط حتى لا تحجب حلقة الأحداث"""
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args)
+    return await run_io(func, *args)
+
+
+class Pipeline:
+    """
+    يشغّل المراحل كسلسلة من العمال، بين كل مرحلتين طابور بحجم queue_size.
+    المرحلة الأولى تسحب المهام من المُكرِّر عند الحاجة فقط، لذا يمكن للمستدعي
+    إيقاف القبول (مثلاً عند تجاوز الوقت) عبر مُولِّد.
+    on_done: دالة تُستدعى مرة واحدة لكل مهمة عند خروجها من الخط (نجاحاً أو فشلاً).
+    """
+
+    def __init__(self, stages, queue_size=1, on_done=None, budget=None, manifest=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_done = on_done
+        self.budget = budget
+        self.manifest = manifest
+
+    def _resumable(self, jobs):
+        """تخطي الحلقات المرفوعة سابقاً (بحث في القاموس فقط، فلا يحجب حلقة الأحداث)"""
+        last = self.stages[-1].name
+        for job in jobs:
+            if self.manifest.is_done(job['caption'], last):
+                print(f"⏭️ {job['caption']}: مكتملة في تشغيل سابق")
+                continue
+            yield job
+
+    async def _resume(self, job):
+        """تحديد أول مرحلة غير مكتملة؛ يعمل في مجمع الخيوط لأن التحقق يحسب sha256 لملفات كبيرة"""
+        names = [stage.name if stage.checkpoint else None for stage in self.stages]
+        job['resume_from'] = await run_io(self.manifest.resume, job, names)
+        if job['resume_from']:
+            print(f"♻️ {job['caption']}: استكمال من مرحلة {self.stages[job['resume_from']].name}")
+
+    async def run(self, jobs):
+        if self.manifest:
+            jobs = self._resumable(jobs)
+        if self.budget:
+            jobs = self.budget.admit(jobs, [stage.name for stage in self.stages])
+        jobs_iter = iter(jobs)
+        queues = [None] + [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages[1:]]
+        finished = []
+
+        async def finish(job, success, msg):
+            job['success'] = success
+            job['message'] = msg
+            finished.append(job)
+            if self.budget:
+                self.budget.record(job)
+            if self.on_done:
+                try:
+                    await call_maybe_async(self.on_done, job)
+                except Exception as e:
+                    print(f"⚠️ خطأ في معالجة نهاية المهمة: {e}")
+
+        async def next_job(idx):
+            if idx == 0:
+                try:
+                    return next(jobs_iter)
+                except StopIteration:
+                    return _DONE
+            return await queues[idx].get()
+
+        async def worker(idx):
+            stage = self.stages[idx]
+            last = idx == len(self.stages) - 1
+            while True:
+                job = await next_job(idx)
+                if job is _DONE:
+                    break
+                if idx == 0 and self.manifest:
+                    await self._resume(job)
+
+                if idx < job.get('resume_from', 0):
+                    # مرحلة مكتملة في تشغيل سابق
+                    if last:
+                        await finish(job, True, "مكتملة سابقاً")
+                    else:
+                        await queues[idx + 1].put(job)
+                    continue
+
+                # زمن المرحلة يشمل انتظار التأدب مع الموقع لأنه جزء من تكلفة الحلقة في ميزانية الوقت
+                stage_start = time.time()
+
+                limit = self.budget.stage_time_left(stage.name, last) if self.budget else None
+                if limit is not None and limit <= 0:
+                    success, msg = False, f"⏰ {stage.name}: لم يعد الوقت المتبقي يكفي لهذه المرحلة"
+                else:
+                    # wait_for يترك الخيوط تعمل عند انتهاء المهلة، فالإشارة توقف ما بقي منها فعلاً
+                    with cancel_scope(threading.Event()) as cancel:
+                        try:
+                            success, msg = await asyncio.wait_for(call_maybe_async(stage.func, job), timeout=limit)
+                        except asyncio.TimeoutError:
+                            success, msg = False, f"⏰ {stage.name}: أُلغيت عند موعد انتهاء التشغيل"
+                        except Exception as e:
+                            success, msg = False, f"{stage.name}: {e}"
+                        finally:
+                            cancel.set()
+                job.setdefault('timings', {})[stage.name] = time.time() - stage_start
+                if self.manifest:
+                    if not success:
+                        await run_io(self.manifest.discard_stages, job['caption'],
+                                     [later.name for later in self.stages[idx:]])
+                    elif stage.checkpoint:
+                        await run_io(self.manifest.complete, job, stage.name)
+
+                if not success:
+                    await finish(job, False, msg)
+                elif last:
+                    await finish(job, True, msg)
+                else:
+                    await queues[idx + 1].put(job)
+
+        async def run_stage(idx):
+            await asyncio.gather(*(worker(idx) for _ in range(self.stages[idx].workers)))
+            if idx + 1 < len(self.stages):
+                for _ in range(self.stages[idx + 1].workers):
+                    await queues[idx + 1].put(_DONE)
+
+        await asyncio.gather(*(run_stage(idx) for idx in range(len(self.stages))))
+        return finished
+
+
+# ===== ميزانية الوقت: قبول الحلقات حسب الوقت المتبقي بدلاً من حد ثابت لعدد الحلقات =====
+# مهلة الـ workflow هي 180 دقيقة؛ نترك ~10 دقائق للتجهيز والتنظيف
+RUN_BUDGET_MINUTES = float(os.environ.get("RUN_BUDGET_MINUTES", "170"))
+BUDGET_HEADROOM_SECONDS = int(os.environ.get("BUDGET_HEADROOM_SECONDS", "300"))
+# تقدير متحفظ لكل مرحلة قبل أن تتوفر أي قياسات (ثوانٍ)
+DEFAULT_STAGE_SECONDS = {'extract': 90, 'download': 300, 'transcode': 300, 'upload': 180, 'episode': 900}
+# وزن القياس الجديد في المتوسط المتحرك
+TIMING_ALPHA = 0.3
+
+
+class TimeBudget:
+    """
+    يقدّر تكلفة كل حلقة من أزمنة المراحل المقاسة (في هذا التشغيل وفي التشغيلات السابقة)
+    ولا يقبل حلقة جديدة إلا إذا أمكن إنهاؤها مع كل ما قبلها قبل انتهاء الميزانية،
+    مع هامش يكفي لرفع ما تم ضغطه.
+
+    بما أن المراحل تعمل بالتوازي، فكل حلقة إضافية تكلّف زمن أبطأ مرحلة (عنق الزجاجة)،
+    وآخر حلقة تحتاج فوق ذلك لعبور باقي المراحل.
+    """
+
+    def __init__(self, name, budget_seconds=None, headroom=BUDGET_HEADROOM_SECONDS, path=None, start_time=None):
+        self.budget_seconds = budget_seconds if budget_seconds is not None else RUN_BUDGET_MINUTES * 60
+        self.headroom = headroom
+        self.start_time = start_time or time.time()
+        self.path = path or os.path.join(CACHE_DIR, f"stage_timings_{name}.json")
+        self.averages = self._load()
+        self.admitted = 0
+        self.done = 0
+        self.deadline = self.start_time + self.budget_seconds
+        set_deadline(self.deadline)
+
+    def _load(self):
+        return load_json(self.path, "أزمنة المراحل")
+
+    def save(self):
+        save_json_atomic(self.path, self.averages, "أزمنة المراحل")
+
+    def record(self, job):
+        """
+        تحديث متوسط كل مرحلة من أزمنة حلقة خرجت من الخط.
+        أزمنة الحلقات الفاشلة تُحسب أيضاً لأنها استهلكت وقت العامل فعلاً.
+        """
+        self.done += 1
+        for stage, seconds in job.get('timings', {}).items():
+            old = self.averages.get(stage)
+            self.averages[stage] = seconds if old is None else old + TIMING_ALPHA * (seconds - old)
+        self.save()
+
+    def stage_estimate(self, stage):
+        return self.averages.get(stage, DEFAULT_STAGE_SECONDS.get(stage, 120))
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def remaining(self):
+        return self.budget_seconds - self.elapsed()
+
+    def stage_time_left(self, stage, last):
+        """
+        الوقت المسموح لمرحلة على وشك البدء: الرفع (المرحلة الأخيرة) يحصل على كل الوقت المتبقي
+        لأن الحلقة شبه مكتملة، وباقي المراحل تتوقف قبل ذلك بهامش الرفع.
+        يعيد 0 إذا كان الوقت المتاح لمرحلة غير أخيرة أقل من تقديرها المعتاد، فلا فائدة من بدئها.
+        """
+        if last:
+            return max(0.0, self.remaining())
+        left = self.remaining() - self.headroom
+        return left if left >= self.stage_estimate(stage) else 0
+
+    def needed_for(self, in_flight, stages):
+        """الوقت اللازم لإنهاء in_flight حلقة موجودة في الخط"""
+        estimates = [self.stage_estimate(stage) for stage in stages]
+        bottleneck = max(estimates)
+        return in_flight * bottleneck + sum(estimates) - bottleneck
+
+    def admit(self, jobs, stages):
+        """مُولِّد يمرر الحلقات طالما يتسع الوقت المتبقي لها ولما قبلها"""
+        for job in jobs:
+            in_flight = self.admitted - self.done + 1
+            needed = self.needed_for(in_flight, stages) + self.headroom
+            remaining = self.remaining()
+            if needed > remaining:
+                print(f"⏰ إيقاف قبول الحلقات: المتبقي {remaining/60:.1f} دقيقة، "
+                      f"والمطلوب لإنهاء {in_flight} حلقة ~{needed/60:.1f} دقيقة")
+                return
+            print(f"⏳ الوقت المنقضي: {self.elapsed()/60:.1f} دقيقة | المتبقي: {remaining/60:.1f} دقيقة "
+                  f"| تقدير الحلقة: {self.needed_for(1, stages)/60:.1f} دقيقة")
+            self.admitted += 1
+            yield job
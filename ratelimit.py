@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+تنظيم معدل الطلبات:
+- منظّم مشترك لاستدعاءات تليغرام (إرسال، نسخ، حذف، بحث): دلو رموز (token bucket)
+  يتعلم المعدل المسموح من قيم FloodWait التي يراها، بدلاً من انتظار ثابت متشائم.
+- مجدول تأدب لكل موقع: لا يؤخر طلب صفحة إلا إذا زِير نفس الموقع قبل قليل.
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from state import CACHE_DIR, load_json, save_json_atomic
+
+# المعدل الابتدائي (طلب/ثانية) قبل أن نتعلم شيئاً، وحدوده
+TELEGRAM_RATE = float(os.environ.get("TELEGRAM_RATE", "0.5"))
+TELEGRAM_MIN_RATE = 0.02
+TELEGRAM_MAX_RATE = 2.0
+TELEGRAM_BURST = int(os.environ.get("TELEGRAM_BURST", "3"))
+# كل نجاح يرفع المعدل قليلاً، وكل FloodWait يخفضه للنصف (AIMD)
+RATE_INCREASE = 0.01
+RATE_DECREASE = 0.5
+# نبقى تحت المعدل الذي سبب آخر FloodWait بهذه النسبة
+FLOOD_SAFETY = 0.9
+
+
+class TokenBucket:
+    """
+    دلو رموز غير متزامن: acquire() ينتظر حتى يتوفر رمز، ولا يسمح بأي طلب قبل انتهاء آخر FloodWait.
+    on_flood_wait() يخفض المعدل ويسجل سقفاً لا نتجاوزه، وon_success() يقترب من السقف تدريجياً.
+    المعدل المتعلَّم يُحفظ في .cache ليبدأ التشغيل القادم منه.
+    """
+
+    def __init__(self, name, rate=TELEGRAM_RATE, burst=TELEGRAM_BURST, path=None):
+        self.name = name
+        self.burst = burst
+        self.path = path or os.path.join(CACHE_DIR, f"rate_{name}.json")
+        saved = self._load()
+        self.rate = saved.get('rate', rate)
+        self.ceiling = saved.get('ceiling', TELEGRAM_MAX_RATE)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.flood_waits = 0
+        self.waited = 0.0
+        self._lock = None
+
+    def _load(self):
+        return load_json(self.path, f"معدل {self.name}")
+
+    def _save(self):
+        save_json_atomic(self.path, {'rate': self.rate, 'ceiling': self.ceiling}, f"معدل {self.name}")
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # القفل يُنشأ داخل حلقة الأحداث (asyncio.Lock في 3.10 يرتبط بالحلقة عند الإنشاء)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+    def on_flood_wait(self, seconds):
+        """تليغرام طلب الانتظار: إيقاف كل الطلبات حتى انتهاء المدة، وخفض المعدل وسقفه"""
+        now = time.monotonic()
+        self.flood_waits += 1
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.ceiling = max(TELEGRAM_MIN_RATE, min(self.ceiling, self.rate * FLOOD_SAFETY))
+        self.rate = max(TELEGRAM_MIN_RATE, min(self.ceiling, self.rate * RATE_DECREASE))
+        self.tokens = 0
+        print(f"🐢 [{self.name}] FloodWait {seconds} ثانية ← المعدل {self.rate:.3f} طلب/ثانية")
+        self._save()
+
+    def on_success(self):
+        # السقف نفسه يرتفع ببطء شديد حتى لا يبقى خفضٌ قديم للأبد
+        self.ceiling = min(TELEGRAM_MAX_RATE, self.ceiling + RATE_INCREASE / 10)
+        self.rate = min(self.ceiling, self.rate + RATE_INCREASE)
+
+    def print_summary(self):
+        print(f"📶 [{self.name}] المعدل النهائي {self.rate:.3f} طلب/ثانية (سقف {self.ceiling:.3f})، "
+              f"{self.flood_waits} FloodWait، انتظار {self.waited:.0f} ثانية")
+        self._save()
+
+
+# منظّم واحد لكل استدعاءات تليغرام في العملية
+telegram_limiter = TokenBucket("telegram")
+
+
+# ===== مجدول التأدب لكل موقع =====
+# أقل فاصل بين طلبين لصفحات نفس الموقع (ثوانٍ)، مع عشوائية حتى لا يكون النمط آلياً
+HOST_MIN_INTERVAL = float(os.environ.get("HOST_MIN_INTERVAL", "30"))
+HOST_JITTER = 0.3
+# فواصل خاصة ببعض المواقع، ويمكن تجاوزها عبر HOST_INTERVALS="larozaa.xyz=45,o.3seq.cam=20"
+HOST_INTERVALS = {
+    'larozaa.xyz': 40,
+}
+for _item in os.environ.get("HOST_INTERVALS", "").split(','):
+    if '=' in _item:
+        _host, _seconds = _item.split('=', 1)
+        HOST_INTERVALS[_host.strip().lower()] = float(_seconds)
+
+
+def _host_of(url):
+    host = (urlparse(url).hostname or url or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+class HostScheduler:
+    """
+    يحجز لكل طلب موعداً في جدول موقعه: أول طلب لموقع يمر فوراً، والطلب التالي لنفس الموقع
+    ينتظر حتى يمر الفاصل منذ سابقه. الطلبات لمواقع مختلفة لا تنتظر بعضها، وباقي مراحل
+    خط المعالجة (تنزيل، ضغط، رفع) تستمر أثناء الانتظار.
+    آمن للخيوط لأن مراحل الاستخراج تعمل داخل مجمع الخيوط.
+    """
+
+    def __init__(self, default_interval=HOST_MIN_INTERVAL, intervals=None):
+        self.default_interval = default_interval
+        self.intervals = HOST_INTERVALS if intervals is None else intervals
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+        self.waited = {}
+
+    def interval(self, host):
+        for key, seconds in self.intervals.items():
+            if host == key or host.endswith('.' + key):
+                return seconds
+        return self.default_interval
+
+    def reserve(self, url):
+        """حجز موعد للطلب وإرجاع الثواني المتبقية حتى الموعد (0 = الآن)"""
+        host = _host_of(url)
+        now = time.time()
+        with self._lock:
+            slot = max(now, self._next_allowed.get(host, 0))
+            spacing = self.interval(host) * (1 + random.uniform(0, HOST_JITTER))
+            self._next_allowed[host] = slot + spacing
+            delay = slot - now
+            if delay > 0:
+                self.waited[host] = self.waited.get(host, 0) + delay
+        if delay > 0:
+            print(f"⏳ [{host}] انتظار {delay:.0f} ثانية احتراماً للموقع")
+        return delay
+
+    def wait(self, url):
+        """نسخة حاجبة للخيوط (مراحل الاستخراج وscript.py)"""
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self, url):
+        delay = self.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def print_summary(self):
+        if self.waited:
+            rows = ", ".join(f"{host}: {seconds:.0f}s" for host, seconds in sorted(self.waited.items()))
+            print(f"🕰️ انتظار التأدب لكل موقع: {rows}")
+
+
+host_scheduler = HostScheduler()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+أدوات حلّ روابط الفيديو من سيرفرات المشاهدة (mirrors).
+"""
+
+import csv
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+from downloader import estimate_media_size
+from pipeline import cancel_scope, carry_context
+from state import CACHE_DIR, load_json, save_json_atomic
+
+# عدد السيرفرات التي تُفحص في نفس الوقت
+RACE_WORKERS = int(os.environ.get("RACE_WORKERS", "3"))
+# بعد أول سيرفر صالح: مهلة إضافية لجمع سيرفرات أخرى ومقارنة أحجامها
+MIRROR_GRACE_SECONDS = float(os.environ.get("MIRROR_GRACE_SECONDS", "5"))
+# الأحجام الأصغر من هذا غالباً إعلانات أو مقاطع تجريبية
+MIRROR_MIN_SIZE_MB = int(os.environ.get("MIRROR_MIN_SIZE_MB", "20"))
+
+# مجلد الحالة المحفوظة بين التشغيلات (يُحفظ في GitHub Actions عبر actions/cache)
+# مدة صلاحية الرابط المحلول قبل إعادة الاستخراج (بالثواني)
+URL_CACHE_TTL = int(os.environ.get("URL_CACHE_TTL", "7200"))
+
+# لوحة صحة السيرفرات: عمر النصف لتأثير الملاحظات القديمة، وتخطي السيرفر بعد عدد من الإخفاقات المتتالية
+HOST_HEALTH_HALF_LIFE_HOURS = float(os.environ.get("HOST_HEALTH_HALF_LIFE_HOURS", "24"))
+HOST_SKIP_AFTER_FAILURES = int(os.environ.get("HOST_SKIP_AFTER_FAILURES", "3"))
+HOST_SKIP_COOLDOWN_HOURS = float(os.environ.get("HOST_SKIP_COOLDOWN_HOURS", "6"))
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def race_collect(candidates, probe, grace=0, max_workers=RACE_WORKERS):
+    """
+    فحص جميع السيرفرات بالتوازي وجمع النتائج الصالحة.
+    probe(candidate, cancel_event) تعيد النتيجة أو None. الفحص يعمل داخل cancel_scope(cancel_event)،
+    فانتظارات المتصفح (wait_for والتقاط الشبكة) وعمليات ffmpeg تتوقف فور انتهاء السباق ويعود المتصفح
+    للمجمع، ويُفضّل أن تتحقق probe أيضاً من cancel_event قبل الخطوات المكلفة.
+    بعد أول نتيجة صالحة يُنتظر grace ثانية إضافية لجمع سيرفرات أخرى للمقارنة (0 = أول نتيجة فقط).
+    يعيد قائمة [(candidate, result)] بترتيب الوصول.
+    تُفحص السيرفرات بترتيب القائمة، لذا يُفضّل تمريرها عبر host_health.order أولاً.
+    """
+    if not candidates:
+        return []
+
+    cancel = threading.Event()
+
+    def timed_probe(candidate):
+        # تسجيل نتيجة وزمن الفحص في لوحة صحة السيرفرات (الفحوصات الملغاة لا تُحسب)
+        start = time.time()
+        try:
+            with cancel_scope(cancel):
+                result = probe(candidate, cancel)
+        except Exception:
+            if not cancel.is_set():
+                host_health.record_resolve(candidate, False, time.time() - start)
+            raise
+        if result or not cancel.is_set():
+            host_health.record_resolve(candidate, bool(result), time.time() - start)
+        return result
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(candidates))),
+                                  thread_name_prefix="race")
+    # الفحوصات تحمل إشارة إلغاء المرحلة، فتتوقف إذا انتهت مهلة مرحلة الاستخراج
+    futures = {executor.submit(carry_context(timed_probe), candidate): candidate for candidate in candidates}
+    pending = set(futures)
+    results = []
+    deadline = None
+    try:
+        while pending:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"⚠️ فشل فحص السيرفر {futures[future]}: {e}")
+                    continue
+                if result:
+                    results.append((futures[future], result))
+            if results:
+                if grace <= 0:
+                    break
+                if deadline is None:
+                    deadline = time.time() + grace
+        return results
+    finally:
+        # إلغاء الفحوصات المتبقية دون انتظارها
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def race_first(candidates, probe, max_workers=RACE_WORKERS):
+    """
+    فحص جميع السيرفرات بالتوازي وإرجاع أول نتيجة صالحة.
+    يعيد (candidate, result) أو (None, None) إذا فشلت جميع السيرفرات.
+    """
+    results = race_collect(candidates, probe, grace=0, max_workers=max_workers)
+    return results[0] if results else (None, None)
+
+
+def rank_mirrors_by_size(results, media_of):
+    """
+    ترتيب السيرفرات الناجحة حسب الحجم المتوقع للتنزيل (الأصغر أولاً)، بما أن كلها تُضغط إلى نفس الدقة.
+    media_of(result) تعيد (video_url, headers). الأحجام الأصغر من MIRROR_MIN_SIZE_MB
+    (إعلانات أو مقاطع قصيرة) والأحجام غير المعروفة تأتي بعد الأحجام المعروفة.
+    """
+    if len(results) < 2:
+        return list(results)
+    with ThreadPoolExecutor(max_workers=len(results), thread_name_prefix="size") as executor:
+        sizes = list(executor.map(lambda item: estimate_media_size(*media_of(item[1])), results))
+
+    min_size = MIRROR_MIN_SIZE_MB * 1024 * 1024
+    def sort_key(item):
+        size, index = item
+        if size and size >= min_size:
+            return (0, size, index)
+        return (1, 0, index)
+
+    ranked = sorted(zip(sizes, range(len(results))), key=sort_key)
+    for size, index in ranked:
+        size_text = f"{size / (1024 * 1024):.0f}MB" if size else "غير معروف"
+        print(f"📏 {host_key(results[index][0])}: {size_text}")
+    return [results[index] for _, index in ranked]
+
+
+def validate_media_url(url, referer=None, headers=None, timeout=10):
+    """
+    فحص سريع لرابط الفيديو بطلب HEAD (أو GET لأول بايت إذا رفض السيرفر HEAD).
+    يعيد رمز حالة HTTP، أو None عند فشل الاتصال.
+    """
+    request_headers = {'User-Agent': USER_AGENT}
+    request_headers.update(headers or {})
+    if referer:
+        request_headers['Referer'] = referer
+
+    for method, extra in (('HEAD', {}), ('GET', {'Range': 'bytes=0-0'})):
+        request = urllib.request.Request(url, method=method, headers={**request_headers, **extra})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            if method == 'HEAD' and e.code in (405, 501):
+                continue
+            return e.code
+        except Exception:
+            return None
+    return None
+
+
+class ResolvedUrlCache:
+    """
+    ذاكرة على القرص تربط رابط صفحة الحلقة برابط الفيديو المحلول (مع referer والهيدرز).
+    كل مدخل له مدة صلاحية، ويُفحص بطلب خفيف قبل استخدامه، ويُحذف عند 403/404/410.
+    """
+
+    def __init__(self, path=None, ttl=URL_CACHE_TTL):
+        self.path = path or os.path.join(CACHE_DIR, "resolved_urls.json")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        return load_json(self.path, "ذاكرة الروابط")
+
+    def _save(self):
+        save_json_atomic(self.path, self._entries, "ذاكرة الروابط")
+
+    def get(self, page_url, validate=True):
+        """يعيد {'video_url', 'referer', 'headers', 'resolved_at'} إذا كان الرابط ما زال صالحاً، وإلا None"""
+        with self._lock:
+            entry = self._entries.get(page_url)
+        if not entry:
+            return None
+        if time.time() - entry.get('resolved_at', 0) > self.ttl:
+            self.evict(page_url)
+            return None
+        if validate:
+            status = validate_media_url(entry['video_url'], entry.get('referer'), entry.get('headers'))
+            if status in (403, 404, 410):
+                print(f"🗑️ الرابط المحفوظ لم يعد صالحاً ({status})")
+                self.evict(page_url)
+                return None
+            if status is None or status >= 400:
+                return None
+        print(f"♻️ استخدام الرابط المحفوظ: {entry['video_url'][:100]}...")
+        return entry
+
+    def put(self, page_url, video_url, referer=None, headers=None):
+        with self._lock:
+            self._entries[page_url] = {
+                'video_url': video_url,
+                'referer': referer,
+                'headers': headers or {},
+                'resolved_at': time.time(),
+            }
+            self._save()
+
+    def evict(self, page_url):
+        with self._lock:
+            if self._entries.pop(page_url, None) is not None:
+                self._save()
+
+
+# ذاكرة مشتركة لكل السكريبت
+url_cache = ResolvedUrlCache()
+
+
+def use_cached_url(job, page_url):
+    """
+    ملء video_url و referer و headers في المهمة من الذاكرة إن وُجد رابط صالح لهذه الصفحة.
+    from_cache يخبر مرحلة التنزيل أن فشل الرابط يستدعي إعادة الاستخراج وليس إفشال الحلقة.
+    """
+    job['cache_key'] = page_url
+    job['from_cache'] = False
+    entry = url_cache.get(page_url)
+    if not entry:
+        return False
+    job['video_url'] = entry['video_url']
+    job['referer'] = entry.get('referer')
+    job['headers'] = entry.get('headers') or {}
+    job['from_cache'] = True
+    return True
+
+
+def host_key(url):
+    """اسم السيرفر بدون النطاق الفرعي واللاحقة (m180.uqload.io ← uqload) ليجمع روابط الـ CDN مع صفحة الـ embed"""
+    host = urlparse(url or '').hostname or ''
+    labels = host.split('.')
+    return labels[-2] if len(labels) >= 2 else host
+
+
+class HostScoreboard:
+    """
+    لوحة صحة السيرفرات محفوظة بين التشغيلات: نسبة النجاح، زمن الاستخراج، وسرعة التنزيل لكل سيرفر.
+    الملاحظات القديمة تتلاشى أُسّياً (عمر النصف HOST_HEALTH_HALF_LIFE_HOURS).
+    """
+
+    def __init__(self, path=None, half_life_hours=HOST_HEALTH_HALF_LIFE_HOURS):
+        self.path = path or os.path.join(CACHE_DIR, "host_health.json")
+        self.half_life = half_life_hours * 3600
+        self._lock = threading.Lock()
+        self._hosts = self._load()
+
+    def _load(self):
+        return load_json(self.path, "لوحة صحة السيرفرات")
+
+    def _save(self):
+        save_json_atomic(self.path, self._hosts, "لوحة صحة السيرفرات")
+
+    def _entry(self, host, now):
+        """المدخل بعد تطبيق التلاشي على الأوزان حتى اللحظة now"""
+        entry = self._hosts.setdefault(host, {
+            'successes': 0.0, 'failures': 0.0, 'resolve_seconds': None, 'mbps': None,
+            'consecutive_failures': 0, 'last_failure': 0, 'updated': now,
+        })
+        factor = 0.5 ** ((now - entry['updated']) / self.half_life) if self.half_life > 0 else 1
+        entry['successes'] *= factor
+        entry['failures'] *= factor
+        entry['updated'] = now
+        return entry
+
+    @staticmethod
+    def _ewma(old, value, weight=0.3):
+        return value if old is None else old + weight * (value - old)
+
+    def _record_outcome(self, entry, ok, now):
+        if ok:
+            entry['successes'] += 1
+            entry['consecutive_failures'] = 0
+        else:
+            entry['failures'] += 1
+            entry['consecutive_failures'] += 1
+            entry['last_failure'] = now
+
+    def record_resolve(self, url, ok, seconds):
+        """نتيجة استخراج رابط من السيرفر وزمنها"""
+        now = time.time()
+        with self._lock:
+            entry = self._entry(host_key(url), now)
+            self._record_outcome(entry, ok, now)
+            if ok:
+                entry['resolve_seconds'] = self._ewma(entry['resolve_seconds'], seconds)
+            self._save()
+
+    def record_download(self, url, ok, size_bytes=0, seconds=0):
+        """نتيجة تنزيل من السيرفر وسرعته"""
+        now = time.time()
+        with self._lock:
+            entry = self._entry(host_key(url), now)
+            self._record_outcome(entry, ok, now)
+            if ok and size_bytes and seconds > 0:
+                entry['mbps'] = self._ewma(entry['mbps'], size_bytes * 8 / seconds / 1e6)
+            self._save()
+
+    def record_download_file(self, url, ok, path, started):
+        """تسجيل تنزيل انتهى في الملف path وبدأ عند started"""
+        size_bytes = os.path.getsize(path) if ok and os.path.exists(path) else 0
+        self.record_download(url, ok, size_bytes, time.time() - started)
+
+    def score(self, url):
+        """نسبة النجاح (مع افتراض مسبق 1 نجاح/1 فشل للسيرفرات الجديدة)"""
+        with self._lock:
+            entry = self._hosts.get(host_key(url))
+            if not entry:
+                return 0.5
+            entry = self._entry(host_key(url), time.time())
+            return (entry['successes'] + 1) / (entry['successes'] + entry['failures'] + 2)
+
+    def is_failing(self, url):
+        """السيرفر فشل عدة مرات متتالية مؤخراً"""
+        with self._lock:
+            entry = self._hosts.get(host_key(url))
+        if not entry:
+            return False
+        return (entry['consecutive_failures'] >= HOST_SKIP_AFTER_FAILURES and
+                time.time() - entry['last_failure'] < HOST_SKIP_COOLDOWN_HOURS * 3600)
+
+    def order(self, urls):
+        """
+        ترتيب السيرفرات حسب النتيجة (ثم السرعة)، مع تخطي السيرفرات المتعطلة حالياً.
+        إذا كانت كل السيرفرات متعطلة تُعاد كلها مرتبة بدلاً من قائمة فارغة.
+        """
+        def sort_key(url):
+            with self._lock:
+                entry = self._hosts.get(host_key(url), {})
+            return (-round(self.score(url), 2), -(entry.get('mbps') or 0), entry.get('resolve_seconds') or 0)
+
+        ordered = sorted(urls, key=sort_key)
+        healthy = [url for url in ordered if not self.is_failing(url)]
+        skipped = len(ordered) - len(healthy)
+        if healthy and skipped:
+            print(f"⏭️ تخطي {skipped} سيرفر متعطل حالياً")
+            return healthy
+        return ordered
+
+    def rows(self):
+        """صفوف اللوحة مرتبة حسب النتيجة، للتصدير أو الطباعة"""
+        now = time.time()
+        with self._lock:
+            hosts = list(self._hosts)
+            rows = []
+            for host in hosts:
+                entry = self._entry(host, now)
+                rows.append({
+                    'host': host,
+                    'score': round((entry['successes'] + 1) / (entry['successes'] + entry['failures'] + 2), 3),
+                    'successes': round(entry['successes'], 2),
+                    'failures': round(entry['failures'], 2),
+                    'consecutive_failures': entry['consecutive_failures'],
+                    'resolve_seconds': round(entry['resolve_seconds'], 1) if entry['resolve_seconds'] is not None else None,
+                    'mbps': round(entry['mbps'], 2) if entry['mbps'] is not None else None,
+                })
+        return sorted(rows, key=lambda row: -row['score'])
+
+    def export_csv(self, path):
+        rows = self.rows()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['host', 'score', 'successes', 'failures',
+                                                   'consecutive_failures', 'resolve_seconds', 'mbps'])
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def print_summary(self):
+        rows = self.rows()
+        if not rows:
+            return
+        print("\n🩺 صحة السيرفرات:")
+        for row in rows:
+            resolve = f"{row['resolve_seconds']}s" if row['resolve_seconds'] is not None else '-'
+            speed = f"{row['mbps']}Mbps" if row['mbps'] is not None else '-'
+            print(f"   {row['host']:<16} نتيجة: {row['score']:.2f}  نجاح: {row['successes']:<6} فشل: {row['failures']:<6} "
+                  f"استخراج: {resolve}  سرعة: {speed}")
+
+
+# لوحة مشتركة لكل السكريبت
+host_health = HostScoreboard()
+
+
+if __name__ == '__main__':
+    # تصدير اللوحة: python resolver.py [host_health.csv]
+    if len(sys.argv) > 1:
+        print(f"✅ تم التصدير إلى {host_health.export_csv(sys.argv[1])}")
+    else:
+        host_health.print_summary()
@@ -10,7 +10,6 @@ import time
 import json
 import subprocess
 import shutil
-import random
 import re
 import base64
 from datetime import datetime
@@ -37,36 +36,15 @@ install_requirements()
 
 import requests
 import yt_dlp
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
 import json5
 
-# ===== إعداد Selenium =====
-def setup_selenium():
-    chrome_options = Options()
-    chrome_options.add_argument('--headless')
-    chrome_options.add_argument('--no-sandbox')
-    chrome_options.add_argument('--disable-dev-shm-usage')
-    chrome_options.add_argument('--disable-gpu')
-    chrome_options.add_argument('--window-size=1920,1080')
-    chrome_options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-    chrome_options.add_experimental_option('useAutomationExtension', False)
-    chrome_options.add_argument('--disable-extensions')
-    chrome_options.add_argument('--disable-notifications')
-    chrome_options.add_argument('--ignore-certificate-errors')
-    
-    try:
-        service = Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-        return driver
-    except Exception as e:
-        print(f"❌ فشل إعداد Selenium: {e}")
-        return None
+from browser import driver_pool, capture_media_request, wait_for, page_source_matches, print_wait_summary, NETWORK_CAPTURE
+from resolver import race_collect, rank_mirrors_by_size, url_cache, host_health, MIRROR_GRACE_SECONDS
+from downloader import download_file, download_hls, discard_hls_segments, is_hls_url, HLS_WORKERS, ytdlp_format_options
+from transcode import transcode_240p
+from pipeline import TimeBudget, cancelled
+from state import Manifest
+from ratelimit import host_scheduler
 
 # ===== استخراج PostData باستخدام json5 =====
 def extract_post_data(html):
@@ -117,6 +95,8 @@ def extract_post_data(html):
         return None
 
 def get_page_html(url):
+    # فاصل التأدب فقط إذا زِير نفس الموقع قبل قليل (الحلقات المحلولة من الذاكرة لا تفتح الصفحة أصلاً)
+    host_scheduler.wait(url)
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Accept-Language': 'ar-SA,ar;q=0.9,en;q=0.8',
@@ -152,84 +132,84 @@ def extract_server_urls(post_data):
     return urls
 
 # ===== التنزيل باستخدام requests =====
-def download_with_requests(url, output_path, referer):
-    """تنزيل الفيديو مباشرة باستخدام requests مع دعم التقدم."""
+def download_with_requests(url, output_path, referer, headers=None):
+    """تنزيل الفيديو مباشرة عبر عدة اتصالات Range متوازية (أو اتصال واحد إذا لم يدعمها السيرفر)، وبث HLS بمقاطع متوازية."""
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Referer': referer,
         'Accept-Language': 'ar-SA,ar;q=0.9,en;q=0.8',
+        # هيدرز طلب المشغّل الملتقطة (Cookie، Origin، ...) كما أرسلها المتصفح
+        **(headers or {}),
+        'Referer': referer,
     }
-    try:
-        with requests.get(url, headers=headers, stream=True, timeout=60) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get('content-length', 0))
-            block_size = 8192
-            downloaded = 0
-            with open(output_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=block_size):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        if total_size > 0:
-                            percent = (downloaded / total_size) * 100
-                            print(f"\r⏳ جاري التحميل: {percent:.1f}%", end='')
-            print()
-        return os.path.exists(output_path)
-    except Exception as e:
-        print(f"❌ فشل التنزيل عبر requests: {e}")
-        return False
+    if is_hls_url(url):
+        return download_hls(url, output_path, headers=headers)
+    return download_file(url, output_path, headers=headers)
 
 # ===== استخراج الفيديو المباشر باستخدام Selenium =====
 def extract_direct_video_with_selenium(server_url, referer):
-    driver = setup_selenium()
-    if not driver:
+    with driver_pool.lease() as driver:
+        if not driver:
+            return None
+        return _extract_direct_video(driver, server_url)
+
+def probe_server(server_url, referer, cancel):
+    """فحص سيرفر واحد ضمن السباق، مع التوقف إذا وُجد فائز قبل بدء الفحص؛ يعيد (video_url, headers) أو None"""
+    if cancel.is_set():
         return None
+    print(f"🔄 فحص السيرفر: {server_url[:80]}...")
+    return extract_direct_video_with_selenium(server_url, referer)
+
+def _extract_direct_video(driver, server_url):
     try:
         print(f"🔄 فتح السيرفر باستخدام Selenium: {server_url[:80]}...")
-        driver.get(server_url)
-        time.sleep(5)
+        media = capture_media_request(driver, server_url)
+        if media:
+            return media['url'], media['headers']
+        if not NETWORK_CAPTURE:
+            # انتظار ظهور رابط mp4 أو m3u8 في الصفحة
+            wait_for(driver, page_source_matches(r'https?://[^"\']+\.(?:mp4|m3u8)'), "page_source")
         page_source = driver.page_source
         
         # البحث عن mp4
         match = re.search(r'(https?://[^"\']+\.mp4[^"\']*)', page_source)
         if match:
-            return match.group(1)
+            return match.group(1), {}
         
         # البحث عن sources
         match = re.search(r'sources:\s*\[\s*"([^"]+\.mp4[^"]*)"\s*\]', page_source)
         if match:
-            return match.group(1)
+            return match.group(1), {}
         
         # البحث عن رابط m3u8
         match = re.search(r'(https?://[^"\']+\.m3u8[^"\']*)', page_source)
         if match:
-            return match.group(1)
+            return match.group(1), {}
         
         return None
     except Exception as e:
         print(f"❌ خطأ في Selenium: {e}")
         return None
-    finally:
-        driver.quit()
 
 # ===== محاولة التنزيل باستخدام yt-dlp (كحل أخير) =====
-def download_with_ytdlp(url, output_path, referer):
+def download_with_ytdlp(url, output_path, referer, headers=None):
     try:
         # نزيل الأحرف العربية من الـ referer إن وجدت
         safe_referer = re.sub(r'[^\x00-\x7F]+', '', referer) if referer else ''
         ydl_opts = {
-            'format': 'best[height<=720]/best',
+            **ytdlp_format_options(),
             'outtmpl': output_path,
             'quiet': False,
             'retries': 3,
             'fragment_retries': 3,
+            'concurrent_fragment_downloads': HLS_WORKERS,
             'socket_timeout': 30,
             'extractor_args': {'generic': 'impersonate'},
             'encoding': 'utf-8',
             'http_headers': {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Referer': safe_referer,
                 'Accept-Language': 'en-US,en;q=0.9',
+                **(headers or {}),
+                'Referer': safe_referer,
             }
         }
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
@@ -240,13 +220,8 @@ def download_with_ytdlp(url, output_path, referer):
         return False
 
 # ===== دالة التحميل الرئيسية =====
-def download_episode(episode_num, series_name_arabic, download_dir, config):
-    domain = config.get("domain", "lodynet.watch")
-    page_url = f"https://{domain}/{series_name_arabic}-حلقة-{episode_num}"
-    
-    print(f"\n🎬 Episode {episode_num}")
-    print(f"🔗 Page URL: {page_url}")
-
+def download_from_servers(episode_num, series_name_arabic, domain, page_url, temp_file, cache_key):
+    """استخراج السيرفرات من صفحة الحلقة والتنزيل من أول سيرفر يعمل، مع حفظ الرابط الناجح في الذاكرة"""
     # 1. الحصول على HTML
     html = get_page_html(page_url)
     if not html:
@@ -271,37 +246,82 @@ def download_episode(episode_num, series_name_arabic, download_dir, config):
 
     print(f"🔍 تم العثور على {len(server_urls)} سيرفر.")
 
-    temp_file = os.path.join(download_dir, f"temp_{episode_num}.mp4")
-    downloaded = False
-
-    for idx, server_url in enumerate(server_urls, 1):
-        print(f"🔄 محاولة السيرفر {idx}: {server_url[:80]}...")
-        
-        # أولاً: نحاول استخراج رابط مباشر باستخدام Selenium
-        direct_url = extract_direct_video_with_selenium(server_url, page_url)
-        if direct_url:
+    # أولاً: فحص السيرفرات بالتوازي بـ Selenium (مرتبة حسب صحتها، مع تخطي المتعطلة) واستخدام أول رابط مباشر
+    remaining = host_health.order(server_urls)
+    while remaining:
+        results = race_collect(remaining, lambda url, cancel: probe_server(url, page_url, cancel),
+                               grace=MIRROR_GRACE_SECONDS)
+        if not results:
+            break
+        # كل السيرفرات تُضغط إلى نفس الدقة، لذا نبدأ بالأصغر حجماً
+        for server_url, (direct_url, headers) in rank_mirrors_by_size(
+                results, lambda media: (media[0], {**media[1], 'Referer': page_url})):
+            if cancelled():
+                return False, "انتهى وقت التشغيل"
+            remaining.remove(server_url)
+            print(f"🏁 السيرفر المختار: {server_url[:80]}...")
             print(f"✅ تم استخراج رابط مباشر: {direct_url[:80]}...")
-            if download_with_requests(direct_url, temp_file, page_url):
-                downloaded = True
-                break
-            else:
+            started = time.time()
+            ok = download_with_requests(direct_url, temp_file, page_url, headers)
+            if not ok:
                 print("⚠️ فشل التنزيل عبر requests، نحاول yt-dlp...")
-                if download_with_ytdlp(direct_url, temp_file, page_url):
-                    downloaded = True
-                    break
-        
-        # إذا لم نستطع استخراج رابط مباشر، نحاول yt-dlp مباشرة على رابط السيرفر
-        print("🔄 محاولة التنزيل عبر yt-dlp على رابط السيرفر...")
-        if download_with_ytdlp(server_url, temp_file, page_url):
+                discard_hls_segments(temp_file)
+                ok = download_with_ytdlp(direct_url, temp_file, page_url, headers)
+            host_health.record_download_file(server_url, ok, temp_file, started)
+            if ok:
+                url_cache.put(cache_key, direct_url, page_url, headers)
+                return True, "تم التنزيل"
+
+    # إذا لم نستطع استخراج رابط مباشر، نحاول yt-dlp مباشرة على روابط السيرفرات المتبقية
+    for idx, server_url in enumerate(remaining, 1):
+        if cancelled():
+            return False, "انتهى وقت التشغيل"
+        print(f"🔄 محاولة التنزيل عبر yt-dlp على رابط السيرفر {idx}: {server_url[:80]}...")
+        started = time.time()
+        ok = download_with_ytdlp(server_url, temp_file, page_url)
+        host_health.record_download_file(server_url, ok, temp_file, started)
+        if ok:
+            return True, "تم التنزيل"
+
+    return False, "فشل التحميل من جميع السيرفرات"
+
+def download_episode(episode_num, series_name_arabic, download_dir, config, manifest):
+    domain = config.get("domain", "lodynet.watch")
+    page_url = f"https://{domain}/{series_name_arabic}-حلقة-{episode_num}"
+    
+    print(f"\n🎬 Episode {episode_num}")
+    print(f"🔗 Page URL: {page_url}")
+
+    cache_key = page_url
+    # الملف المؤقت في مجلد العمل الثابت (داخل .cache) ليُستكمل منه إذا توقف التشغيل بعد التنزيل
+    job = {
+        'caption': page_url,
+        'temp_file': os.path.join(manifest.work_dir(series_name_arabic), f"temp_{episode_num}.mp4"),
+        'final_file': os.path.join(download_dir, f"{series_name_arabic}_e{episode_num:02d}_240p.mp4"),
+    }
+    temp_file = job['temp_file']
+    stages = ['download', 'transcode']
+    downloaded = manifest.resume(job, stages) > 0
+    if downloaded:
+        print("♻️ الملف المنزَّل محفوظ من تشغيل سابق")
+
+    # 0. رابط محلول سابقاً وما زال صالحاً: تنزيل مباشر بدون فتح الصفحة أو المتصفح
+    cached = None if downloaded else url_cache.get(cache_key)
+    if cached:
+        if download_with_requests(cached['video_url'], temp_file, cached.get('referer') or page_url, cached.get('headers')):
             downloaded = True
-            break
+        else:
+            url_cache.evict(cache_key)
 
     if not downloaded:
-        return False, "فشل التحميل من جميع السيرفرات"
+        downloaded, message = download_from_servers(episode_num, series_name_arabic, domain, page_url, temp_file, cache_key)
+        if not downloaded:
+            return False, message
+    manifest.complete(job, 'download')
 
     # 3. ضغط الفيديو
-    final_file = os.path.join(download_dir, f"{series_name_arabic}_e{episode_num:02d}_240p.mp4")
-    if not compress_to_240p(temp_file, final_file):
+    final_file = job['final_file']
+    if not transcode_240p(temp_file, final_file):
         shutil.copy2(temp_file, final_file)
         print("⚠️ فشل الضغط، تم حفظ الملف الأصلي.")
 
@@ -309,27 +329,12 @@ def download_episode(episode_num, series_name_arabic, download_dir, config):
         os.remove(temp_file)
     except:
         pass
+    manifest.complete(job, 'transcode')
 
     print(f"✅ تم حفظ الفيديو في: {final_file}")
     return True, "تم بنجاح"
 
 # ===== دوال الضغط والصور المصغرة =====
-def compress_to_240p(input_path, output_path):
-    if not os.path.exists(input_path):
-        return False
-    cmd = [
-        'ffmpeg', '-i', input_path,
-        '-vf', 'scale=-2:240',
-        '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast',
-        '-c:a', 'aac', '-b:a', '64k',
-        '-y', output_path
-    ]
-    try:
-        subprocess.run(cmd, capture_output=True, timeout=1800)
-        return os.path.exists(output_path)
-    except:
-        return False
-
 def create_thumbnail(video_path, thumb_path):
     cmd = [
         'ffmpeg', '-i', video_path,
@@ -347,6 +352,7 @@ def main():
     print("="*50)
     print("🎬 تنزيل وضغط فيديو من lodynet (باستخدام requests)")
     print("="*50)
+    budget = TimeBudget("script")
 
     try:
         subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
@@ -371,10 +377,6 @@ def main():
     start_ep = int(config.get("start_episode", 1))
     end_ep = int(config.get("end_episode", 1))
 
-    if end_ep - start_ep + 1 > 25:
-        print("⚠️ عدد الحلقات كبير، سيتم معالجة 25 حلقة فقط.")
-        end_ep = start_ep + 24
-
     print(f"📺 المسلسل: {series_name_arabic}")
     print(f"🎬 الحلقات: {start_ep} إلى {end_ep}")
 
@@ -384,8 +386,21 @@ def main():
     successful = 0
     failed = []
 
-    for ep in range(start_ep, end_ep + 1):
-        success, msg = download_episode(ep, series_name_arabic, download_dir, config)
+    manifest = Manifest("script")
+    domain = config.get("domain", "lodynet.watch")
+
+    def pending_episodes():
+        # الحلقات المكتملة سابقاً رُفعت مع artifacts ذلك التشغيل
+        for ep in range(start_ep, end_ep + 1):
+            if manifest.is_done(f"https://{domain}/{series_name_arabic}-حلقة-{ep}", 'transcode'):
+                print(f"⏭️ الحلقة {ep}: مكتملة في تشغيل سابق")
+                continue
+            yield ep
+
+    # كل حلقة هنا مرحلة واحدة متسلسلة (تنزيل + ضغط)
+    for ep in budget.admit(pending_episodes(), ['episode']):
+        episode_start = time.time()
+        success, msg = download_episode(ep, series_name_arabic, download_dir, config, manifest)
         if success:
             successful += 1
             print(f"✅ الحلقة {ep} اكتملت")
@@ -393,14 +408,16 @@ def main():
             failed.append(ep)
             print(f"❌ الحلقة {ep}: {msg}")
 
-        wait_time = random.randint(30, 45)
-        print(f"⏳ انتظار {wait_time} ثانية...")
-        time.sleep(wait_time)
+        budget.record({'success': success, 'timings': {'episode': time.time() - episode_start}})
 
     print(f"\n✅ الناجحة: {successful}/{len(range(start_ep, end_ep+1))}")
     if failed:
         print(f"❌ الفاشلة: {failed}")
     print(f"📂 الملفات المحفوظة في: {download_dir}")
+    print_wait_summary()
+    host_health.print_summary()
+    host_scheduler.print_summary()
+    driver_pool.close_all()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+سجل نقاط التوقف لكل حلقة: المراحل المكتملة، الملفات الناتجة مع حجمها وبصمتها،
+ورقم رسالة تليغرام. يُحفظ في مجلد .cache الذي يستعيده الـ workflow،
+فإعادة تشغيل فاشل تكمل من آخر مرحلة بدلاً من البدء من start_episode.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# مجلد الحالة المحفوظة بين التشغيلات (يستعيده الـ workflow)، مشترك بين كل الوحدات
+CACHE_DIR = os.environ.get("CACHE_DIR", ".cache")
+# ملفات الحلقات غير المكتملة تبقى هنا لتُستكمل في التشغيل القادم على نفس الجهاز؛
+# الـ workflows تستثنيها من ذاكرة Actions لحجمها، فيُكتشف غيابها ويُعاد المدخل من البداية
+WORK_DIR = os.environ.get("STATE_WORK_DIR", os.path.join(CACHE_DIR, "work"))
+
+# حقول المهمة التي تمثل ملفات على القرص
+FILE_FIELDS = ('temp_file', 'final_file', 'thumb_file')
+# حقول وقت التشغيل التي لا معنى لحفظها
+RUNTIME_FIELDS = ('timings', 'success', 'message', 'resume_from')
+
+
+def load_json(path, label):
+    """قراءة ملف حالة JSON؛ الملف غير الموجود أو التالف يعني حالة فارغة"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"⚠️ تعذّر قراءة {label}: {e}")
+        return {}
+
+
+def save_json_atomic(path, data, label):
+    """الكتابة إلى ملف .tmp ثم os.replace، فلا يبقى ملف نصف مكتوب إذا انقطع التشغيل أثناء الحفظ"""
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"⚠️ تعذّر حفظ {label}: {e}")
+
+
+def file_digest(path):
+    """بصمة sha256 للملف"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    مدخل لكل حلقة (المفتاح عادةً عنوان الحلقة job['caption']):
+    {'stages': [...], 'artifacts': {field: {'path', 'size', 'sha256'}}, 'fields': {...}, 'message_id', 'updated_at'}
+    """
+
+    def __init__(self, name, path=None):
+        self.name = name
+        self.path = path or os.path.join(CACHE_DIR, f"manifest_{name}.json")
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        return load_json(self.path, "سجل الحلقات")
+
+    def _save(self):
+        save_json_atomic(self.path, self._entries, "سجل الحلقات")
+
+    def work_dir(self, label):
+        """مجلد ثابت لملفات سلسلة واحدة (بدلاً من مجلد جديد بتاريخ كل تشغيل) حتى يمكن الاستكمال"""
+        path = os.path.join(WORK_DIR, self.name, hashlib.sha1(label.encode()).hexdigest()[:12])
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def is_done(self, key, last_stage):
+        entry = self.get(key)
+        return bool(entry) and last_stage in entry.get('stages', [])
+
+    def _artifacts_valid(self, artifacts):
+        for info in artifacts.values():
+            path = info['path']
+            try:
+                if os.path.getsize(path) != info['size'] or file_digest(path) != info['sha256']:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def resume(self, job, stage_names):
+        """
+        استعادة حقول المهمة المحفوظة وإرجاع رقم أول مرحلة يجب تشغيلها.
+        تُعتبر المرحلة مكتملة إذا سُجّلت هي أو مرحلة بعدها وما زالت ملفات آخر مرحلة مسجلة سليمة.
+        المراحل التي اسمها None لا تُستأنف أبداً (مثل الاستخراج: الرابط الموقّع ينتهي بين التشغيلات).
+        """
+        entry = self.get(job['caption'])
+        if not entry:
+            return 0
+        completed = [idx for idx, name in enumerate(stage_names)
+                     if name is not None and name in entry.get('stages', [])]
+        if not completed:
+            return 0
+        if not self._artifacts_valid(entry.get('artifacts', {})):
+            print(f"⚠️ ملفات {job['caption']} المحفوظة ناقصة أو تغيّرت، البدء من جديد")
+            self.reset(job['caption'])
+            return 0
+        for field, value in entry.get('fields', {}).items():
+            job.setdefault(field, value)
+        return max(completed) + 1
+
+    def complete(self, job, stage):
+        """تسجيل اكتمال مرحلة مع حقول المهمة والملفات الموجودة حالياً"""
+        fields = {}
+        for field, value in job.items():
+            if field in RUNTIME_FIELDS:
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            fields[field] = value
+        artifacts = {}
+        for field in FILE_FIELDS:
+            path = job.get(field)
+            if path and os.path.exists(path):
+                artifacts[field] = {'path': path, 'size': os.path.getsize(path), 'sha256': file_digest(path)}
+
+        with self._lock:
+            entry = self._entries.setdefault(job['caption'], {'stages': []})
+            if stage not in entry['stages']:
+                entry['stages'].append(stage)
+            entry['fields'] = fields
+            entry['artifacts'] = artifacts
+            if job.get('message_id'):
+                entry['message_id'] = job['message_id']
+            entry['updated_at'] = time.time()
+            self._save()
+
+    def discard_stages(self, key, stage_names):
+        """
+        مرحلة فشلت: حذفها وكل ما بعدها من السجل حتى لا يُستأنف منها في التشغيل القادم.
+        إذا لم تبقَ أي مرحلة يُحذف المدخل كاملاً.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return
+            stages = [name for name in entry.get('stages', []) if name not in stage_names]
+            if stages == entry.get('stages', []):
+                return
+            if stages:
+                entry['stages'] = stages
+            else:
+                self._entries.pop(key)
+            self._save()
+
+    def reset(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+ضغط الفيديو إلى 240p، بما في ذلك وضع البث: تمرير المصدر مباشرة إلى ffmpeg أثناء التنزيل
+بدلاً من كتابة ملف مؤقت كامل ثم قراءته مرة أخرى للضغط وللصورة المصغرة.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from downloader import download_hls, discard_hls_segments, is_hls_url, USER_AGENT, TARGET_HEIGHT
+from pipeline import run_io, run_subprocess, run_process, carry_context
+
+# وضع البث (1 = تفعيل): يبدأ الضغط بينما البايتات ما زالت تصل. معطل افتراضياً لأنه يتجاوز محرك القرار
+# والضغط المتوازي والتنزيل متعدد الاتصالات، وحتى عند تفعيله لا يُستخدم إلا لمصدر يحتاج ضغطاً كاملاً
+STREAM_TRANSCODE = os.environ.get("STREAM_TRANSCODE", "0") == "1"
+STREAM_TRANSCODE_TIMEOUT = int(os.environ.get("STREAM_TRANSCODE_TIMEOUT", "3600"))
+
+# إعدادات الضغط إلى 240p (الصورة والصوت منفصلان ليمكن نسخ الصوت كما هو)؛
+# الدقة نفسها التي يختار التنزيل على أساسها (TARGET_HEIGHT في downloader)
+VIDEO_240P_ARGS = ['-vf', f'scale=-2:{TARGET_HEIGHT}', '-c:v', 'libx264', '-crf', '28', '-preset', 'veryfast']
+AUDIO_AAC_ARGS = ['-c:a', 'aac', '-b:a', '64k']
+ENCODE_240P_ARGS = VIDEO_240P_ARGS + AUDIO_AAC_ARGS
+REMUX_ARGS = ['-c', 'copy', '-movflags', '+faststart']
+
+# محرك القرار: مصدر بدقة TARGET_HEIGHT أو أقل، أو بمعدل بت أقل من هذا، لا يستفيد من إعادة الترميز
+TARGET_BITRATE_KBPS = int(os.environ.get("TARGET_BITRATE_KBPS", "400"))
+
+# الضغط المتوازي: تقسيم المصدر عند الإطارات المفتاحية وضغط الأجزاء على كل الأنوية
+PARALLEL_TRANSCODE = os.environ.get("PARALLEL_TRANSCODE", "1") == "1"
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+MIN_CHUNK_SECONDS = int(os.environ.get("MIN_CHUNK_SECONDS", "60"))
+TRANSCODE_TIMEOUT = 1800
+# الفرق المسموح بين مدة الناتج ومدة المصدر بعد الدمج (ثوانٍ)
+DURATION_TOLERANCE = 1.5
+
+STREAMABLE_EXTENSIONS = ('.mp4', '.m4v', '.mkv', '.webm', '.mov')
+
+
+def is_streamable_url(url):
+    """رابط ملف فيديو أو HLS يمكن لـ ffmpeg قراءته مباشرة (وليس صفحة embed تحتاج yt-dlp)"""
+    if not url or not url.startswith('http'):
+        return False
+    path = url.split('?', 1)[0].lower()
+    return is_hls_url(url) or path.endswith(STREAMABLE_EXTENSIONS)
+
+
+def transcode_output_args(final_path, thumb_path=None):
+    """مخرجات ffmpeg: النسخة المضغوطة، والصورة المصغرة من الثانية 5 في نفس المرور"""
+    args = ENCODE_240P_ARGS + ['-y', final_path]
+    if thumb_path:
+        args += ['-map', '0:v:0', '-ss', '00:00:05', '-frames:v', '1', '-s', '320x180',
+                 '-f', 'image2', '-y', thumb_path]
+    return args
+
+
+def request_headers(referer=None, headers=None):
+    """هيدرز طلب المصدر: User-Agent افتراضي، ثم هيدرز المشغّل الملتقطة (Cookie، Origin، ...)، ثم referer"""
+    merged = {'User-Agent': USER_AGENT, **(headers or {})}
+    if referer:
+        merged['Referer'] = referer
+    return merged
+
+
+def ffmpeg_header_args(referer=None, headers=None):
+    """نفس الهيدرز بصيغة ffmpeg/ffprobe للروابط البعيدة"""
+    merged = request_headers(referer, headers)
+    user_agent = merged.pop('User-Agent')
+    args = ['-user_agent', user_agent]
+    if merged:
+        args += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in merged.items())]
+    return args
+
+
+async def stream_transcode(url, final_path, thumb_path=None, referer=None, headers=None):
+    """
+    تنزيل وضغط في مرور واحد بدون ملف مؤقت:
+    - HLS: المقاطع تُنزَّل بالتوازي وتُمرَّر بالترتيب إلى ffmpeg فور اكتمالها
+    - ملف مباشر: ffmpeg يقرأ الرابط بنفسه مع الهيدرز وإعادة الاتصال عند الانقطاع
+    يعيد True عند النجاح، ويحذف الملف الناقص عند الفشل ليعود المستدعي إلى المسار العادي.
+    """
+    print(f"🌊 تنزيل وضغط في مرور واحد: {url[:100]}...")
+    if is_hls_url(url):
+        ok = await run_io(download_hls, url, final_path, request_headers(referer, headers),
+                          output_args=transcode_output_args(final_path, thumb_path))
+    else:
+        cmd = ['ffmpeg', '-loglevel', 'error',
+               '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '10',
+               '-rw_timeout', '30000000'] + ffmpeg_header_args(referer, headers)
+        cmd += ['-i', url] + transcode_output_args(final_path, thumb_path)
+        returncode, _, stderr = await run_subprocess(cmd, timeout=STREAM_TRANSCODE_TIMEOUT)
+        ok = returncode == 0
+        if not ok and stderr:
+            print(f"❌ ffmpeg: {stderr.decode(errors='ignore')[-300:]}")
+
+    if ok and os.path.exists(final_path):
+        return True
+    for path in (final_path, thumb_path):
+        if path and os.path.exists(path):
+            os.remove(path)
+    discard_hls_segments(final_path)
+    return False
+
+
+async def should_stream_transcode(url, referer=None, headers=None):
+    """
+    هل نستخدم وضع البث لهذا الرابط؟ فقط إذا كان مفعلاً، والرابط قابلاً للبث، وffprobe على الرابط نفسه
+    يقول إن المصدر سيحتاج ضغطاً كاملاً على أي حال؛ وإلا فالتنزيل ثم transcode_240p أرخص.
+    """
+    if not STREAM_TRANSCODE or not is_streamable_url(url):
+        return False
+    info = await run_io(probe_media, url, referer, headers)
+    mode, reason = decide_transcode(info)
+    if not info or mode != 'full':
+        print(f"🧭 لا حاجة لوضع البث: {mode} ({reason})")
+        return False
+    return True
+
+
+# ===== فحص المصدر واختيار طريقة الضغط =====
+def probe_media(path, referer=None, headers=None):
+    """
+    استدعاء ffprobe واحد يعيد ما نحتاجه لاتخاذ القرار:
+    {'duration', 'width', 'height', 'vcodec', 'acodec', 'format', 'bitrate_kbps', 'size'} أو None عند الفشل
+    path يمكن أن يكون رابطاً (مع referer وهيدرز المشغّل اختيارياً) لفحص المصدر قبل تنزيله.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json']
+    remote = path.startswith('http')
+    if remote:
+        cmd += ffmpeg_header_args(referer, headers)
+    try:
+        result = subprocess.run(cmd + [path], capture_output=True, text=True, timeout=30)
+        data = json.loads(result.stdout or '{}')
+    except Exception as e:
+        print(f"⚠️ فشل ffprobe: {e}")
+        return None
+    fmt = data.get('format') or {}
+    if not fmt:
+        return None
+    video = next((st for st in data.get('streams', []) if st.get('codec_type') == 'video'), {})
+    audio = next((st for st in data.get('streams', []) if st.get('codec_type') == 'audio'), {})
+    duration = float(fmt.get('duration') or 0)
+    size = int(fmt.get('size') or (0 if remote else os.path.getsize(path)))
+    return {
+        'duration': duration,
+        'width': int(video.get('width') or 0),
+        'height': int(video.get('height') or 0),
+        'vcodec': video.get('codec_name'),
+        'acodec': audio.get('codec_name'),
+        'format': fmt.get('format_name', ''),
+        'bitrate_kbps': size * 8 / duration / 1000 if size and duration else float(fmt.get('bit_rate') or 0) / 1000,
+        'size': size,
+    }
+
+
+def decide_transcode(info):
+    """
+    اختيار أرخص طريقة تعطي ملفاً صالحاً للرفع، وتعيد (mode, reason):
+    - passthrough: mp4 بـ h264/aac وصغير أصلاً ← يُستخدم الملف كما هو
+    - remux: نفس الترميزات في حاوية أخرى ← -c copy مع faststart
+    - video: الصورة تحتاج ضغطاً والصوت aac ← ضغط الصورة ونسخ الصوت
+    - full: ضغط الصورة والصوت
+    """
+    if not info or not info['vcodec']:
+        return 'full', "تعذر فحص المصدر"
+    compliant_video = info['vcodec'] == 'h264'
+    compliant_audio = info['acodec'] in ('aac', None)
+    small = info['height'] <= TARGET_HEIGHT or (info['bitrate_kbps'] and info['bitrate_kbps'] <= TARGET_BITRATE_KBPS)
+
+    if compliant_video and compliant_audio and small:
+        reason = f"h264/{info['acodec'] or 'بدون صوت'} بدقة {info['height']}p و {info['bitrate_kbps']:.0f} kbps"
+        if 'mp4' in info['format'] or 'mov' in info['format']:
+            return 'passthrough', reason
+        return 'remux', reason + f" داخل {info['format']}"
+    if info['acodec'] == 'aac':
+        return 'video', f"{info['vcodec']} بدقة {info['height']}p يحتاج ضغطاً، والصوت aac يُنسخ كما هو"
+    return 'full', f"{info['vcodec']}/{info['acodec']} بدقة {info['height']}p"
+
+
+def audio_args(mode):
+    """معاملات الصوت لكل طريقة: نسخ الصوت aac كما هو في 'video'، وترميزه في 'full'"""
+    return ['-c:a', 'copy'] if mode == 'video' else AUDIO_AAC_ARGS
+
+
+def encode_args(mode):
+    """معاملات ffmpeg لكل طريقة"""
+    if mode == 'remux':
+        return REMUX_ARGS
+    return VIDEO_240P_ARGS + audio_args(mode)
+
+
+def _run_ffmpeg(cmd, timeout):
+    """ffmpeg حاجب داخل خيط: يُنهى فعلاً عند المهلة أو موعد الانتهاء أو إلغاء المرحلة"""
+    returncode, _, stderr = run_process(cmd, timeout)
+    if returncode not in (0, None):
+        print(f"❌ ffmpeg: {stderr.decode(errors='ignore')[-300:]}")
+    return returncode == 0
+
+
+def _encode_single(input_path, output_path, args=ENCODE_240P_ARGS):
+    cmd = ['ffmpeg', '-loglevel', 'error', '-i', input_path] + args + ['-y', output_path]
+    return _run_ffmpeg(cmd, TRANSCODE_TIMEOUT) and os.path.exists(output_path)
+
+
+# ===== الضغط المتوازي المقسَّم عند الإطارات المفتاحية =====
+def _split_at_keyframes(input_path, work_dir, chunk_seconds):
+    """
+    تقسيم الصورة فقط بالنسخ المباشر (-c copy): الـ segment muxer يقطع عند أول إطار مفتاحي بعد كل حد.
+    الصوت لا يُقطع، لأن ترميز AAC لكل جزء يضيف صمتاً (priming/padding) يُسمع كفجوة عند كل حد.
+    """
+    pattern = os.path.join(work_dir, 'src_%04d.mkv')
+    cmd = ['ffmpeg', '-loglevel', 'error', '-i', input_path, '-map', '0:v:0',
+           '-c', 'copy', '-f', 'segment', '-segment_time', f'{chunk_seconds:.2f}',
+           '-reset_timestamps', '1', '-y', pattern]
+    if not _run_ffmpeg(cmd, 600):
+        return []
+    return sorted(os.path.join(work_dir, f) for f in os.listdir(work_dir) if f.startswith('src_'))
+
+
+def _encode_chunk(chunk_path, threads, video_args):
+    out_path = chunk_path.replace('src_', 'enc_').rsplit('.', 1)[0] + '.mp4'
+    cmd = (['ffmpeg', '-loglevel', 'error', '-i', chunk_path] + video_args
+           + ['-an', '-threads', str(threads), '-y', out_path])
+    return out_path if _run_ffmpeg(cmd, TRANSCODE_TIMEOUT) and os.path.exists(out_path) else None
+
+
+def _concat_and_mux(parts, input_path, output_path, work_dir, audio):
+    """دمج أجزاء الصورة بدون إعادة ترميز، مع صوت المصدر كاملاً في مرور واحد (نسخ أو ترميز مرة واحدة)"""
+    list_path = os.path.join(work_dir, 'concat.txt')
+    with open(list_path, 'w') as f:
+        for part in parts:
+            f.write(f"file '{os.path.abspath(part)}'\n")
+    cmd = (['ffmpeg', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-i', input_path,
+            '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy'] + audio
+           + ['-movflags', '+faststart', '-y', output_path])
+    return _run_ffmpeg(cmd, TRANSCODE_TIMEOUT) and os.path.exists(output_path)
+
+
+def _output_duration(path):
+    info = probe_media(path)
+    return info['duration'] if info else None
+
+
+def parallel_transcode(input_path, output_path, duration, mode='full', workers=TRANSCODE_WORKERS):
+    """
+    ضغط إلى 240p على كل الأنوية: libx264 بدقة 240p لا يستفيد كثيراً من الخيوط داخل عملية واحدة،
+    فنقسم صورة المصدر عند الإطارات المفتاحية إلى أجزاء، ونضغط كل جزء في عملية ffmpeg مستقلة،
+    ثم ندمج الأجزاء بدون إعادة ترميز مع صوت المصدر كاملاً (mode يحدد نسخه أو ترميزه)،
+    ونتحقق من أن المدة النهائية تطابق المصدر.
+    يعيد False عند أي خلل ليرجع المستدعي إلى الضغط العادي.
+    """
+    if not duration or workers < 2 or duration < MIN_CHUNK_SECONDS * 2:
+        return False
+
+    chunk_seconds = max(MIN_CHUNK_SECONDS, duration / workers)
+    work_dir = output_path + '.chunks'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    try:
+        chunks = _split_at_keyframes(input_path, work_dir, chunk_seconds)
+        if len(chunks) < 2:
+            return False
+        print(f"⚡ ضغط متوازي: {len(chunks)} جزء على {workers} نواة")
+        threads = max(1, workers // len(chunks))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="x264") as executor:
+            parts = list(executor.map(carry_context(lambda c: _encode_chunk(c, threads, VIDEO_240P_ARGS)), chunks))
+        if not all(parts) or not _concat_and_mux(parts, input_path, output_path, work_dir, audio_args(mode)):
+            return False
+
+        out_duration = _output_duration(output_path)
+        if out_duration is None or abs(out_duration - duration) > DURATION_TOLERANCE:
+            print(f"⚠️ مدة الناتج {out_duration} لا تطابق المصدر {duration:.1f}")
+            os.remove(output_path)
+            return False
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def output_media_info(info, mode):
+    """معلومات الملف الناتج محسوبة من معلومات المصدر وطريقة الضغط، بدون ffprobe إضافي"""
+    if not info:
+        return None
+    out = dict(info)
+    if mode in ('video', 'full') and info['height']:
+        # scale=-2:TARGET_HEIGHT يحافظ على النسبة ويقرّب العرض إلى عدد زوجي
+        out['width'] = int(round(info['width'] * TARGET_HEIGHT / info['height'] / 2)) * 2
+        out['height'] = TARGET_HEIGHT
+        out['vcodec'] = 'h264'
+        if mode == 'full' and info['acodec']:
+            out['acodec'] = 'aac'
+    return out
+
+
+def transcode_240p(input_path, output_path, info=None):
+    """
+    تجهيز الملف للرفع بأرخص طريقة يسمح بها المصدر (راجع decide_transcode).
+    في وضع passthrough يُنقل الملف المصدر إلى output_path بدلاً من نسخه.
+    يعيد معلومات الملف الناتج (قاموس probe_media) لتمريرها إلى الصورة المصغرة والرفع، أو None عند الفشل.
+    """
+    if not os.path.exists(input_path):
+        return None
+    info = info or probe_media(input_path)
+    mode, reason = decide_transcode(info)
+    print(f"🧭 طريقة الضغط: {mode} ({reason})")
+
+    if mode == 'passthrough':
+        os.replace(input_path, output_path)
+        return info
+    if mode == 'remux':
+        return output_media_info(info, mode) if _encode_single(input_path, output_path, REMUX_ARGS) else None
+
+    args = encode_args(mode)
+    if PARALLEL_TRANSCODE and info and parallel_transcode(input_path, output_path, info['duration'], mode):
+        return output_media_info(info, mode)
+    if _encode_single(input_path, output_path, args):
+        return output_media_info(info, mode)
+    # فشل الترميز: إعادة التغليف أرخص وأفضل من نسخ الملف كما هو
+    return output_media_info(info, 'remux') if _encode_single(input_path, output_path, REMUX_ARGS) else None
+
+
+async def compress_to_240p(input_path, output_path, info=None):
+    """ضغط الفيديو إلى 240p دون حجب حلقة الأحداث، ويعيد معلومات الملف الناتج"""
+    return await run_io(transcode_240p, input_path, output_path, info)
+
+
+async def probe_media_async(path):
+    return await run_io(probe_media, path)
+
+
+async def create_thumbnail(video_path, thumb_path, info=None):
+    """صورة مصغرة من الثانية 5، أو من ثلث المدة في الفيديوهات القصيرة"""
+    seek = 5
+    if info and info['duration']:
+        seek = min(seek, info['duration'] / 3)
+    cmd = [
+        'ffmpeg', '-ss', f'{seek:.2f}', '-i', video_path,
+        '-vframes', '1', '-s', '320x180',
+        '-f', 'image2', '-y', thumb_path
+    ]
+    returncode, _, _ = await run_subprocess(cmd, timeout=30)
+    return returncode == 0 and os.path.exists(thumb_path)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+أدوات الرفع إلى تليغرام: فهرس الحلقات المنشورة مسبقاً في القناة،
+حتى لا تُعاد معالجة حلقة موجودة أو تُنشر مرتين، ورفع عدة ملفات بالتوازي مع الحفاظ على ترتيب النشر.
+"""
+
+import asyncio
+import math
+import os
+import threading
+import time
+
+from pyrogram import raw, types, utils
+from pyrogram.errors import FilePartMissing, FloodWait
+from pyrogram.session import Session
+
+from ratelimit import telegram_limiter
+from state import CACHE_DIR, load_json, save_json_atomic
+
+# أقصى عدد رسائل يُفحص في بحث القناة عند بناء الفهرس
+UPLOAD_INDEX_SCAN_LIMIT = int(os.environ.get("UPLOAD_INDEX_SCAN_LIMIT", "2000"))
+# أقصى عدد رسائل في صفحة messages.Search (نفس حد search_messages في pyrogram)
+SEARCH_PAGE_SIZE = 100
+# عدد الملفات التي تُرفع في نفس الوقت على نفس العميل
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "3"))
+# محاولات الرفع الكاملة (بعد FloodWait أو انقطاع)، والمحاولة التالية تكمل من آخر جزء مؤكد
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "4"))
+# أكبر من هذا الحجم يُرفع الملف بأجزاء saveBigFilePart نتتبعها بأنفسنا (نفس حد pyrogram)
+BIG_FILE_MB = 10
+# الملفات الأكبر من هذا الحجم تُرفع أجزاؤها عبر عدة اتصالات MTProto متوازية
+PARALLEL_UPLOAD_MIN_MB = int(os.environ.get("PARALLEL_UPLOAD_MIN_MB", "100"))
+PARALLEL_UPLOAD_CONNECTIONS = int(os.environ.get("PARALLEL_UPLOAD_CONNECTIONS", "4"))
+# طلبات الأجزاء الجارية في نفس الوقت على كل اتصال
+PARALLEL_UPLOAD_PIPELINE = 2
+PART_RETRIES = 3
+# أقصى حجم لجزء الملف في upload.saveBigFilePart
+PART_SIZE = 512 * 1024
+
+
+class UploadIndex:
+    """
+    فهرس {caption: message_id} للقناة، من ذاكرة محلية في .cache يُضاف إليها
+    نتيجة بحث واحد في القناة عن اسم المسلسل/الفيلم في بداية كل تشغيل.
+    """
+
+    def __init__(self, channel, path=None):
+        self.channel = str(channel)
+        self.path = path or os.path.join(CACHE_DIR, "upload_index.json")
+        self._lock = threading.Lock()
+        self._all = self._load()
+        self._entries = self._all.setdefault(self.channel, {})
+
+    def _load(self):
+        return load_json(self.path, "فهرس المرفوعات")
+
+    def _save(self):
+        save_json_atomic(self.path, self._all, "فهرس المرفوعات")
+
+    async def build(self, app, query, limit=UPLOAD_INDEX_SCAN_LIMIT):
+        """
+        بحث في القناة عن الرسائل التي تحتوي query (اسم المسلسل أو الفيلم) وإضافة عناوينها للفهرس.
+        الصفحات تُطلب صراحةً (messages.Search) حتى يأخذ كل طلب رمزاً من telegram_limiter،
+        وبدون sleep_threshold حتى يصل FloodWait إلى المنظّم بدلاً من أن ينام pyrogram بصمت.
+        """
+        if not app or not query:
+            return
+        start = time.time()
+        found = 0
+        offset = 0
+        try:
+            peer = await app.resolve_peer(self.channel)
+            while offset < limit:
+                page_size = min(SEARCH_PAGE_SIZE, limit - offset)
+                await telegram_limiter.acquire()
+                r = await app.invoke(raw.functions.messages.Search(
+                    peer=peer, q=query, filter=raw.types.InputMessagesFilterEmpty(),
+                    min_date=0, max_date=0, offset_id=0, add_offset=offset, limit=page_size,
+                    min_id=0, max_id=0, hash=0), sleep_threshold=0)
+                telegram_limiter.on_success()
+                messages = await utils.parse_messages(app, r, replies=0)
+                for message in messages:
+                    caption = (message.caption or '').strip()
+                    if caption and message.video:
+                        self._entries[caption] = message.id
+                        found += 1
+                offset += len(messages)
+                if len(messages) < page_size:
+                    break
+        except FloodWait as e:
+            telegram_limiter.on_flood_wait(e.value)
+            print(f"⚠️ FloodWait أثناء البحث في القناة، الاعتماد على ما جُمع والفهرس المحلي")
+        except Exception as e:
+            print(f"⚠️ تعذّر البحث في القناة، الاعتماد على الفهرس المحلي فقط: {e}")
+        with self._lock:
+            self._save()
+        print(f"📇 فهرس القناة: {found} فيديو لـ '{query}' ({time.time() - start:.1f} ثانية)، "
+              f"{len(self._entries)} في الفهرس")
+
+    def get(self, caption):
+        with self._lock:
+            return self._entries.get(caption.strip())
+
+    def add(self, caption, message_id):
+        with self._lock:
+            self._entries[caption.strip()] = message_id
+            self._save()
+
+    def pending(self, jobs):
+        """مُولِّد يمرر فقط الحلقات غير المنشورة في القناة"""
+        for job in jobs:
+            message_id = self.get(job['caption'])
+            if message_id:
+                print(f"⏭️ {job['caption']}: منشورة في القناة مسبقاً (رسالة {message_id})")
+                continue
+            yield job
+
+
+class OrderedUploader:
+    """
+    رفع عدة فيديوهات بالتوازي على عميل pyrogram واحد مع نشرها في القناة بترتيب الحلقات.
+    كل ملف يُرفع أولاً إلى "الرسائل المحفوظة" (me)، ثم يُنسخ إلى القناة عندما يحين دوره
+    (النسخ فوري لأن الملف موجود على سيرفرات تليغرام)، ثم تُحذف النسخة المؤقتة.
+    الدور يُحجز عند بدء الرفع، لذا يبقى ترتيب النشر هو ترتيب دخول الحلقات لمرحلة الرفع.
+    مع concurrency=1 يُرفع الملف مباشرة إلى القناة كما كان سابقاً.
+    """
+
+    def __init__(self, app, channel, concurrency=UPLOAD_CONCURRENCY):
+        self.app = app
+        self.channel = channel
+        self.concurrency = max(1, concurrency)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._turn_changed = asyncio.Condition()
+        self._next_ticket = 0
+        self._turn = 0
+        self._finished = set()
+
+    async def _wait_turn(self, ticket):
+        async with self._turn_changed:
+            await self._turn_changed.wait_for(lambda: self._turn == ticket)
+
+    async def _release_turn(self, ticket):
+        """إنهاء الدور (نجاحاً أو فشلاً أو إلغاءً) حتى لا تنتظره الحلقات التالية"""
+        async with self._turn_changed:
+            self._finished.add(ticket)
+            while self._turn in self._finished:
+                self._finished.discard(self._turn)
+                self._turn += 1
+            self._turn_changed.notify_all()
+
+    async def _send(self, chat_id, video, caption, **kwargs):
+        size_mb = os.path.getsize(video) / (1024 * 1024)
+        if size_mb <= BIG_FILE_MB:
+            return await with_retries(lambda: self.app.send_video(chat_id=chat_id, video=video, caption=caption,
+                                                                  **kwargs), os.path.basename(video))
+        connections = PARALLEL_UPLOAD_CONNECTIONS if size_mb >= PARALLEL_UPLOAD_MIN_MB else 1
+        return await with_retries(lambda: send_video_parallel(self.app, chat_id, video, caption,
+                                                              connections=connections, **kwargs),
+                                   os.path.basename(video))
+
+    async def send_video(self, video, caption, **kwargs):
+        """يعيد رسالة القناة المنشورة (pyrogram Message)، ويرفع استثناءات pyrogram للمستدعي"""
+        if self.concurrency == 1:
+            async with self._slots:
+                return await self._send(self.channel, video, caption, **kwargs)
+
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        staged = None
+        try:
+            async with self._slots:
+                staged = await self._send("me", video, caption, **kwargs)
+            await self._wait_turn(ticket)
+            return await with_retries(lambda: self.app.copy_message(self.channel, "me", staged.id), "نشر")
+        finally:
+            await self._release_turn(ticket)
+            if staged is not None:
+                try:
+                    await with_retries(lambda: self.app.delete_messages("me", staged.id), "حذف", retries=2)
+                except Exception as e:
+                    print(f"⚠️ تعذّر حذف النسخة المؤقتة من الرسائل المحفوظة: {e}")
+
+
+async def with_retries(make_call, label, retries=UPLOAD_RETRIES):
+    """
+    تنفيذ استدعاء تليغرام عبر telegram_limiter بعدد محاولات محدود: FloodWait يُبلَّغ للمنظّم
+    الذي يؤخر المحاولة التالية، وباقي الأخطاء تنتظر مهلة متزايدة. الرفع بالأجزاء يكمل من آخر جزء مؤكد، فالمحاولة الجديدة لا تعيد الملف من الصفر.
+    """
+    for attempt in range(1, retries + 1):
+        await telegram_limiter.acquire()
+        try:
+            result = await make_call()
+            telegram_limiter.on_success()
+            return result
+        except FloodWait as e:
+            # المنظّم يوقف كل الاستدعاءات (وليس هذا فقط) حتى انتهاء المدة
+            telegram_limiter.on_flood_wait(e.value)
+            if attempt == retries:
+                raise
+            print(f"⏳ [{label}] FloodWait {e.value} ثانية (محاولة {attempt}/{retries})")
+        except Exception as e:
+            if attempt == retries:
+                raise
+            wait_time = 5 * attempt
+            print(f"⚠️ [{label}] {e}، إعادة المحاولة بعد {wait_time} ثانية (محاولة {attempt}/{retries})")
+            await asyncio.sleep(wait_time)
+
+
+# ===== رفع ملف كبير بأجزاء متوازية مع تتبع الأجزاء المؤكدة =====
+# path -> {'file_id', 'total_parts', 'acked'}: يبقى بين المحاولات حتى ينجح الإرسال
+_upload_progress = {}
+
+
+def _upload_state(app, path):
+    size = os.path.getsize(path)
+    state = _upload_progress.get(path)
+    if not state or state['size'] != size:
+        state = {'file_id': app.rnd_id(), 'size': size, 'total_parts': math.ceil(size / PART_SIZE), 'acked': set()}
+        _upload_progress[path] = state
+    return state
+
+
+async def save_file_parallel(app, path, connections=PARALLEL_UPLOAD_CONNECTIONS):
+    """
+    رفع الملف كأجزاء upload.saveBigFilePart موزعة على عدة جلسات MTProto (اتصالات منفصلة)
+    بدلاً من الجلسة الواحدة التي يستخدمها save_file في pyrogram.
+    كل جزء يؤكده السيرفر يُسجَّل، فإذا فشل الرفع (انقطاع أو FloodWait طويل) تكمل المحاولة التالية
+    من الأجزاء الناقصة فقط. FloodWait على جزء يُبلَّغ لـ telegram_limiter ثم يُعاد الجزء نفسه،
+    وكل جزء له PART_RETRIES محاولة على الأكثر.
+    يعيد InputFileBig، ويطبع سرعة الرفع الكلية ومتوسط زمن الجزء ونصيب كل اتصال.
+    """
+    state = _upload_state(app, path)
+    file_id, total_parts, acked = state['file_id'], state['total_parts'], state['acked']
+    parts = asyncio.Queue()
+    for part in range(total_parts):
+        if part not in acked:
+            parts.put_nowait(part)
+    if parts.empty():
+        return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(path))
+    if acked:
+        print(f"♻️ استكمال الرفع من {len(acked)}/{total_parts} جزء مؤكد")
+
+    dc_id, auth_key, test_mode = await app.storage.dc_id(), await app.storage.auth_key(), await app.storage.test_mode()
+    sessions = [Session(app, dc_id, auth_key, test_mode, is_media=True)
+                for _ in range(max(1, min(connections, parts.qsize())))]
+    part_times = []
+    sent_per_session = [0] * len(sessions)
+
+    async def upload_part(session, part, chunk):
+        for attempt in range(1, PART_RETRIES + 1):
+            try:
+                await session.invoke(raw.functions.upload.SaveBigFilePart(
+                    file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=chunk),
+                    sleep_threshold=0)
+                return
+            except FloodWait as e:
+                # المنظّم المشترك يتعلم من FloodWait الأجزاء أيضاً ويؤخر باقي استدعاءات تليغرام
+                telegram_limiter.on_flood_wait(e.value)
+                if attempt == PART_RETRIES:
+                    # ليس FloodWait حتى لا يُبلَّغ المنظّم مرة ثانية في with_retries
+                    raise Exception(f"FloodWait متكرر على الجزء {part}")
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                if attempt == PART_RETRIES:
+                    raise Exception(f"فشل رفع الجزء {part}: {e}")
+                await asyncio.sleep(attempt)
+
+    async def worker(idx, session):
+        with open(path, 'rb') as fp:
+            while not parts.empty():
+                part = parts.get_nowait()
+                fp.seek(part * PART_SIZE)
+                chunk = fp.read(PART_SIZE)
+                started = time.time()
+                await upload_part(session, part, chunk)
+                acked.add(part)
+                part_times.append(time.time() - started)
+                sent_per_session[idx] += len(chunk)
+
+    started = time.time()
+    workers = []
+    try:
+        await asyncio.gather(*(session.start() for session in sessions))
+        workers = [asyncio.create_task(worker(idx, session))
+                   for idx, session in enumerate(sessions)
+                   for _ in range(PARALLEL_UPLOAD_PIPELINE)]
+        await asyncio.gather(*workers)
+    finally:
+        # فشل عامل واحد لا يوقف الباقين في gather: إلغاؤهم وانتظارهم قبل إغلاق الجلسات التي يستخدمونها
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+
+    elapsed = max(time.time() - started, 0.001)
+    mb = sum(sent_per_session) / (1024 * 1024)
+    per_session = ", ".join(f"{sent / (1024 * 1024) / elapsed:.1f}" for sent in sent_per_session)
+    avg_part_ms = sum(part_times) / len(part_times) * 1000 if part_times else 0
+    print(f"📤 رفع {mb:.0f}MB في {elapsed:.0f} ثانية ({mb / elapsed:.1f} MB/s) عبر {len(sessions)} اتصالات "
+          f"[{per_session} MB/s]، {len(part_times)} جزء بمتوسط {avg_part_ms:.0f}ms للجزء")
+    return raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(path))
+
+
+async def send_video_parallel(app, chat_id, video, caption, connections=PARALLEL_UPLOAD_CONNECTIONS,
+                              supports_streaming=True, width=0, height=0, duration=0, thumb=None):
+    """نفس send_video في pyrogram لكن برفع الملف عبر save_file_parallel، يعيد Message"""
+    file = await save_file_parallel(app, video, connections)
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type="video/mp4",
+        file=file,
+        thumb=await app.save_file(thumb) if thumb else None,
+        attributes=[
+            raw.types.DocumentAttributeVideo(supports_streaming=supports_streaming or None,
+                                             duration=duration, w=width, h=height),
+            raw.types.DocumentAttributeFilename(file_name=os.path.basename(video)),
+        ]
+    )
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            r = await app.invoke(raw.functions.messages.SendMedia(
+                peer=await app.resolve_peer(chat_id),
+                media=media,
+                random_id=app.rnd_id(),
+                **await utils.parse_text_entities(app, caption, None, None)
+            ))
+            break
+        except FilePartMissing as e:
+            if attempt == UPLOAD_RETRIES:
+                raise
+            # جزء لم يصل للسيرفر: إلغاء تأكيده ورفعه وحده (باقي الأجزاء مؤكدة) ثم إعادة الإرسال
+            print(f"🧩 الجزء {e.value} مفقود على السيرفر، إعادة رفعه (محاولة {attempt}/{UPLOAD_RETRIES})")
+            _upload_state(app, video)['acked'].discard(e.value)
+            await save_file_parallel(app, video, connections=1)
+    # الملف صار رسالة: لا حاجة لتتبع أجزائه بعد الآن
+    _upload_progress.pop(video, None)
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(app, update.message,
+                                              {u.id: u for u in r.users}, {c.id: c for c in r.chats})
+    return None